@@ -0,0 +1,182 @@
+""" This file times the Scheduler on a set of generated layouts that stand
+    in for the kinds of solutions people run:
+        pipeline: a long row of nodes passing values along
+        grid: a wide grid of nodes doing local math and jumps
+        jro: nodes looping through JRO with immediates and ACC
+        io: a chain fed from an input port and drained into an output port
+
+    Each workload is reported with
+        cycles_per_sec: simulated cycles per second of wall time
+        instructions_per_sec: instructions executed per second
+        peak_bytes: the most memory allocated while building and running it
+
+    usage: python benchmark.py [--repeat N] [--baseline FILE]
+                               [--tolerance T] [--save FILE]
+    --baseline compares against an earlier --save, any workload more than
+    T (0.2 by default) slower than its baseline makes the exit status 1
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from array import array
+
+from main import make_grid, update_output_table
+from ports import InputPort, OutputPort
+from scheduler import Scheduler
+import tracing
+
+# a workload that runs slower than baseline * (1 - TOLERANCE) regressed
+TOLERANCE = 0.2
+
+
+def pipeline(length=200):
+    """ A row of nodes passing a counter from left to right """
+    programs = dict(((x, 0), ["MOV LEFT, RIGHT"]) for x in range(length))
+    programs[(0, 0)] = ["ADD 1", "MOV ACC, RIGHT"]
+    programs[(length - 1, 0)] = ["MOV LEFT, ACC", "SAV"]
+    return make_grid(programs)
+
+
+def grid(width=20, height=20):
+    """ A grid of nodes that never talk to each other """
+    program = ["top:", "ADD 1", "SAV", "NEG", "JLZ top", "SWP", "SUB 2",
+               "JGZ top", "JMP top"]
+    return make_grid(dict(((x, y), program) for x in range(width)
+                          for y in range(height)))
+
+
+def jro(count=200):
+    """ Nodes jumping around with JRO on immediates and on ACC """
+    program = ["MOV 1, ACC", "top:", "JRO ACC", "ADD 0", "JRO 2", "NOP",
+               "JRO -4"]
+    return make_grid(dict(((x, 0), program) for x in range(count)))
+
+
+def io_chain(length=50, values=10000):
+    """ A row of nodes adding one to a stream of values """
+    programs = dict(((x, 0), ["MOV LEFT, RIGHT"]) for x in range(length))
+    programs[(0, 0)] = ["MOV LEFT, ACC", "ADD 1", "MOV ACC, RIGHT"]
+    nodes = make_grid(programs)
+    pipes = [InputPort(-1, 0, range(values)),
+             OutputPort(length, 0, array("q", [0]) * values)]
+    update_output_table(nodes, pipes)
+    return nodes + pipes
+
+
+# name -> (layout builder, cycles to run it for)
+WORKLOADS = {"pipeline": (pipeline, 2000),
+             "grid": (grid, 2000),
+             "jro": (jro, 2000),
+             "io": (io_chain, 5000)}
+
+
+def count_instructions(build, cycles):
+    """ Returns the number of instructions a workload executes, this runs
+        it again with tracing on so it is kept out of the timed run
+    """
+    counter = [0]
+
+    def count(record):
+        counter[0] += 1
+
+    tracer = tracing.Tracer(level=tracing.DEBUG, events=["execute"],
+                            sinks=[tracing.CallbackSink(count)])
+    Scheduler(build(), tracer).run(cycles)
+    return counter[0]
+
+
+def run_workload(build, cycles, repeat=3):
+    """ Returns the measurements of one workload, the fastest of repeat
+        timed runs is kept
+    """
+    best = None
+    for i in range(repeat):
+        scheduler = Scheduler(build())
+        start = time.perf_counter()
+        scheduler.run(cycles)
+        elapsed = time.perf_counter() - start
+        if (best is None or elapsed < best):
+            best = elapsed
+    ran = scheduler.cycle
+
+    tracemalloc.start()
+    Scheduler(build()).run(cycles)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    instructions = count_instructions(build, cycles)
+    best = max(best, 1e-9)
+    return {"cycles": ran,
+            "seconds": best,
+            "cycles_per_sec": ran / best,
+            "instructions_per_sec": instructions / best,
+            "peak_bytes": peak}
+
+
+def run_benchmarks(workloads=None, repeat=3):
+    """ Runs every workload, returns {name: measurements} """
+    workloads = WORKLOADS if workloads is None else workloads
+    return dict((name, run_workload(build, cycles, repeat))
+                for name, (build, cycles) in workloads.items())
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Returns the names of the workloads whose cycles/sec dropped more
+        than tolerance below their baseline
+    """
+    slower = []
+    for name, result in sorted(results.items()):
+        if (name not in baseline):
+            continue
+        expected = baseline[name]["cycles_per_sec"]
+        if (result["cycles_per_sec"] < expected * (1 - tolerance)):
+            slower.append(name)
+    return slower
+
+
+def format_results(results, baseline=None):
+    """ Turns results into a table, one line per workload """
+    lines = ["%-10s %12s %16s %12s %8s" % ("workload", "cycles/s",
+                                          "instructions/s", "peak KiB",
+                                          "change")]
+    for name, result in sorted(results.items()):
+        change = ""
+        if (baseline and name in baseline):
+            change = "%+.0f%%" % (100.0 * result["cycles_per_sec"] /
+                                  baseline[name]["cycles_per_sec"] - 100)
+        lines.append("%-10s %12.0f %16.0f %12.1f %8s" % (
+            name, result["cycles_per_sec"], result["instructions_per_sec"],
+            result["peak_bytes"] / 1024.0, change))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the Scheduler on "
+                                     "generated layouts")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--save", default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(repeat=args.repeat)
+    baseline = None
+    if (args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if (args.save):
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if (baseline):
+        slower = compare(results, baseline, args.tolerance)
+        if (slower):
+            print("slower than baseline: " + ", ".join(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+""" This file contains the ProgramCache, which keeps parsed layouts on
+    disk so repeat runs of the same layout skip parsing and validation.
+
+    Entries are keyed by a hash of the layout's source text and hold
+    every node's class, position, its program as returned by
+    get_program() (lines, code table, labels, pc tables) and its
+    neighbors.
+    Loading an entry only has to rebind the instruction handlers.
+
+    The cache stays under max_bytes by deleting the least recently used
+    entries, entries are touched every time they are loaded.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+from loader import iter_nodes
+from main import build_io_tables
+
+# bump when the cached format or parser output changes
+CACHE_VERSION = b"4"
+SUFFIX = ".layout"
+
+
+def layout_entries(nodes):
+    """ Returns a picklable description of a list of linked nodes, with
+        neighbors given by their index in nodes
+    """
+    index = dict((node, i) for i, node in enumerate(nodes))
+    entries = []
+    for node in nodes:
+        neighbors = tuple(index.get(neighbor) for neighbor in node.neighbors)
+        entries.append((type(node), node.xpos, node.ypos,
+                        node.get_program(), neighbors))
+    return entries
+
+
+def build_layout(entries):
+    """ Returns fresh linked nodes from what layout_entries() returned """
+    nodes = []
+    for node_type, xpos, ypos, program, neighbors in entries:
+        node = node_type(xpos, ypos)
+        node.set_program(program)
+        nodes.append(node)
+    for node, entry in zip(nodes, entries):
+        node.neighbors = tuple(None if neighbor is None else nodes[neighbor]
+                               for neighbor in entry[4])
+        node.build_priority()
+    return nodes
+
+
+class ProgramCache(object):
+
+    """ A directory of cached layouts, at most max_bytes in total """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source):
+        """ Returns the cache key of the layout text in source """
+        digest = hashlib.sha256(CACHE_VERSION)
+        digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, source):
+        """ Returns the linked nodes of source, None if it is not cached """
+        path = self.path(self.key(source))
+        try:
+            with open(path, "rb") as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # touch the entry so it is the last to be evicted
+        os.utime(path)
+        self.hits += 1
+
+        return build_layout(entries)
+
+    def store(self, source, nodes):
+        """ Caches the linked nodes parsed from source """
+        entries = layout_entries(nodes)
+
+        # write to a temporary file first so readers never see half an entry
+        handle, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path(self.key(source)))
+        self.evict()
+
+    def evict(self):
+        """ Deletes the least recently used entries until the cache fits """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if (not name.endswith(SUFFIX)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if (total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def load_layout(self, filename):
+        """ Returns the linked nodes of the layout in filename, parsing it
+            and caching the result if it is not cached yet
+        """
+        with open(filename) as f:
+            source = f.read()
+        nodes = self.load(source)
+        if (nodes is None):
+            nodes = list(iter_nodes(source.splitlines(), filename))
+            build_io_tables(nodes)
+            self.store(source, nodes)
+        return nodes
@@ -0,0 +1,92 @@
+""" This file scores a directory of solutions, each a layout file in the
+    nodes.txt format, by running them across a pool of worker processes.
+
+    Every solution is run until it halts (no node can do anything) or
+    runs out of cycles, and is scored TIS-100 style:
+        cycles: how many cycles it ran for
+        nodes: how many nodes hold code
+        instructions: how many lines of code, labels not included
+
+    usage: python evaluate.py <directory> [--workers N] [--max-cycles N]
+                              [--cache DIR]
+    prints a JSON list with one entry per solution
+    --cache keeps parsed layouts in DIR so reruns skip parsing
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ProgramCache
+from main import load_nodes, build_io_tables
+from scheduler import Scheduler
+
+MAX_CYCLES = 100000
+
+
+def score(nodes, scheduler):
+    """ Returns the score of a grid that has been run """
+    return {"cycles": scheduler.cycle,
+            "halted": scheduler.halted,
+            "nodes": sum(1 for node in nodes if node.code),
+            "instructions": sum(len(node.code) for node in nodes),
+            "valid": all(node.is_valid for node in nodes)}
+
+
+def evaluate_file(filename, max_cycles=MAX_CYCLES, cache_dir=None):
+    """ Loads, runs and scores the layout in filename
+        layouts are loaded through a ProgramCache in cache_dir if given
+    """
+    result = {"file": os.path.basename(filename)}
+    try:
+        if (cache_dir):
+            nodes = ProgramCache(cache_dir).load_layout(filename)
+        else:
+            nodes = load_nodes(filename)
+            build_io_tables(nodes)
+        scheduler = Scheduler(nodes)
+        scheduler.run(max_cycles)
+    except Exception as e:
+        # one broken solution must not take the rest of the batch with it
+        result["error"] = type(e).__name__ + ": " + str(e)
+        return result
+    result.update(score(nodes, scheduler))
+    return result
+
+
+def evaluate_directory(directory, workers=None, max_cycles=MAX_CYCLES,
+                       cache_dir=None):
+    """ Scores every file in directory across workers processes
+        (one per core by default), results are sorted by file name
+    """
+    filenames = sorted(os.path.join(directory, name)
+                       for name in os.listdir(directory)
+                       if os.path.isfile(os.path.join(directory, name)))
+    if (not filenames):
+        return []
+    workers = workers or os.cpu_count() or 1
+    # hand out files in chunks so small solutions don't pay a round trip each
+    chunksize = max(1, len(filenames) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(evaluate_file, filenames,
+                             [max_cycles] * len(filenames),
+                             [cache_dir] * len(filenames),
+                             chunksize=chunksize))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a directory of "
+                                     "solutions in the nodes.txt format")
+    parser.add_argument("directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES)
+    parser.add_argument("--cache", default=None)
+    args = parser.parse_args()
+    results = evaluate_directory(args.directory, args.workers,
+                                 args.max_cycles, args.cache)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
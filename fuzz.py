@@ -0,0 +1,558 @@
+""" This file fuzzes the ways a grid can be run against each other.
+
+    Random layouts of valid programs, with the odd stack node and input
+    port above or output port below the grid, are run on every engine
+    below, and the registers and MOV state of every node, the values on
+    every stack and the values read from and written to every port are
+    compared once the same number of cycles has gone by:
+        execute_next: Node.execute_next on its own, single node layouts
+            without stacks or ports only
+        tick: a plain Scheduler ticked cycles times
+        run: Scheduler.run, which stops once the grid halts
+        fuse: Scheduler(fuse=True), nodes in the middle of a fused block
+            are left out of the comparison
+        fast_forward: Scheduler.run(fast_forward=True)
+        fork: run half way, fork() and run the fork to the end
+        history: run to the end with a History, seek() back half way and
+            run to the end again
+        vector: VectorEngine, only the layouts it supports (no ANY or
+            LAST, no stacks and no ports as operands of ADD, SUB and JRO)
+            and only while every register fits in 64 bits, as it wraps
+            around where the others keep growing, the ports go in its
+            inputs and outputs
+    The reference is execute_next for a single node and tick for anything
+    bigger, as execute_next picks a value up without waiting for the
+    commit phase.
+
+    A case that makes an engine disagree is shrunk before being reported:
+    nodes and lines are dropped, numbers made smaller and the cycles cut
+    down for as long as the engine still disagrees. Cases are generated
+    and checked across a pool of worker processes.
+
+    usage: python fuzz.py [--cases N] [--workers N] [--seed N]
+                          [--cycles N] [--engines a,b,...]
+    prints every shrunk failing case as a layout in the nodes.txt format,
+    followed by its ports, exits with 1 if there were any
+"""
+
+import argparse
+import os
+import random
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from history import History
+from main import DIRECTIONS, build_io_tables, make_grid, update_output_table
+from node import Node, PORTS
+from ports import InputPort, OutputPort
+from scheduler import Scheduler
+from stack_node import StackNode
+from vector_engine import UnsupportedError, VectorEngine
+
+CASES = 1000
+CYCLES = 100
+MAX_LINES = 8
+MAX_LABELS = 2
+MAX_SIZE = 3
+# values fed to an input port and room in an output port
+MAX_VALUES = 8
+
+# instructions taking a number, ACC, NIL or a port
+ARITHMETIC = ("ADD", "SUB", "JRO")
+JUMPS = ("JMP", "JEZ", "JNZ", "JGZ", "JLZ")
+
+# a case is the code of each position and the cycles to run it for
+# stacks holds the positions of stack nodes, inputs the ((x, y), values) of
+# the input ports above the grid and outputs the ((x, y), room) of the
+# output ports below it
+Case = namedtuple("Case", "programs cycles stacks inputs outputs",
+                  defaults=((), (), ()))
+
+# engines that hold registers in 64 bits
+INT64_ENGINES = ("vector",)
+# engines that only run a single node
+SINGLE_NODE_ENGINES = ("execute_next",)
+INT64_LIMIT = 2 ** 63
+
+# engine disagreed with reference, expected and got are node states
+Failure = namedtuple("Failure", "engine reference case expected got")
+
+
+def random_number(rng):
+    """ Mostly small numbers, so jumps and loops do something """
+    if (rng.random() < 0.1):
+        return rng.randint(-999, 999)
+    return rng.randint(-5, 5)
+
+
+def random_operand(rng):
+    """ A number, ACC or NIL """
+    choice = rng.random()
+    if (choice < 0.6):
+        return str(random_number(rng))
+    return "ACC" if choice < 0.9 else "NIL"
+
+
+def random_instruction(rng, labels, ports):
+    """ One line of code, labels are the ones jumps can go to and ports
+        the registers MOV, ADD, SUB and JRO can read from and MOV write to
+    """
+    opcodes = sorted(Node.VALID_INSTRUCTIONS)
+    if (not labels):
+        opcodes = [opcode for opcode in opcodes if opcode not in JUMPS]
+    opcode = rng.choice(opcodes)
+    if (opcode in ARITHMETIC):
+        if (rng.random() < 0.3):
+            return opcode + " " + rng.choice(ports)
+        return opcode + " " + random_operand(rng)
+    if (opcode in JUMPS):
+        return opcode + " " + rng.choice(labels)
+    if (opcode == "MOV"):
+        if (rng.random() < 0.5):
+            source = rng.choice(ports)
+        else:
+            source = random_operand(rng)
+        destination = rng.choice(ports + ("ACC", "NIL"))
+        return "MOV " + source + ", " + destination
+    # the rest take no arguments
+    return opcode
+
+
+def random_program(rng, ports=PORTS, max_lines=MAX_LINES,
+                   max_labels=MAX_LABELS):
+    """ Returns the lines of a valid program, every jump goes to one of
+        its labels, which each sit on a line of their own
+    """
+    labels = ["L" + str(i) for i in range(rng.randint(0, max_labels))]
+    lines = [random_instruction(rng, labels, ports)
+             for i in range(rng.randint(1, max_lines))]
+    for label in labels:
+        lines.insert(rng.randint(0, len(lines)), label + ":")
+    return tuple(lines)
+
+
+def random_case(rng, cycles=CYCLES, max_size=MAX_SIZE, any_ports=True,
+                stacks=True):
+    """ Returns a Case on a grid of up to max_size by max_size nodes
+        any_ports lets MOV, ADD, SUB and JRO use ANY and LAST
+        stacks lets some positions hold a stack node instead of code
+    """
+    width = rng.randint(1, max_size)
+    height = rng.randint(1, max_size)
+    positions = []
+    stack_positions = []
+    for position in [(x, y) for x in range(width) for y in range(height)]:
+        choice = rng.random()
+        if (choice < 0.7):
+            positions.append(position)
+        elif (choice < 0.8 and stacks):
+            stack_positions.append(position)
+    if (not positions):
+        positions = [(0, 0)]
+        if ((0, 0) in stack_positions):
+            stack_positions.remove((0, 0))
+    # ports go above and below the nodes on the edges of the grid
+    inputs = tuple(((x, -1), tuple(random_number(rng) for i in
+                                   range(rng.randint(0, MAX_VALUES))))
+                   for x in range(width)
+                   if (x, 0) in positions and rng.random() < 0.5)
+    outputs = tuple(((x, height), rng.randint(0, MAX_VALUES))
+                    for x in range(width)
+                    if (x, height - 1) in positions and rng.random() < 0.5)
+    taken = set(positions + stack_positions)
+    taken.update(at for at, values in inputs + outputs)
+    programs = dict()
+    for x, y in positions:
+        # mostly MOV to ports that lead somewhere
+        ports = tuple(name for name, (dx, dy) in DIRECTIONS.items()
+                      if (x + dx, y + dy) in taken)
+        if (not ports or rng.random() < 0.1):
+            ports = PORTS
+        if (any_ports):
+            ports += ("ANY", "LAST")
+        programs[(x, y)] = random_program(rng, ports)
+    # random code seldom gets to a port, so some nodes start by reading
+    # their input or end by writing their output
+    for (x, y), values in inputs:
+        if (rng.random() < 0.5):
+            programs[(x, y + 1)] = ("MOV UP, ACC",) + programs[(x, y + 1)]
+    for (x, y), room in outputs:
+        if (rng.random() < 0.5):
+            programs[(x, y - 1)] += ("MOV ACC, DOWN",)
+    return Case(programs, rng.randint(1, cycles), tuple(stack_positions),
+                inputs, outputs)
+
+
+def build(case, ports=True):
+    """ Returns the linked nodes of case, the nodes with code first in
+        position order, then the stack nodes, the input and the output
+        ports, unless ports is False
+    """
+    nodes = make_grid(case.programs)
+    grid = nodes + [StackNode(x, y) for x, y in case.stacks]
+    build_io_tables(grid)
+    if (not ports):
+        return grid
+    pipes = [InputPort(x, y, values) for (x, y), values in case.inputs]
+    pipes += [OutputPort(x, y, [0] * room) for (x, y), room in case.outputs]
+    update_output_table(nodes, pipes)
+    return grid + pipes
+
+
+def vector_ports(case):
+    """ Returns the VectorEngine inputs and outputs of the ports of case,
+        inputs are above the node they feed and outputs below it
+    """
+    inputs = dict(((x, y + 1, "UP"), [values])
+                  for (x, y), values in case.inputs)
+    outputs = dict(((x, y - 1, "DOWN"), room)
+                   for (x, y), room in case.outputs)
+    return inputs, outputs
+
+
+def single_node(case):
+    """ Returns True if case is one node on its own """
+    return (len(case.programs) == 1 and
+            not (case.stacks or case.inputs or case.outputs))
+
+
+def is_valid(programs):
+    return all(node.is_valid for node in make_grid(programs))
+
+
+def position(node):
+    if (node is None):
+        return None
+    if (type(node) is tuple):
+        return "ANY"
+    if (type(node) in (InputPort, OutputPort)):
+        # the vector engine has no node for a port, a MOV on one shows up
+        # as on nothing there
+        return None
+    return (node.xpos, node.ypos)
+
+
+def node_states(nodes):
+    """ The registers and MOV state of every node, None for a node in the
+        middle of a fused block, the values on a stack, the count of
+        values read from an input port and the values written to an
+        output port
+    """
+    states = []
+    for node in nodes:
+        if (type(node) is OutputPort):
+            states.append(tuple(node.values[:node.count]))
+        elif (node.passive):
+            states.append(node.fingerprint())
+        elif (node.busy):
+            states.append(None)
+        else:
+            states.append((node.acc, node.bak, node.pc, position(node.last),
+                           node.value_to_send, node.receiving_into_acc,
+                           position(node.sending), position(node.receiving)))
+    return states
+
+
+def run_execute_next(case):
+    if (not single_node(case)):
+        raise ValueError("execute_next only runs a single node")
+    nodes = build(case)
+    for i in range(case.cycles):
+        nodes[0].execute_next()
+    return node_states(nodes)
+
+
+def run_tick(case):
+    nodes = build(case)
+    scheduler = Scheduler(nodes)
+    for i in range(case.cycles):
+        scheduler.tick()
+    return node_states(nodes)
+
+
+def run_run(case):
+    nodes = build(case)
+    # a halted grid stays as it is, so its state at cycles is the same
+    Scheduler(nodes).run(case.cycles)
+    return node_states(nodes)
+
+
+def run_fuse(case):
+    nodes = build(case)
+    Scheduler(nodes, fuse=True).run(case.cycles)
+    return node_states(nodes)
+
+
+def run_fast_forward(case):
+    nodes = build(case)
+    Scheduler(nodes).run(case.cycles, fast_forward=True)
+    return node_states(nodes)
+
+
+def run_fork(case):
+    scheduler = Scheduler(build(case))
+    scheduler.run(case.cycles // 2)
+    fork = scheduler.fork()
+    fork.run(case.cycles)
+    return node_states(fork.nodes)
+
+
+def run_history(case):
+    nodes = build(case)
+    scheduler = Scheduler(nodes)
+    history = History(scheduler)
+    scheduler.run(case.cycles)
+    history.seek(case.cycles // 2)
+    scheduler.run(case.cycles)
+    return node_states(nodes)
+
+
+def run_vector(case):
+    # raises UnsupportedError for code it cannot run and for stacks
+    nodes = build(case, ports=False)
+    inputs, outputs = vector_ports(case)
+    engine = VectorEngine(nodes, 1, inputs, outputs)
+    engine.run(case.cycles)
+    engine.write_back()
+    states = node_states(nodes)
+    for at, values in case.inputs:
+        states.append(int(engine.port_pos[engine.ports[
+            (at[0], at[1] + 1, "UP")]]))
+    for at, room in case.outputs:
+        key = (at[0], at[1] - 1, "DOWN")
+        count = int(engine.output_count[key][0])
+        states.append(tuple(engine.output_values_by_key()[key][0, :count]
+                            .tolist()))
+    return states
+
+
+# name -> function(case) returning node_states() after case.cycles
+ENGINES = {"execute_next": run_execute_next, "tick": run_tick,
+           "run": run_run, "fuse": run_fuse,
+           "fast_forward": run_fast_forward, "fork": run_fork,
+           "history": run_history, "vector": run_vector}
+
+
+def overflows(case):
+    """ Returns True if a register or offered value goes beyond 64 bits
+        within the cycles of case
+    """
+    grid = build(case)
+    scheduler = Scheduler(grid)
+    for i in range(case.cycles):
+        scheduler.tick()
+        for node in grid[:len(case.programs)]:
+            for value in (node.acc, node.bak, node.value_to_send or 0):
+                if (not -INT64_LIMIT <= value < INT64_LIMIT):
+                    return True
+    return False
+
+
+def same_states(expected, got):
+    """ Compares node_states() lists, skipping nodes that are None in
+        either
+    """
+    return len(expected) == len(got) and all(
+        a is None or b is None or a == b for a, b in zip(expected, got))
+
+
+def check_case(case, engines=ENGINES):
+    """ Runs case on every engine in engines (a dict as ENGINES) that can
+        run it, returns a Failure for each one that disagrees with the
+        reference
+    """
+    single = single_node(case)
+    reference = "execute_next" if single else "tick"
+    try:
+        expected = ENGINES[reference](case)
+    except OverflowError:
+        # stacks hold 64 bit values, a case pushing a bigger one is not run
+        return []
+    failures = []
+    for name, engine in engines.items():
+        if (name == reference or
+                (name in SINGLE_NODE_ENGINES and not single)):
+            continue
+        try:
+            got = engine(case)
+        except UnsupportedError:
+            continue
+        if (same_states(expected, got)):
+            continue
+        if (name in INT64_ENGINES and overflows(case)):
+            continue
+        failures.append(Failure(name, reference, case, expected, got))
+    return failures
+
+
+def fails(case, name, engine):
+    """ Returns True if engine, named name, disagrees on case """
+    return bool(check_case(case, {name: engine}))
+
+
+def smaller_cases(case):
+    """ Yields valid cases that are a bit smaller than case, the biggest
+        cuts first
+    """
+    programs, cycles = case.programs, case.cycles
+    # fewer cycles
+    for cut in (cycles // 2, cycles - 1):
+        if (0 < cut < cycles):
+            yield case._replace(cycles=cut)
+    # fewer stacks and ports, and fewer values to read
+    for i in range(len(case.stacks)):
+        yield case._replace(stacks=case.stacks[:i] + case.stacks[i + 1:])
+    for i in range(len(case.inputs)):
+        yield case._replace(inputs=case.inputs[:i] + case.inputs[i + 1:])
+    for i in range(len(case.outputs)):
+        yield case._replace(outputs=case.outputs[:i] + case.outputs[i + 1:])
+    for i, (at, values) in enumerate(case.inputs):
+        if (values):
+            yield case._replace(inputs=case.inputs[:i] + (
+                (at, values[:len(values) // 2]),) + case.inputs[i + 1:])
+    # fewer nodes, along with the ports next to them
+    if (len(programs) > 1):
+        for x, y in sorted(programs):
+            yield case._replace(
+                programs=dict((key, lines) for key, lines in programs.items()
+                              if key != (x, y)),
+                inputs=tuple(port for port in case.inputs
+                             if port[0] != (x, y - 1)),
+                outputs=tuple(port for port in case.outputs
+                              if port[0] != (x, y + 1)))
+    for at, lines in sorted(programs.items()):
+        # fewer lines, keeping the labels that are still jumped to
+        for i, line in enumerate(lines):
+            if (line.endswith(":") and
+                    any(jump.endswith(" " + line[:-1]) for jump in lines)):
+                continue
+            yield case._replace(programs=replace(programs, at, lines[:i] +
+                                                 lines[i + 1:]))
+        # smaller numbers
+        for i, line in enumerate(lines):
+            words = line.replace(",", "").split(" ")
+            for j, word in enumerate(words):
+                try:
+                    number = int(word)
+                except ValueError:
+                    continue
+                for smaller in (0, number // 2):
+                    if (abs(smaller) < abs(number)):
+                        yield case._replace(programs=replace(
+                            programs, at, lines[:i] + (format_instruction(
+                                words[:j] + [str(smaller)] + words[j + 1:]),) +
+                            lines[i + 1:]))
+
+
+def replace(programs, at, lines):
+    """ A copy of programs with the code at position at replaced """
+    programs = dict(programs)
+    programs[at] = tuple(lines)
+    return programs
+
+
+def format_instruction(words):
+    """ Joins an opcode and its arguments back into a line """
+    return words[0] + " " + ", ".join(words[1:]) if len(words) > 1 \
+        else words[0]
+
+
+def shrink(case, name, engine):
+    """ Returns the smallest case found by greedily cutting case down for
+        as long as engine, named name, still disagrees on it
+    """
+    shrunk = True
+    while (shrunk):
+        shrunk = False
+        for smaller in smaller_cases(case):
+            if (is_valid(smaller.programs) and fails(smaller, name, engine)):
+                case = smaller
+                shrunk = True
+                break
+    return case
+
+
+def check_cases(seed, count, cycles=CYCLES, names=None):
+    """ Generates and checks count cases, case i from random.Random(seed + i)
+        names limits the engines to those names
+        Returns a shrunk Failure for every case an engine disagreed on
+    """
+    engines = dict((name, ENGINES[name]) for name in names or ENGINES)
+    failures = []
+    for i in range(seed, seed + count):
+        rng = random.Random(i)
+        # ANY/LAST and stacks would keep the vector engine out of every
+        # grid using them
+        case = random_case(rng, cycles, any_ports=rng.random() < 0.5,
+                           stacks=rng.random() < 0.5)
+        for failure in check_case(case, engines):
+            engine = engines[failure.engine]
+            small = shrink(case, failure.engine, engine)
+            failures.extend(check_case(small, {failure.engine: engine}))
+    return failures
+
+
+def fuzz(cases=CASES, workers=None, seed=0, cycles=CYCLES, names=None):
+    """ Checks cases cases across workers processes (one per core by
+        default), returns every shrunk Failure
+    """
+    workers = workers or os.cpu_count() or 1
+    # a few batches per worker so the slow ones even out
+    batches = min(cases, workers * 4)
+    starts = [seed + cases * i // batches for i in range(batches + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(check_cases, starts[:-1],
+                           [b - a for a, b in zip(starts, starts[1:])],
+                           [cycles] * batches, [names] * batches)
+        return [failure for result in results for failure in result]
+
+
+def format_case(case):
+    """ Returns the layout of case in the nodes.txt format, followed by a
+        line for each port, which a layout cannot hold
+    """
+    text = []
+    for (x, y), lines in sorted(case.programs.items()):
+        text.append("[" + str(x) + "," + str(y) + "]")
+        text.extend(lines)
+        text.append("")
+    for x, y in case.stacks:
+        text.append("[" + str(x) + "," + str(y) + "] STACK")
+        text.append("")
+    for (x, y), values in case.inputs:
+        text.append("input at " + str(x) + "," + str(y) + ": " +
+                    " ".join(str(value) for value in values))
+    for (x, y), room in case.outputs:
+        text.append("output at " + str(x) + "," + str(y) + ": room for " +
+                    str(room))
+    return "\n".join(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz the engines "
+                                     "against each other")
+    parser.add_argument("--cases", type=int, default=CASES)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cycles", type=int, default=CYCLES)
+    parser.add_argument("--engines", default=None,
+                        help="comma separated, from " + ", ".join(ENGINES))
+    args = parser.parse_args()
+    names = args.engines.split(",") if args.engines else None
+    for name in names or ():
+        if (name not in ENGINES):
+            parser.error("unknown engine " + name)
+    failures = fuzz(args.cases, args.workers, args.seed, args.cycles, names)
+    for failure in failures:
+        print(failure.engine + " disagrees with " + failure.reference +
+              " after " + str(failure.case.cycles) + " cycles")
+        print("expected " + str(failure.expected))
+        print("got      " + str(failure.got))
+        print(format_case(failure.case))
+    print(str(len(failures)) + " failures in " + str(args.cases) + " cases")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
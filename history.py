@@ -0,0 +1,198 @@
+""" This file contains History, which lets a debugger step a grid
+    backwards.
+
+    Attached to a Scheduler, History records every tick as a frame
+    holding only what the tick changed, as it was before it: acc, bak, pc
+    and busy of the nodes a step changed, which the Scheduler compares
+    anyway (a runnable node's MOV state is idle before it steps), the
+    pcs, acc, MOV state and sent value of the nodes a MOV between two
+    nodes completed for, and the fingerprint() of the nodes around ANY
+    and passive nodes. Nodes that are parked or step without changing
+    cost nothing, and the fields of the MOVs are gathered with map() into
+    one tuple per field, so a frame is a handful of objects however many
+    nodes ran. Every
+    interval cycles a keyframe with the fingerprint of the whole grid is
+    kept as well, so seek() can jump near its target and only undo the
+    frames from there. Use Scheduler.snapshot() for states that outlive
+    the grid.
+
+    Frames and keyframes live in deques with a maximum length, so only the
+    last depth cycles can be gone back to and memory stays bounded however
+    long the grid runs.
+
+    Going back moves input ports back too, which only works for inputs
+    that can be gone through again (see ports.py).
+
+    Recording makes ticks about 1.4 times slower on the grid and jro
+    benchmark workloads and about 2 times on pipeline and io, where
+    every node moves a value every other tick. A Scheduler without a
+    History pays one check per tick and one per node that steps.
+
+    usage:
+        history = History(scheduler, depth=10000)
+        scheduler.run(50000)
+        history.step_back()
+        history.seek(45000)
+"""
+
+from collections import deque
+from itertools import chain
+from operator import attrgetter, itemgetter
+
+# cycles kept by default, and how often a keyframe is taken
+DEPTH = 10000
+INTERVAL = 256
+
+# what a completed MOV can change in the sender and in the reader
+SOURCE_FIELDS = [attrgetter(name) for name in ("pc", "value_to_send")]
+READER_FIELDS = [attrgetter(name) for name in ("pc", "acc",
+                                               "receiving_into_acc",
+                                               "sending")]
+READER = itemgetter(0)
+SOURCE = itemgetter(1)
+
+
+def columns(nodes, fields):
+    """ Returns a tuple per field, holding it for every node in nodes """
+    return tuple([tuple(map(field, nodes)) for field in fields])
+
+
+class History(object):
+
+    """ The last depth cycles of a Scheduler, recorded as it runs
+
+    frames holds (cycle, halted, steps, transfers, sources, readers,
+    touched, states) for every recorded tick, oldest first, where steps
+    is node, acc, bak, pc, busy one after the other for every node a step
+    changed, sources and readers the SOURCE_FIELDS and READER_FIELDS columns of
+    the two ends of its transfers, and states the fingerprints of the
+    nodes settling ANY or serving a passive node could touch, all as they
+    were before the tick
+    keyframes holds (cycle, Scheduler.fingerprint()) every interval cycles
+    """
+
+    def __init__(self, scheduler, depth=DEPTH, interval=INTERVAL):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.frames = deque(maxlen=depth)
+        self.keyframes = deque(maxlen=depth // interval + 1)
+        scheduler.history = self
+        self.reset()
+
+    def reset(self):
+        """ Forgets every recorded cycle, called by the Scheduler whenever
+            the grid changes without ticking (restore, fast forward)
+        """
+        scheduler = self.scheduler
+        self.frames.clear()
+        self.keyframes.clear()
+        self.keyframes.append((scheduler.cycle, scheduler.fingerprint()))
+
+    def oldest(self):
+        """ Returns the earliest cycle that can still be gone back to """
+        if (self.frames):
+            return self.frames[0][0]
+        return self.scheduler.cycle
+
+    def begin(self):
+        """ Takes a keyframe if one is due before the Scheduler ticks """
+        scheduler = self.scheduler
+        cycle = scheduler.cycle
+        keyframes = self.keyframes
+        if (cycle % self.interval == 0 and
+                (not keyframes or keyframes[-1][0] < cycle)):
+            keyframes.append((cycle, scheduler.fingerprint()))
+
+    def record(self, steps, transfers, anys, served):
+        """ Records the tick the Scheduler is about to commit, steps are
+            node, acc, bak, pc, busy for every node a step changed,
+            transfers its (reader, source) pairs, anys the nodes on ANY
+            and served the passive nodes being read or written, a node can
+            be recorded twice
+        """
+        scheduler = self.scheduler
+        touched = list(chain(anys, served))
+        # the neighbors ANY and passive nodes can move values to and from
+        for node in chain(anys, served):
+            touched.extend(node.priority)
+        self.frames.append((scheduler.cycle, scheduler.halted, steps,
+                            transfers,
+                            columns(list(map(SOURCE, transfers)),
+                                    SOURCE_FIELDS),
+                            columns(list(map(READER, transfers)),
+                                    READER_FIELDS),
+                            touched, [node.fingerprint() for node in touched]))
+
+    def discard(self):
+        """ Forgets the last recorded tick, which the Scheduler takes back
+            when it finds the grid halted
+        """
+        cycle = self.frames.pop()[0]
+        while (self.keyframes and self.keyframes[-1][0] > cycle):
+            self.keyframes.pop()
+
+    def undo(self, frame):
+        """ Puts the nodes a frame recorded back as they were before it
+            Returns the cycle and halted of the frame
+        """
+        (cycle, halted, steps, transfers, sources, readers, touched,
+         states) = frame
+        for node, state in zip(touched, states):
+            node.restore(state)
+        # a reader was receiving, so it had no value to send yet
+        for ((reader, source), source_pc, value, pc, acc, into_acc,
+             target) in zip(transfers, *(sources + readers)):
+            source.pc = source_pc
+            source.sending = reader
+            source.value_to_send = value
+            reader.restore((acc, reader.bak, pc, reader.last, reader.busy,
+                            None, into_acc, target, source))
+        fields = iter(steps)
+        for node, acc, bak, pc, busy in zip(*[fields] * 5):
+            node.restore((acc, bak, pc, node.last, busy,
+                          None, False, None, None))
+        return cycle, halted
+
+    def step_back(self):
+        """ Puts the grid back one cycle
+            Returns False if there is no recorded cycle left
+        """
+        if (not self.frames):
+            return False
+        self.moved(*self.undo(self.frames.pop()))
+        return True
+
+    def seek(self, cycle):
+        """ Puts the grid in the state it was in at cycle, going forward
+            means running it
+            Raises ValueError if cycle is older than oldest()
+        """
+        scheduler = self.scheduler
+        if (cycle >= scheduler.cycle):
+            scheduler.run(cycle)
+            return
+        if (cycle < self.oldest()):
+            raise ValueError("cycle " + str(cycle) + " is no longer kept, "
+                             "the oldest is " + str(self.oldest()))
+        frames = self.frames
+        for keyframe, state in self.keyframes:
+            if (cycle <= keyframe < scheduler.cycle):
+                # the frames after the keyframe are not needed to get there
+                for node, fingerprint in zip(scheduler.nodes, state):
+                    node.restore(fingerprint)
+                while (frames and frames[-1][0] >= keyframe):
+                    frames.pop()
+                break
+        halted = False
+        while (frames and frames[-1][0] >= cycle):
+            halted = self.undo(frames.pop())[1]
+        self.moved(cycle, halted)
+
+    def moved(self, cycle, halted):
+        """ Moves the Scheduler to cycle after going back """
+        scheduler = self.scheduler
+        while (self.keyframes and self.keyframes[-1][0] > cycle):
+            self.keyframes.pop()
+        scheduler.cycle = cycle
+        scheduler.halted = halted
+        scheduler.rebuild()
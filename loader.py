@@ -0,0 +1,232 @@
+""" This file contains the parsers that turn text into nodes.
+
+    Both parsers read their input line by line and yield each node as
+    soon as its block of code ends, so a file never has to be held in
+    memory as a whole.
+
+    Two formats are understood:
+        layouts (nodes.txt), where every node starts with an [x,y] header
+        TIS-100 save files, where every node starts with @N, N being the
+            node's number counting across the rows of the puzzle grid
+
+    A layout header can be followed by a node type, "[x,y] STACK" (or
+    T30) makes a stack memory node, which has no code.
+
+    Problems are reported as a ParseError carrying the file name, line
+    and column they were found at.
+"""
+
+import io
+import itertools
+import os
+import re
+import tarfile
+import zipfile
+
+from node import Node
+from stack_node import StackNode
+
+# [x,y] node headers, coordinates can be any (possibly negative) integers
+NODE_HEADER = re.compile(r"^\[\s*(-?\d+)\s*,\s*(-?\d+)\s*\]")
+
+# node types a layout header can name, a header without one is a T21
+NODE_TYPES = {"T21": Node, "STACK": StackNode, "T30": StackNode}
+
+# @N node headers of TIS-100 save files
+SAVE_HEADER = re.compile(r"^@(\d+)\s*$")
+
+# width of the compute grid in TIS-100 puzzles
+SAVE_WIDTH = 4
+
+
+class ParseError(ValueError):
+
+    """ A problem found while parsing, line and column count from 1 """
+
+    def __init__(self, message, filename="<string>", line=0, column=0):
+        ValueError.__init__(self, filename + ":" + str(line) + ":" +
+                            str(column) + ": " + message)
+        self.filename = filename
+        self.line = line
+        self.column = column
+
+
+def check_instruction(line, filename, line_num, indent):
+    """ Raises a ParseError pointing at the first bad token in line
+        labels are not checked here, Node.validate_code does that
+    """
+    tokens = line.replace(",", " ").split()
+    opcode = tokens[0]
+    expected = Node.VALID_INSTRUCTIONS.get(opcode)
+    if (expected is None):
+        raise ParseError("unknown instruction " + opcode, filename,
+                         line_num, indent + 1)
+    if (len(tokens) != expected):
+        raise ParseError(opcode + " takes " + str(expected - 1) +
+                         " arguments, got " + str(len(tokens) - 1),
+                         filename, line_num, indent + 1)
+
+
+def iter_nodes(lines, filename="<string>", strict=False):
+    """ Yields the nodes of a layout from an iterable of lines
+        (an open file works) as each node's code ends
+
+        Nodes are yielded parsed, but not linked to their neighbors
+        strict raises a ParseError on unknown instructions and wrong
+        argument counts instead of leaving the node marked invalid
+    """
+    node = None
+    for line_num, raw in enumerate(lines, 1):
+        line = raw.strip()
+        if (not line):
+            continue
+        indent = len(raw) - len(raw.lstrip())
+        # start of a new node
+        if (line.startswith("[")):
+            header = NODE_HEADER.match(line)
+            if (not header):
+                raise ParseError("bad node header " + line, filename,
+                                 line_num, indent + 1)
+            if (node is not None):
+                if (not node.passive):
+                    node.parse_lines()
+                yield node
+            kind = line[header.end():].split()
+            node_type = NODE_TYPES.get(kind[0].upper() if kind else "T21")
+            if (node_type is None or len(kind) > 1):
+                raise ParseError("bad node type " + " ".join(kind), filename,
+                                 line_num, indent + header.end() + 1)
+            node = node_type(int(header.group(1)), int(header.group(2)))
+            continue
+        if (node is None):
+            raise ParseError("code before the first [x,y] header", filename,
+                             line_num, indent + 1)
+        if (node.passive):
+            raise ParseError("stack nodes have no code", filename,
+                             line_num, indent + 1)
+        if (strict and not line.endswith(":")):
+            check_instruction(line, filename, line_num, indent)
+        node.lines.append(line)
+
+    if (node is not None):
+        if (not node.passive):
+            node.parse_lines()
+        yield node
+
+
+def save_position(number, width=SAVE_WIDTH, broken=()):
+    """ Returns the (x, y) position of node @number in a puzzle grid
+        width wide, skipping the positions in broken like the game does
+    """
+    position = 0
+    while (True):
+        x, y = position % width, position // width
+        position += 1
+        if ((x, y) in broken):
+            continue
+        if (number == 0):
+            return (x, y)
+        number -= 1
+
+
+def split_save_line(line):
+    """ Turns one line of a save file into layout lines
+        comments and breakpoints (!) are dropped and a label sharing a
+        line with an instruction is given a line of its own
+    """
+    line = line.split("#", 1)[0].strip().lstrip("!").strip()
+    if (not line):
+        return []
+    lines = []
+    if (":" in line):
+        label, line = line.split(":", 1)
+        lines.append(label.strip() + ":")
+        line = line.strip()
+    if (line):
+        # one space between tokens, which is what parse_lines expects
+        lines.append(" ".join(line.replace(",", " ").split()))
+    return lines
+
+
+def iter_save_nodes(lines, filename="<string>", width=SAVE_WIDTH,
+                    broken=(), strict=False):
+    """ Yields the nodes of a TIS-100 save file from an iterable of lines
+
+        Nodes are placed with save_position(), nodes without code are
+        skipped, and nodes are yielded parsed but not linked
+    """
+    node = None
+    for line_num, raw in enumerate(lines, 1):
+        stripped = raw.strip()
+        if (stripped.startswith("@")):
+            header = SAVE_HEADER.match(stripped)
+            if (not header):
+                raise ParseError("bad node header " + stripped, filename,
+                                 line_num, len(raw) - len(raw.lstrip()) + 1)
+            if (node is not None and node.lines):
+                node.parse_lines()
+                yield node
+            x, y = save_position(int(header.group(1)), width, broken)
+            node = Node(x, y)
+            continue
+        code = split_save_line(raw)
+        if (not code):
+            continue
+        if (node is None):
+            raise ParseError("code before the first @N header", filename,
+                             line_num, 1)
+        for line in code:
+            if (strict and not line.endswith(":")):
+                check_instruction(line, filename, line_num, 0)
+            node.lines.append(line)
+
+    if (node is not None and node.lines):
+        node.parse_lines()
+        yield node
+
+
+def iter_any_nodes(lines, filename="<string>", **kwargs):
+    """ Yields the nodes of either format, picked by the first header """
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if (line.strip()):
+            break
+    lines = itertools.chain(head, lines)
+    if (head and head[-1].strip().startswith("@")):
+        return iter_save_nodes(lines, filename, **kwargs)
+    return iter_nodes(lines, filename, strict=kwargs.get("strict", False))
+
+
+def iter_archive(path, **kwargs):
+    """ Yields (name, nodes) for every solution in path, which can be
+        a zip file, a tar file (compressed or not) or a directory
+        Solutions are read one at a time
+    """
+    if (os.path.isdir(path)):
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if (os.path.isfile(filename)):
+                with open(filename) as f:
+                    yield name, list(iter_any_nodes(f, name, **kwargs))
+    elif (zipfile.is_zipfile(path)):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if (info.is_dir()):
+                    continue
+                with archive.open(info) as member:
+                    text = io.TextIOWrapper(member, encoding="utf-8")
+                    yield info.filename, list(
+                        iter_any_nodes(text, info.filename, **kwargs))
+    elif (tarfile.is_tarfile(path)):
+        with tarfile.open(path) as archive:
+            for info in archive:
+                if (not info.isfile()):
+                    continue
+                member = archive.extractfile(info)
+                text = io.TextIOWrapper(member, encoding="utf-8")
+                yield info.name, list(iter_any_nodes(text, info.name,
+                                                     **kwargs))
+    else:
+        raise ParseError("not an archive or directory", path)
@@ -1,83 +1,200 @@
+import argparse
+import json
+
 from node import Node
+from loader import iter_nodes
+from ports import InputPort, OutputPort, read_text
+from scheduler import Scheduler
+import tracing
+from visualizer import Visualizer
 from colorama import init, Fore, Back, Style
 init()
 
 COLUMNS = 3
 ROWS = 3
 
+# direction -> (dx, dy) of the neighbor in that direction
+DIRECTIONS = {"LEFT": (-1, 0), "RIGHT": (1, 0), "UP": (0, -1), "DOWN": (0, 1)}
+
+# the side of a neighbor that faces back
+OPPOSITE = {"LEFT": "RIGHT", "RIGHT": "LEFT", "UP": "DOWN", "DOWN": "UP"}
+
 
 def load_nodes(filename):
-    """ Loads a set of nodes in from filename """
+    """ Loads a set of nodes in from filename
+        see loader.iter_nodes for the format, the file is read a line at a
+        time rather than all at once
+    """
     with open(filename) as f:
-        content = f.readlines()
-    # remove whitespace
-    content = [x.strip() for x in content]
+        return list(iter_nodes(f, filename))
 
-    nodes = []
-    node_count = -1
-
-    for line in content:
-        # start of a new node
-        if line.startswith("["):
-            temp = line.replace(" ", "")
-            nodes.append(Node(int(temp[1]), int(temp[3])))
-            node_count += 1
-        # not whitespace
-        elif line:
-            nodes[node_count].lines.append(line)
 
+def index_nodes(nodes):
+    """ Returns a dict of (x, y) -> node for every node in nodes """
+    index = dict()
     for node in nodes:
-        node.parse_lines()
-        print("Labels: ", node.labels)
-
-    return nodes
+        position = (node.xpos, node.ypos)
+        if (position in index):
+            raise ValueError("two nodes at " + str(position))
+        index[position] = node
+    return index
 
 
 def build_io_tables(nodes):
     """ Assigns the LEFT, UP, DOWN, RIGHT values of each node's
     IO hash tables to the corresponding node objects.
 
-    Strategy: Iterate through every node in the list
-        for each node: iterate through every node in the list looking for
+    Strategy: Index every node by its (x, y) position
+        for each node: look up the positions
         xpos-1 = LEFT, xpos+1 = RIGHT, ypos-1 = UP, ypos+1 = DOWN
-        The other position must remain unchanged, nodes without a matching
+        in the index, nodes without a matching
         adjencency will receive a NULL value for the node position
+    This is linear in the number of nodes.
+    Every node also works out its neighbors in priority order, which
+    is the order ANY tries them in and stack nodes serve them in.
+    Returns the position index
     """
-    for current_assignment in nodes:
-        for checking in nodes:
-            if (checking.xpos == (current_assignment.xpos - 1) and checking.ypos == current_assignment.ypos):
-                current_assignment.adjacency["LEFT"] = checking
-            elif (checking.xpos == (current_assignment.xpos + 1) and checking.ypos == current_assignment.ypos):
-                current_assignment.adjacency["RIGHT"] = checking
-            elif (checking.ypos == (current_assignment.ypos - 1) and checking.xpos == current_assignment.xpos):
-                current_assignment.adjacency["UP"] = checking
-            elif (checking.ypos == (current_assignment.ypos + 1) and checking.xpos == current_assignment.xpos):
-                current_assignment.adjacency["DOWN"] = checking
+    index = index_nodes(nodes)
+    for node in nodes:
+        # DIRECTIONS is in port code order, see node.PORTS
+        node.neighbors = tuple(index.get((node.xpos + dx, node.ypos + dy))
+                               for dx, dy in DIRECTIONS.values())
+        node.build_priority()
+    return index
 
 
-def update_output_table(nodes, pipes):
+def make_grid(programs):
+    """ Builds, parses and links a grid from a {(x, y): lines} dict,
+        the nodes come back in position order
     """
-    Iterates through every node and updates """
+    nodes = []
+    for (x, y), lines in sorted(programs.items()):
+        node = Node(x, y)
+        node.lines = list(lines)
+        node.parse_lines()
+        nodes.append(node)
+    build_io_tables(nodes)
+    return nodes
 
 
-def simulate_next_frame(nodes, frame_counter):
+def update_output_table(nodes, pipes):
+    """
+    Iterates through every pipe (an input or output port, see ports.py)
+    and links it with the node next to it, both ways, call this after
+    build_io_tables().
+    A pipe must be next to exactly one node and not on top of one,
+    otherwise a ValueError is raised.
+    Returns the position index of the nodes
+    """
+    index = index_nodes(nodes)
+    for pipe in pipes:
+        if ((pipe.xpos, pipe.ypos) in index):
+            raise ValueError("pipe on top of node at " + str(pipe.xpos) +
+                             "," + str(pipe.ypos))
+        linked = 0
+        for direction, (dx, dy) in DIRECTIONS.items():
+            node = index.get((pipe.xpos + dx, pipe.ypos + dy))
+            pipe.adjacency[direction] = node
+            if (node is not None):
+                node.adjacency[OPPOSITE[direction]] = pipe
+                linked += 1
+        if (linked != 1):
+            raise ValueError("pipe at " + str(pipe.xpos) + "," +
+                             str(pipe.ypos) + " is next to " + str(linked) +
+                             " nodes")
+    return index
+
+
+def simulate_next_frame(scheduler, frame_counter):
     print(Fore.LIGHTBLUE_EX + "*starting frame ", frame_counter)
     print(Style.RESET_ALL, end='')
-    for node in nodes:
-        node.execute_next()
+    scheduler.tick()
+    for node in scheduler.nodes:
         print(Fore.LIGHTRED_EX + str(node))
         print(Style.RESET_ALL, end='')
 
 
-def simulate():
-    nodes = load_nodes("nodes.txt")
+def simulate(full_debug=False, filename="nodes.txt", frames=10):
+    nodes = load_nodes(filename)
     #nodes = [Node(x, y) for x in range(COLUMNS) for y in range(ROWS)]
 
     build_io_tables(nodes)
-
-    for i in range(10):
-        simulate_next_frame(nodes, i)
+    tracer = tracing.full_debug() if full_debug else None
+    scheduler = Scheduler(nodes, tracer)
+
+    for i in range(frames):
+        simulate_next_frame(scheduler, i)
+
+
+def run_headless(filename, max_cycles, inputs=(), outputs=(),
+                 stop_after=None, fast_forward=False, watch=False):
+    """ Runs the layout in filename without printing anything
+    inputs is a list of (x, y, path), a text file of values fed in by an
+        input port at (x, y)
+    outputs is a list of (x, y, path), a binary file the output port at
+        (x, y) appends its values to
+    stop_after stops the run once that many values have been output
+    watch draws the grid live with a Visualizer on its own thread
+    Returns the Scheduler's RunResult
+    """
+    nodes = load_nodes(filename)
+    build_io_tables(nodes)
+    output_ports = [OutputPort(x, y, file=path) for x, y, path in outputs]
+    pipes = [InputPort(x, y, read_text(path)) for x, y, path in inputs]
+    pipes += output_ports
+    update_output_table(nodes, pipes)
+    scheduler = Scheduler(nodes + pipes)
+    view = None
+    if (watch):
+        view = Visualizer(scheduler.nodes)
+        view.start()
+    try:
+        return scheduler.run_until(max_cycles, stop_after,
+                                   view.capture if view else None,
+                                   fast_forward)
+    finally:
+        if (view is not None):
+            view.stop(scheduler)
+        for port in output_ports:
+            port.close()
+
+
+def port_argument(text):
+    """ Parses an X,Y,PATH command line argument """
+    x, y, path = text.split(",", 2)
+    return (int(x), int(y), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a layout")
+    parser.add_argument("layout", nargs="?", default="nodes.txt")
+    parser.add_argument("--headless", action="store_true",
+                        help="print only the result at the end")
+    parser.add_argument("--cycles", type=int, default=None,
+                        help="cycles to run (10 frames when not headless)")
+    parser.add_argument("--input", type=port_argument, action="append",
+                        default=[], metavar="X,Y,PATH")
+    parser.add_argument("--output", type=port_argument, action="append",
+                        default=[], metavar="X,Y,PATH")
+    parser.add_argument("--stop-after", type=int, default=None,
+                        help="stop after this many output values")
+    parser.add_argument("--fast-forward", action="store_true")
+    parser.add_argument("--watch", action="store_true",
+                        help="draw the grid live while running headless")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    if (not args.headless):
+        simulate(args.debug, args.layout, args.cycles or 10)
+        return
+    result = run_headless(args.layout, args.cycles or 1000000, args.input,
+                          args.output, args.stop_after, args.fast_forward,
+                          args.watch)
+    summary = result._asdict()
+    summary["state"] = dict(("%d,%d" % position, list(registers))
+                            for position, registers in result.state.items())
+    print(json.dumps(summary, indent=2))
 
 
 if __name__ == "__main__":
-    simulate()
+    main()
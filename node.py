@@ -1,28 +1,361 @@
 """ This file contains all of the implementation for
     the Node object. I/O can be handled as an input/output
     hash table that is built for each of the surrounding nodes.
-    The main program will operate by calling all of the I/O functions
-    sequentially (possibly twice over).
+    Nodes only ever change their own state when stepping, moving
+    values between nodes is left to the Scheduler (see scheduler.py).
+
+    Nodes are kept small, as hundreds of thousands of them can be held at
+    once: Node uses __slots__, neighbors are a 4-tuple indexed by port
+    code, and everything parsed from a node's lines lives in a Program
+    that is shared by every node with the same lines. A Program stores
+    its instructions as small integer codes in an array, code and
+    adjacency are still there as views for code that wants the old dicts.
 """
 
-# TODO: currently the nodes are executed sequentially, which causes IO
-# problems due to IO revolving around receiving something. May need 2-pass
-# for MOV instructs in simulate next frame.
+import sys
+import weakref
+from array import array
+from types import MappingProxyType
+
+# opcodes and registers, in the order of their small integer codes
+# the ports come first so that a port's code indexes neighbors
+OPCODES = ("NOP", "MOV", "SWP", "SAV", "ADD", "SUB", "NEG", "JMP", "JEZ",
+           "JNZ", "JGZ", "JLZ", "JRO")
+REGISTERS = ("LEFT", "RIGHT", "UP", "DOWN", "ACC", "NIL", "ANY", "LAST")
+PORTS = REGISTERS[:4]
+LEFT, RIGHT, UP, DOWN, ACC, NIL, ANY, LAST = range(len(REGISTERS))
+OPCODE_CODES = dict((name, code) for code, name in enumerate(OPCODES))
+REGISTER_CODES = dict((name, code) for code, name in enumerate(REGISTERS))
+PORT_CODES = dict((name, code) for code, name in enumerate(PORTS))
+# the port codes in the order a write to ANY tries them in
+WRITE_ORDER = (UP, LEFT, RIGHT, DOWN)
+ADD_CODE = OPCODE_CODES["ADD"]
+SUB_CODE = OPCODE_CODES["SUB"]
+JRO_CODE = OPCODE_CODES["JRO"]
+MOV_CODE = OPCODE_CODES["MOV"]
+
+# a program's code table has WIDTH slots per line: the opcode, then the
+# kind and value of each operand
+# a line without code has NO_CODE as its opcode, an unknown opcode is
+# stored as -2 - (its index in names)
+WIDTH = 5
+# array typecode of the code and pc tables, 32 bits holds every code,
+# literal and line number
+TABLE_TYPE = "i"
+NO_CODE = -1
+# operand kinds, a NAME's value is its index in names
+EMPTY, NUMBER, REGISTER, NAME = range(4)
+# literals go from -MAX_LITERAL to MAX_LITERAL, as in TIS-100
+MAX_LITERAL = 999
+
+NO_NEIGHBORS = (None, None, None, None)
+
+# what save_state() stores for no node and for a node's priority tuple
+NO_NODE = -1
+ANY_NODES = -2
+
+# lines -> Program, so nodes running the same code share one
+PROGRAMS = weakref.WeakValueDictionary()
+
+# (handler, args, advance) -> that same compiled entry, so programs share
+# their entries, there are only so many as literals stay in MAX_LITERAL
+ENTRIES = dict()
+
+# shape of a run -> function making its fused block from its immediates,
+# a shape is the run's (opcode, operand) pairs with every number replaced
+# by NUMBER, so it does not grow with the values programs use
+BLOCK_MAKERS = dict()
+
+# how each local-only instruction changes acc and bak in a fused block
+BLOCK_STATEMENTS = {"ADD": "acc += {0}", "SUB": "acc -= {0}",
+                    "NEG": "acc = -acc", "SAV": "bak = acc",
+                    "SWP": "acc = bak", "NOP": "pass"}
+
+
+def block_maker(shape):
+    """ Returns the function that takes the immediates of a run of the
+        given shape, in order, and returns its fused block function
+    """
+    maker = BLOCK_MAKERS.get(shape)
+    if (maker is not None):
+        return maker
+    names = []
+    statements = []
+    for opcode, operand in shape:
+        if (operand == NUMBER):
+            operand = "k" + str(len(names))
+            names.append(operand)
+        elif (operand == "ACC"):
+            operand = "acc"
+        elif (operand == "NIL"):
+            operand = 0
+        statements.append(BLOCK_STATEMENTS[opcode].format(operand))
+    source = "def make(" + ", ".join(names) + "):\n" \
+        "    def block(node):\n" \
+        "        acc = node.acc\n        bak = node.bak\n" + \
+        "".join("        " + statement + "\n" for statement in statements) + \
+        "        node.acc = acc\n        node.bak = bak\n" \
+        "    return block\n"
+    namespace = dict()
+    exec(compile(source, "<block>", "exec"), namespace)
+    maker = BLOCK_MAKERS[shape] = namespace["make"]
+    return maker
+
+
+def reference(neighbor, index):
+    """ Returns the number save_state() stores for a node reference:
+        its position in index, NO_NODE for None or ANY_NODES for the
+        priority tuple of a MOV on ANY that has not settled
+    """
+    if (neighbor is None):
+        return NO_NODE
+    if (type(neighbor) is tuple):
+        return ANY_NODES
+    return index[neighbor]
+
+
+def dereference(number, nodes, priority):
+    """ Turns a number from reference() back into a node reference """
+    if (number == NO_NODE):
+        return None
+    if (number == ANY_NODES):
+        return priority
+    return nodes[number]
+
+
+def encode_operand(arg, names):
+    """ Returns the (kind, value) slots for a parsed operand """
+    if (arg is None):
+        return (EMPTY, 0)
+    if (type(arg) == int):
+        return (NUMBER, arg)
+    if (arg in REGISTER_CODES):
+        return (REGISTER, REGISTER_CODES[arg])
+    if (arg not in names):
+        names.append(arg)
+    return (NAME, names.index(arg))
+
+
+def decode_operand(kind, value, names):
+    """ Turns (kind, value) slots back into the parsed operand """
+    if (kind == EMPTY):
+        return None
+    if (kind == NUMBER):
+        return value
+    if (kind == REGISTER):
+        return REGISTERS[value]
+    return names[value]
+
+
+class Ports(object):
+
+    """ A dict-like view of a node's neighbors keyed by "LEFT", "RIGHT",
+    "UP" and "DOWN", which is what node.adjacency used to be
+    Setting a neighbor through the view rebuilds the node's priority
+    """
 
+    __slots__ = ("node",)
 
-class Node(object):
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, direction):
+        return self.node.neighbors[PORT_CODES[direction]]
+
+    def __setitem__(self, direction, neighbor):
+        code = PORT_CODES[direction]
+        neighbors = self.node.neighbors
+        self.node.neighbors = neighbors[:code] + (neighbor,) + \
+            neighbors[code + 1:]
+        self.node.build_priority()
+
+    def __contains__(self, direction):
+        return direction in PORT_CODES
+
+    def __iter__(self):
+        return iter(PORTS)
+
+    def keys(self):
+        return PORTS
+
+    def values(self):
+        return self.node.neighbors
+
+    def items(self):
+        return zip(PORTS, self.node.neighbors)
+
+
+class Linked(object):
+
+    """ Anything on the grid, linked to up to four neighbors
+
+    neighbors is a tuple in port code order (LEFT, RIGHT, UP, DOWN)
+    priority holds the neighbors that are there in that same order, see
+    build_priority(), write_priority holds them in the order ANY writes go
+    """
+
+    __slots__ = ()
+
+    adjacency = property(Ports)
+
+    def build_priority(self):
+        """ Orders the neighbors LEFT, RIGHT, UP, DOWN, the fixed order
+            reads from ANY try them in and passive nodes serve them in,
+            and UP, LEFT, RIGHT, DOWN, the order writes to ANY try them
+            in, so neither has to look at the empty sides
+        """
+        self.priority = tuple(neighbor for neighbor in self.neighbors
+                              if neighbor is not None)
+        self.write_priority = tuple(self.neighbors[code]
+                                    for code in WRITE_ORDER
+                                    if self.neighbors[code] is not None)
+        if (self.write_priority == self.priority):
+            # only UP with LEFT or RIGHT tells the two apart
+            self.write_priority = self.priority
+
+
+class Passive(Linked):
+
+    """ A node the Scheduler serves instead of stepping, like stack nodes
+    and I/O ports, it holds no code
+    """
+
+    passive = True
+
+    lines = ()
+    # read-only, as every passive node shares it
+    code = MappingProxyType({})
+    compiled = ()
+    is_valid = True
+
+    __slots__ = ("trace", "xpos", "ypos", "neighbors", "priority",
+                 "write_priority")
+
+    def __init__(self, xpos, ypos):
+        self.trace = None
+        self.xpos = xpos
+        self.ypos = ypos
+        self.neighbors = NO_NEIGHBORS
+        self.priority = ()
+        self.write_priority = ()
+
+
+class Program(object):
+
+    """ Everything parse_lines() works out from a node's lines
+
+    table is the code table, see WIDTH
+    names holds the labels and unknown words the code uses
+    next_pc, jro_table and jro_index are the pc tables, see
+        Node.build_pc_tables(), jump_targets is worked out from them when
+        asked for
+    compiled is the (handler, args, advance) entry of every line,
+        handlers are Node methods called with the node first
+    blocks is built by Node.build_blocks(), None until then
+    """
+
+    __slots__ = ("lines", "table", "names", "labels", "is_valid", "next_pc",
+                 "jro_table", "jro_index", "compiled", "blocks",
+                 "__weakref__")
+
+    def __init__(self, lines=()):
+        # shared by every node running the program, so it is a tuple
+        self.lines = tuple(lines)
+        self.table = array(TABLE_TYPE, [NO_CODE, 0, 0, 0, 0]) * len(lines)
+        self.names = list()
+        self.labels = dict()
+        self.is_valid = True
+        self.next_pc = array(TABLE_TYPE)
+        self.jro_table = array(TABLE_TYPE)
+        self.jro_index = array(TABLE_TYPE)
+        self.compiled = ()
+        self.blocks = None
+
+    def jump_target(self, label):
+        """ Returns the line a jump to label lands on, None for no label """
+        line_num = self.labels.get(label)
+        if (line_num is None or self.table[line_num * WIDTH] != NO_CODE):
+            return line_num
+        return self.next_pc[line_num]
+
+    @property
+    def jump_targets(self):
+        """ {label: line a jump to it lands on} """
+        return dict((label, self.jump_target(label)) for label in self.labels)
+
+    def index_jro(self):
+        """ Works out jro_index from jro_table, so only the table has to
+            be stored
+        """
+        self.jro_index = array(TABLE_TYPE, [0]) * len(self.lines)
+        for position in range(1, len(self.jro_table) - 1):
+            self.jro_index[self.jro_table[position]] = position
+
+    def store(self, line_num, instruction):
+        """ Encodes the parsed instruction of line_num into table """
+        opcode, arg1, arg2 = instruction
+        if (opcode in OPCODE_CODES):
+            opcode = OPCODE_CODES[opcode]
+        else:
+            opcode = -2 - encode_operand(opcode, self.names)[1]
+        at = line_num * WIDTH
+        self.table[at] = opcode
+        self.table[at + 1], self.table[at + 2] = \
+            encode_operand(arg1, self.names)
+        self.table[at + 3], self.table[at + 4] = \
+            encode_operand(arg2, self.names)
+
+    def opcode(self, line_num):
+        """ Returns the opcode of line_num as text, None for no code """
+        opcode = self.table[line_num * WIDTH]
+        if (opcode == NO_CODE):
+            return None
+        if (opcode < 0):
+            return self.names[-2 - opcode]
+        return OPCODES[opcode]
+
+    def instruction(self, line_num):
+        """ Returns the parsed (opcode, arg1, arg2) of line_num """
+        at = line_num * WIDTH
+        table = self.table
+        return (self.opcode(line_num),
+                decode_operand(table[at + 1], table[at + 2], self.names),
+                decode_operand(table[at + 3], table[at + 4], self.names))
+
+    def code(self):
+        """ Returns {line number: (opcode, arg1, arg2)} for every line
+            holding code
+        """
+        return dict((line_num, self.instruction(line_num))
+                    for line_num in range(len(self.lines))
+                    if self.table[line_num * WIDTH] != NO_CODE)
+
+
+# what a node runs before it has parsed any lines
+EMPTY_PROGRAM = Program()
+
+
+class Node(Linked):
 
     """ The node object represents the squares containing code
-    Each node has a list of lines of code as a list of strings
-    A call stack, that is the parsed form of those lines
+    Each node has a list of lines of code as a list of strings, which
+    parse_lines() swaps for the tuple shared by every node with that code
+    A program, that is the parsed form of those lines
     An accumulator value, a bak value, a Last value
-    A state value, and an idle percentage value
+    A state value, and an idle percentage value (see profiler.py)
 
-    Input is handled by a list of 4 values representing
-    the input in clockwise fashion (0 being up, 3 being left)
+    Input is handled by a tuple of 4 neighbors, in the order of the
+    port codes (LEFT, RIGHT, UP, DOWN)
     output is handled in the same fashion
+    priority holds the neighbors that are there in that same order, it is
+    the order MOV from ANY tries them in, write_priority is the UP, LEFT,
+    RIGHT, DOWN order MOV to ANY tries them in, see build_priority()
 
-    code contains a dict of tuples representing instructions parsed from lines
+    last is the neighbor the last ANY read or write went to, which is
+    where LAST points, None until then
+
+    code is a dict of tuples representing instructions parsed from lines,
+    decoded from the program's code table every time it is read
         each code is a 3-tuple containing three 'arguments'
         The first argument is the opcode, representing which operation to execute
         The next two arguments are used for registers or immediates to the opcode
@@ -43,9 +376,22 @@ class Node(object):
     VALID_REGISTERS = ["ACC", "NIL", "LEFT",
                        "RIGHT", "UP", "DOWN", "ANY", "LAST"]
 
+    # the Program fields get_program() returns
+    PROGRAM_FIELDS = ("lines", "table", "names", "labels", "is_valid",
+                      "next_pc", "jro_table")
+
+    # nodes the Scheduler serves instead of stepping, see stack_node.py
+    passive = False
+
+    __slots__ = ("trace", "xpos", "ypos", "acc", "bak", "last", "mode",
+                 "lines", "program", "compiled", "next_pc", "blocks", "busy",
+                 "neighbors", "priority", "write_priority", "pc", "sending",
+                 "receiving", "receiving_into_acc", "value_to_send")
+
     # TODO: Create a static enum for modes
     def __init__(self, xpos, ypos):
-        self.full_debug = False
+        # Tracer this node reports to, None when tracing is off
+        self.trace = None
 
         self.xpos = xpos
         self.ypos = ypos
@@ -54,17 +400,24 @@ class Node(object):
         self.last = None
         self.mode = None
         self.lines = list()
-        self.code = dict()
-        self.call_stack = list()
-        self.labels = dict()
-        self.is_valid = True
-        self.adjacency = {"LEFT": None,
-                          "RIGHT": None, "UP": None, "DOWN": None}
+        # compiled and next_pc are the program's, kept on the node so the
+        # hot path reads them in one step
+        self.program = EMPTY_PROGRAM
+        self.compiled = EMPTY_PROGRAM.compiled
+        self.next_pc = EMPTY_PROGRAM.next_pc
+        # basic blocks, see build_blocks(), empty unless fusion is enabled
+        self.blocks = ()
+        self.busy = 0  # cycles left to charge for the last fused block
+        self.neighbors = NO_NEIGHBORS
+        self.priority = ()
+        self.write_priority = ()
 
         self.pc = 0  # program counter
 
         # sending/receiving point to a Node that we are sending/receiving to/from
         # if either is None, we are not sending or receiving from anyone
+        # while a MOV on ANY waits, it is the priority tuple instead, until
+        # the Scheduler settles it with settle_any()
         self.sending = None
         self.receiving = None
 
@@ -72,6 +425,21 @@ class Node(object):
         self.value_to_send = None
         # print("Created Node at ", xpos, ypos)
 
+    # views of the program and neighbors, for reading rather than running
+    code = property(lambda self: self.program.code())
+    labels = property(lambda self: self.program.labels)
+    jump_targets = property(lambda self: self.program.jump_targets)
+    jro_table = property(lambda self: self.program.jro_table)
+    jro_index = property(lambda self: self.program.jro_index)
+
+    @property
+    def is_valid(self):
+        return self.program.is_valid
+
+    @is_valid.setter
+    def is_valid(self, is_valid):
+        self.program.is_valid = is_valid
+
     def validate_code(self):
         """ Validates that instructions are
         syntactically correct
@@ -93,10 +461,11 @@ class Node(object):
 
             # invalid if any argcount is not correct
             if (Node.VALID_INSTRUCTIONS.get(opcode, -1) != instruct_len):
-                print("length mismatch!", opcode)
+                print("length mismatch!", opcode, file=sys.stderr)
                 print("length ", instruct_len, " expected ",
-                      Node.VALID_INSTRUCTIONS.get(opcode, -1))
-                print(instruction)
+                      Node.VALID_INSTRUCTIONS.get(opcode, -1),
+                      file=sys.stderr)
+                print(instruction, file=sys.stderr)
                 self.is_valid = False
                 return
             # ADD/SUB needs a register or a number, as does JRO
@@ -114,26 +483,34 @@ class Node(object):
             # J needs a label
             elif (opcode.startswith("J")):
                 if (args[1] not in self.labels.keys()):
-                    print('label ', args[1], ' not in labels dict')
+                    print('label ', args[1], ' not in labels dict',
+                          file=sys.stderr)
                     self.is_valid = False
                     return
 
     def parse_lines(self):
-        """ Parses the string lines to be
-            placed onto the call stack
+        """ Parses the string lines into a Program, shared with every
+            other node that has the same lines
             note: doesn't support multiple spaces yet
         """
+        lines = tuple(self.lines)
+        program = PROGRAMS.get(lines)
+        if (program is not None):
+            self.use_program(program)
+            return
+        program = Program(lines)
+        self.use_program(program)
         # iterate through every string of code
-        for line_num, line in enumerate(self.lines):
+        for line_num, line in enumerate(lines):
             # This is a label on a line by itself
             if (line.strip().endswith(':')):
                 stripped = line.strip().replace(':', '')
                 # If we redefine a label, this is invalid code
-                if (self.labels.get(stripped, False)):
+                if (program.labels.get(stripped, False)):
                     self.is_valid = False
                     return
                 # Otherwise, save the label, line_num pair in labels dict
-                self.labels[stripped] = line_num
+                program.labels[stripped] = line_num
                 continue
 
             instruction = tuple()
@@ -148,265 +525,513 @@ class Node(object):
                 else:
                     # Add the arg, make it numeric if possible
                     try:
-                        instruction += (int(args[i]),)
+                        value = int(args[i])
                     except ValueError:
-                        instruction += (args[i],)
-            self.code[line_num] = instruction
+                        value = args[i]
+                    # a literal out of range is kept as a word, which
+                    # makes the line invalid
+                    if (type(value) == int and
+                            not -MAX_LITERAL <= value <= MAX_LITERAL):
+                        value = args[i]
+                    instruction += (value,)
+            program.store(line_num, instruction)
+        # nothing is added once parsed, and most programs have no names
+        program.names = tuple(program.names)
         self.validate_code()
-    
-    def correct_pc_bounds(self):
-        """ corrects out-of-bounds program counters
-        going under 0 sets to 0 and going over length sets to length
-        """
-        if (self.pc >= len(self.lines)):
-            self.pc = len(self.lines) - 1
-        
-        if (self.pc < 0):
-            self.pc = 0
-
-    def increment_pc(self):
-        """ Updates the pc according to the current status of
-            the pc and the number of lines of code we have
-        """
-        # Increase if we have some code
-        if (self.code):
-            self.pc += 1
-        # If our current line number is >= max line nums, reset pc
-        if (self.pc >= len(self.lines)):
-            self.pc = 0
-
-    def skip_labels(self):
-        """ increments the pc along until we find the next line of
-            code that does not consist solely of a label
-
-            if the current line of code has code (is not a label),
-            then we do nothing
-
-            if we do not find a valid line, do not change the pc
-        """
-        length = len(self.lines)
-        checked = 0
-        # keep incrementing the pc until we find a line that is not a label
-        while (self.code.get(self.pc, False) == False) and (checked < length):
-            checked += 1
-            self.increment_pc()
-    
-    def move_pc_and_skip_labels(self, move_amount):
-        """ changes the pc by move_amount and skips over any labels we find
-        """
-        # move the pc and keep track of the delta in total_moved
-        # when the delta matches the target delta we're done
-        total_moved = 0
-        is_pos = move_amount > 0
-        while total_moved != move_amount:
-            if is_pos:
-                self.pc += 1
-                total_moved += 1
-                # check if we went over bounds
-                if (self.pc > len(self.lines)):
-                    self.pc = len(self.lines) - 1
-                    return
-                # move the target move amount up if this is label
-                if (self.code.get(self.pc, False) == False):
-                    move_amount += 1
-            else:
-                self.pc -= 1
-                total_moved -= 1
-                # check if we went under bounds
-                if (self.pc < 0):
-                    self.pc = 0
-                    return
-                # move the target move amount down if this is a label
-                if (self.code.get(self.pc, False) == False):
-                    move_amount -= 1
-            
+        self.build_pc_tables()
+        self.compile_code()
+        PROGRAMS[lines] = program
 
-    def send_value(self):
-        """ Sends a value from the self node to the sending node
-            This is only called by the receiving node!
-            Return value_to_send if successful
-            Return None if the node we send to is not receiving from us
-        """
-        print("In send_value() for ", str(self))
-        print("We want to send to ", str(self.sending))
-        # check if the node we are sending to is receiving from us
-        if ((self.sending.receiving == self) and (self.value_to_send)):
-            self.increment_pc()  # we are done after any send
-            self.skip_labels()
-            return self.value_to_send
-        else:
-            if (not self.sending.receiving == self):
-                print("The node we're sending to is not receiving us!")
-            else:
-                print("We don't have a value to send!")
-            return None
+    def use_program(self, program):
+        """ Points this node at program """
+        self.program = program
+        self.lines = program.lines
+        self.compiled = program.compiled
+        self.next_pc = program.next_pc
+        self.blocks = ()
 
-    def receive_value(self):
-        """ Receives a value from node receiving into register reg
-            If the other node is not sending, return False
-                Otherwise receive the value and return True
-
-            Idea: a node loops on a mov until it is succesful
-                upon success, increment the pc
-        """
-        print("In receive_value() for ", str(self))
-        print("We want to receive from ", str(self.receiving))
-        # have to check if the node we receive from is sending to us
-        if (self.receiving.sending == self):
-            # get the value from the other node
-            value = self.receiving.send_value()
-            print("got ", value, " from our receiving node")
-
-            if (not value):  # The node is sending but does not have its value ready yet
-                return False
-
-            # The node we received from is now no longer sending to anyone
-            self.receiving.sending = None
-            self.receiving.value_to_send = None
-
-            # This node is no longer receiving from anyone
-            self.receiving = None
-
-            # assign the value to the correct register
-            if (self.receiving_into_acc):
-                # we are sending this value to our acc
-                self.acc = value
-                self.receiving_into_acc = False
-                # if we receive into the acc, we are done and can move the pc
-                # up
-                self.increment_pc()
-                self.skip_labels()
-            else:
-                # We are sending this value to another node
-                self.value_to_send = value
-                # TODO: add in the rest of the registers
-            return True
-        else:
-            # the other node is not sending to us
-            print("Our node we want to receive from is not sending to us!")
-            return False
+    def build_pc_tables(self):
+        """ Precomputes every pc movement so that no label skipping
+            happens while executing
 
-    def execute_next(self):
-        """ Executes the next instruction
-            that the program counter points to
+            next_pc[line] is the next line holding code after line,
+                wrapping around to the top of the node
+            jro_table holds every line of code in order, with the clamped
+                targets for jumping under (line 0) and over (the last line)
+                the code at either end
+            jro_index[line] is the position of the code on line in jro_table
+            all three are arrays, see TABLE_TYPE
         """
-        if (self.full_debug):
-            print("Entering execute_next() for node ", self)
-
-        if (self.receiving):
-            self.receive_value()
-            # If we succesfully receive, we want to increment the PC, but only
-            # if we are not sending
-            if (not self.receiving):
-                # if (not self.sending):
-                #    print("Succesfully completed a MOV onto ", self)
-                #    self.increment_pc()
-                return
+        program = self.program
+        length = len(program.lines)
+        code_lines = [line_num for line_num in range(length)
+                      if program.table[line_num * WIDTH] != NO_CODE]
 
-        if (self.receiving or self.sending):
-            if (self.receiving):
-                print("Currently receiving in execute_next(), now returning")
-            if (self.sending):
-                print("Currently sending in execute_next(), now returning")
-            return
-        # if (self.receiving or self.sending):
-        # return  # we don't do anything if IO is happening TODO: but we
-        # should, right?
-
-        instruction = self.code.get(self.pc, False)
-        # print(instruction)
-        if (instruction == False):
-            # If we have some code, then this is a label and we need to increment pc
-            # if timing is in error, call execute_next() again here
-            self.increment_pc()
-            self.skip_labels()
-            return
+        program.next_pc = array(TABLE_TYPE, range(length))
+        if (code_lines):
+            # walk backwards so every line knows the first code line after it
+            following = code_lines[0]
+            for line_num in reversed(range(length)):
+                program.next_pc[line_num] = following
+                if (program.table[line_num * WIDTH] != NO_CODE):
+                    following = line_num
+        self.next_pc = program.next_pc
+
+        program.jro_table = array(TABLE_TYPE,
+                                  [0] + code_lines + [length - 1])
+        program.index_jro()
+
+    def jro_target(self, line_num, offset):
+        """ Looks up where a JRO by offset from line_num lands """
+        program = self.program
+        index = program.jro_index[line_num] + offset
+        if (index < 0):
+            index = 0
+        elif (index >= len(program.jro_table)):
+            index = len(program.jro_table) - 1
+        return program.jro_table[index]
 
-        # grab the next instruction
-        opcode = instruction[0]
+    def get_program(self):
+        """ Returns the parsed and validated program as a tuple of
+            plain values, which set_program() can load into another node
+        """
+        return tuple(getattr(self.program, field)
+                     for field in Node.PROGRAM_FIELDS)
+
+    def set_program(self, fields):
+        """ Loads a program from get_program() without parsing it again """
+        lines = tuple(fields[0])
+        program = PROGRAMS.get(lines)
+        if (program is None):
+            program = Program(fields[0])
+            for field, value in zip(Node.PROGRAM_FIELDS[1:], fields[1:]):
+                setattr(program, field, value)
+            program.index_jro()
+            self.use_program(program)
+            # parse_lines() stops at a redefined label before building the
+            # pc tables, such a program is left without compiled code too
+            if (len(program.next_pc) == len(program.lines)):
+                self.compile_code()
+            PROGRAMS[lines] = program
+        self.use_program(program)
+
+    def compile_code(self):
+        """ Resolves every parsed instruction into a
+            (handler, args, advance) entry indexed by line number so that
+            execute_next only has to do one lookup and one call per cycle
 
-        # print(instruction)
+            handlers are unbound, so the entries can be shared by every node
+            running the program, and by every program, see ENTRIES
+            label-only lines get None
+            advance is True when the pc moves to the next line afterwards,
+            jumps and MOV manage the pc themselves
+        """
+        program = self.program
+        compiled = [None] * len(program.lines)
+        for line_num, instruction in self.code.items():
+            entry = self.compile_instruction(line_num, instruction)
+            compiled[line_num] = ENTRIES.setdefault(entry, entry)
+        program.compiled = tuple(compiled)
+        self.compiled = program.compiled
+
+    def compile_instruction(self, line_num, instruction):
+        """ Decodes the operands of the instruction on line_num once and
+            returns its (handler, args, advance) entry
+        """
+        opcode, arg1, arg2 = instruction
 
-        # Ties opcodes to functions
-        if (opcode == "ADD"):
-            self.add(instruction[1])
-        elif (opcode == "SUB"):
-            self.sub(instruction[1])
+        if ((opcode == "ADD" or opcode == "SUB" or opcode == "JRO") and
+                (arg1 in PORT_CODES or arg1 == "ANY" or arg1 == "LAST")):
+            # the operand is read from a port, receive_value() finishes
+            # the instruction once the value arrives
+            return (Node.read, (REGISTER_CODES[arg1],), False)
+        if (opcode == "ADD" or opcode == "SUB"):
+            # NIL reads as zero, ACC is read when the instruction runs
+            if (arg1 == "ACC"):
+                if (opcode == "ADD"):
+                    return (Node.add_acc, (), True)
+                return (Node.sub_acc, (), True)
+            if (arg1 == "NIL"):
+                arg1 = 0
+            if (opcode == "ADD"):
+                return (Node.add, (arg1,), True)
+            return (Node.sub, (arg1,), True)
         elif (opcode == "NEG"):
-            self.neg()
+            return (Node.neg, (), True)
         elif (opcode == "SAV"):
-            self.sav()
+            return (Node.sav, (), True)
         elif (opcode == "SWP"):
-            self.swp()
+            return (Node.swp, (), True)
 
-        # Jumping args should return so we don't mess with the pc
-        elif (opcode == "JMP"):
-            self.jmp(instruction[1])
-            return
-        elif (opcode == "JEZ"):
-            self.jez(instruction[1])
-            return
-        elif (opcode == "JNZ"):
-            self.jnz(instruction[1])
-            return
-        elif (opcode == "JLZ"):
-            self.jlz(instruction[1])
-            return
-        elif (opcode == "JGZ"):
-            self.jgz(instruction[1])
-            return
+        # Jumping handlers move the pc themselves
+        elif (opcode.startswith("J") and opcode != "JRO"):
+            target = self.program.jump_target(arg1)
+            # validate_code has already flagged jumps to unknown labels
+            if (target is None):
+                return (Node.nop, (), True)
+            if (opcode == "JMP"):
+                return (Node.jmp, (target,), False)
+            elif (opcode == "JEZ"):
+                return (Node.jez, (target,), False)
+            elif (opcode == "JNZ"):
+                return (Node.jnz, (target,), False)
+            elif (opcode == "JLZ"):
+                return (Node.jlz, (target,), False)
+            elif (opcode == "JGZ"):
+                return (Node.jgz, (target,), False)
         elif (opcode == "JRO"):
-            self.jro(instruction[1])
+            if (type(arg1) == int):
+                return (Node.jmp, (self.jro_target(line_num, arg1),), False)
+            return (Node.jro, (REGISTER_CODES.get(arg1),), False)
+
+        elif (opcode == "MOV" and arg2 in REGISTER_CODES):
+            # registers are passed as their codes
+            if (type(arg1) == int):
+                return (Node.mov_value, (arg1, REGISTER_CODES[arg2]), False)
+            if (arg1 in REGISTER_CODES):
+                return (Node.mov, (REGISTER_CODES[arg1],
+                                   REGISTER_CODES[arg2]), False)
+
+        # NOP, and anything validate_code rejected, just moves the pc
+        return (Node.nop, (), True)
+
+    def is_local(self, instruction):
+        """ Returns True if instruction only touches ACC and BAK """
+        opcode, arg1, arg2 = instruction
+        if (opcode == "ADD" or opcode == "SUB"):
+            return type(arg1) == int or arg1 in ("ACC", "NIL")
+        return opcode in ("NEG", "SAV", "SWP", "NOP")
+
+    def build_blocks(self):
+        """ Finds the runs of local-only instructions (ADD/SUB with an
+            immediate, ACC or NIL, NEG, SAV, SWP and NOP) and compiles each
+            run into a single function
+
+            blocks[line] is (function, length, end) for the run starting at
+            line, where end is the line after the run, or None if there is
+            no run of two or more instructions there. Runs stop at the
+            first other instruction, or when they wrap back to their start
+        """
+        program = self.program
+        if (program.blocks is not None):
+            self.blocks = program.blocks
+            return
+        code = program.code()
+        blocks = [None] * len(program.lines)
+        for start, instruction in code.items():
+            run = []
+            line_num = start
+            while (self.is_local(code[line_num])):
+                run.append(code[line_num])
+                line_num = self.next_pc[line_num]
+                if (line_num == start):
+                    break
+            if (len(run) < 2):
+                continue
+            shape = tuple((opcode, NUMBER if type(arg1) == int else arg1)
+                          for opcode, arg1, arg2 in run)
+            immediates = [arg1 for opcode, arg1, arg2 in run
+                          if type(arg1) == int]
+            blocks[start] = (block_maker(shape)(*immediates), len(run),
+                             line_num)
+        program.blocks = blocks
+        self.blocks = blocks
+
+    def settle_any(self, neighbor):
+        """ Settles the MOV on ANY this node is blocked on onto neighbor,
+            which LAST points to from now on
+        """
+        if (self.receiving is not None):
+            self.receiving = neighbor
+        else:
+            self.sending = neighbor
+        self.last = neighbor
+
+    def advance_pc(self):
+        """ Moves the pc onto the next line of code, skipping labels
+            and wrapping around at the end of the node
+        """
+        self.pc = self.next_pc[self.pc]
+
+    def fingerprint(self):
+        """ Returns the registers, pc and MOV state of this node """
+        return (self.acc, self.bak, self.pc, self.last, self.busy,
+                self.value_to_send, self.receiving_into_acc,
+                self.sending, self.receiving)
+
+    def restore(self, state):
+        """ Puts this node back in a state from fingerprint() """
+        (self.acc, self.bak, self.pc, self.last, self.busy,
+         self.value_to_send, self.receiving_into_acc, self.sending,
+         self.receiving) = state
+
+    def save_state(self, index):
+        """ Returns the registers, pc and MOV state of this node as a
+            tuple of plain values, other nodes are stored as their
+            position in index (a {node: position} dict)
+        """
+        return (self.acc, self.bak, self.pc, self.busy,
+                reference(self.last, index), reference(self.sending, index),
+                reference(self.receiving, index), self.value_to_send,
+                self.receiving_into_acc)
+
+    def load_state(self, state, nodes):
+        """ Puts this node back in a state from save_state(), nodes is the
+            list the positions in it refer to
+        """
+        (self.acc, self.bak, self.pc, self.busy, last, sending, receiving,
+         self.value_to_send, self.receiving_into_acc) = state
+        self.last = dereference(last, nodes, self.priority)
+        self.sending = dereference(sending, nodes, self.write_priority)
+        self.receiving = dereference(receiving, nodes, self.priority)
+
+    def clone(self):
+        """ Returns a new node at the same position running the same
+            program, with fused blocks if this node has them, and no
+            neighbors or state
+        """
+        node = Node(self.xpos, self.ypos)
+        node.use_program(self.program)
+        node.blocks = self.blocks
+        return node
+
+    def offer(self):
+        """ Returns the node we are offering a value to
+            Returns None if we do not have a value waiting to be picked up
+        """
+        if (self.value_to_send is not None):
+            return self.sending
+        return None
+
+    def send_value(self):
+        """ Hands our offered value over to the node we are sending to
+            This is only called once the receiving node has picked it up!
+            The MOV is complete, so the pc moves on
+            Returns the value that was sent
+        """
+        value = self.value_to_send
+        if (self.trace is not None):
+            self.trace.emit("send", self, value, "to",
+                            (self.sending.xpos, self.sending.ypos))
+        self.sending = None
+        self.value_to_send = None
+        self.advance_pc()  # we are done after any send
+        return value
+
+    def receive_value(self, value):
+        """ Stores value picked up from the node we are receiving from
+
+            If the MOV was into a port we now offer the value on, and the
+            MOV completes once that node picks it up
+            Otherwise the value goes to ACC (or NIL) and the MOV is complete
+        """
+        if (self.trace is not None):
+            self.trace.emit("receive", self, value, "from",
+                            (self.receiving.xpos, self.receiving.ypos))
+        # This node is no longer receiving from anyone
+        self.receiving = None
+
+        if (self.receiving_into_acc):
+            # we are sending this value to our acc
+            self.acc = value
+            self.receiving_into_acc = False
+            self.advance_pc()
             return
 
-        elif (opcode == "MOV"):
-            self.mov(instruction[1], instruction[2])
+        if (self.sending is None and self.last is not None and
+                self.sends_to_last()):
+            # MOV ANY, LAST: LAST is the port the value just came from
+            self.sending = self.last
+        if (self.sending is not None):
+            # We are sending this value to another node
+            self.value_to_send = value
             return
+        self.use_value(value)
+
+    def sends_to_last(self):
+        """ Returns True if the instruction at pc is a MOV into LAST """
+        at = self.pc * WIDTH
+        table = self.program.table
+        return (table[at] == MOV_CODE and table[at + 3] == REGISTER and
+                table[at + 4] == LAST)
 
-        elif (opcode == "NOP"):
-            self.increment_pc()  # Skip this instruction. Consider changing to ADD NIL
-            self.skip_labels()
+    def use_value(self, value):
+        """ Finishes the instruction at pc that read value without
+            sending it on: ADD, SUB or JRO from a port, or a MOV into NIL
+        """
+        opcode = self.program.table[self.pc * WIDTH]
+        if (opcode == ADD_CODE):
+            self.acc += value
+        elif (opcode == SUB_CODE):
+            self.acc -= value
+        elif (opcode == JRO_CODE):
+            self.pc = self.jro_target(self.pc, value)
             return
+        # we are done and can move the pc up
+        self.advance_pc()
+
+    def step(self):
+        """ Runs this node for one cycle using only its own state
+
+            Returns the node we want to read a value from this cycle,
+            or None. Reading needs the other node's state, so it is left to
+            the caller (see Scheduler.tick), which lets every node step
+            independently of the others
+        """
+        if (self.receiving is not None):
+            # blocked until the node we receive from has a value for us
+            if (self.trace is not None):
+                self.trace.emit("blocked", self, "receiving")
+            return self.receiving
+        if (self.sending is not None):
+            # blocked until the node we send to picks our value up
+            if (self.trace is not None):
+                self.trace.emit("blocked", self, "sending")
+            return None
+
+        if (self.busy):
+            # still paying for the cycles of a fused block
+            self.busy -= 1
+            return None
+
+        # nothing to run if we have no code
+        if (not self.compiled):
+            return None
 
-        self.increment_pc()
-        self.skip_labels()
+        if (self.blocks):
+            block = self.blocks[self.pc]
+            if (block is not None):
+                # run the whole block now and charge its other cycles later
+                function, length, end = block
+                if (self.trace is not None):
+                    self.trace.emit("execute", self, self.pc, "BLOCK", length)
+                function(self)
+                self.pc = end
+                self.busy = length - 1
+                return None
+
+        entry = self.compiled[self.pc]
+        if (entry is None):
+            # This is a label and we need to increment pc
+            self.advance_pc()
+            return None
+
+        if (self.trace is not None):
+            self.trace.emit("execute", self, self.pc,
+                            self.program.opcode(self.pc))
+        handler, args, advance = entry
+        handler(self, *args)
+        if (advance):
+            # advance_pc(), inlined as it runs for most instructions
+            self.pc = self.next_pc[self.pc]
+        # a MOV from a port tries to read straight away
+        return self.receiving
+
+    def execute_next(self):
+        """ Executes the next instruction
+            that the program counter points to
+
+            This runs the node on its own, any value we read is picked up
+            straight away. Use a Scheduler to run a grid of nodes in step,
+            which is also what settles MOVs on ANY
+        """
+        source = self.step()
+        if ((source is not None) and (type(source) is not tuple) and
+                (source.offer() is self)):
+            self.receive_value(source.send_value())
 
     def mov(self, reg1, reg2):
         """ Moves the value from reg1 into reg2
         if reg1 is a port (U/D/L/R) we receive from that Node
         if reg2 is a port (U/D/L/R) we send to that Node
         syntax: MOV <r1, r2> for registers r1 and r2
+        reg1 and reg2 are register codes, ports index neighbors
+        ANY is whichever neighbor is first ready, see settle_any()
+        LAST is the neighbor of the last ANY, NIL if there was none
+
+        A port with no node on the other side never completes, the MOV
+        is retried every cycle
         """
-        print("Executing mov on node ", str(self),
-              " with reg1=", reg1, " reg2=", reg2)
-        if reg1 in self.adjacency.keys():
-            # This is a node we need to receive from
-            self.receiving = self.adjacency[reg1]
-            print("we need to receive from ", str(self.receiving))
-            # somehow set our send value?
-        else:
-            # This is this node's registers (ACC,etc)
-            if reg1 == "ACC":
-                self.value_to_send = self.acc
-                print("received from ACC, now sending value ", self.value_to_send)
-            # Or reg1 was a literal
-            elif type(reg1) == int:
-                self.value_to_send = reg1
-                print("received from literal, now sending value ",
-                      self.value_to_send)
-
-        if reg2 in self.adjacency.keys():
+        if (self.trace is not None):
+            self.trace.emit("mov", self, REGISTERS[reg1], REGISTERS[reg2])
+        source = target = None
+        if (reg1 <= DOWN or reg1 >= ANY):
+            source = self.port(reg1)
+            if (source is None and reg1 != LAST):
+                return
+        if (reg2 <= DOWN or reg2 >= ANY):
+            target = self.write_port(reg2)
+            if (target is None and reg2 != LAST):
+                return
+        if (reg1 == ANY and reg2 == LAST):
+            # LAST is wherever the read settles, see receive_value()
+            target = None
+
+        if (source is None):
+            # This is this node's registers (ACC,etc), or LAST before ANY
+            self.move(self.acc if reg1 == ACC else 0, reg2)
+            return
+        if (target is not None):
             # This is a node we need to send to
-            self.sending = self.adjacency[reg2]
-            print("now sending to ", str(self.sending))
-        else:
-            # This is this node's registers (ACC, etc)
-            if reg2 == "ACC":
-                self.receiving_into_acc = True
-                print("Set to receive into our ACC")
+            self.sending = target
+        elif (reg2 == ACC):
+            self.receiving_into_acc = True
+        # This is a node we need to receive from
+        self.receiving = source
+
+    def read(self, reg):
+        """ Starts reading the operand of ADD, SUB or JRO from the port
+            register reg, LAST with no LAST reads as zero like NIL
+            A port with no node on the other side never completes
+        """
+        source = self.port(reg)
+        if (source is not None):
+            self.receiving = source
+        elif (reg == LAST):
+            self.use_value(0)
+
+    def port(self, reg):
+        """ Returns what a MOV on the port register reg talks to: a node,
+            the priority tuple for ANY, or None if nothing is there
+        """
+        if (reg <= DOWN):
+            return self.neighbors[reg]
+        if (reg == ANY):
+            return self.priority or None
+        return self.last
+
+    def write_port(self, reg):
+        """ Like port(), but ANY gives the write_priority tuple, as writes
+            to ANY try the neighbors in a different order than reads
+        """
+        if (reg == ANY):
+            return self.write_priority or None
+        return self.port(reg)
+
+    def mov_value(self, value, reg2):
+        """ Moves the literal value into reg2
+        syntax: MOV <v, r2> for a number v
+        """
+        if (self.trace is not None):
+            self.trace.emit("mov", self, value, REGISTERS[reg2])
+        self.move(value, reg2)
 
-        print("initial mov call finished on ", str(self))
-        self.execute_next()  # we need to use one extra clock cycle
+    def move(self, value, reg2):
+        """ Finishes a MOV whose value is already known """
+        if (reg2 <= DOWN or reg2 >= ANY):
+            target = self.write_port(reg2)
+            if (target is None):
+                if (reg2 == LAST):
+                    # with no LAST, the value is thrown away like NIL
+                    self.advance_pc()
+                return
+            # offer the value, the MOV completes once it is picked up
+            self.sending = target
+            self.value_to_send = value
+            return
+        if (reg2 == ACC):
+            self.acc = value
+        self.advance_pc()
 
     def sav(self):
         """ The value of ACC is written to BAK
@@ -420,27 +1045,36 @@ class Node(object):
         """
         self.acc = self.bak
 
+    def nop(self):
+        """ Does nothing for a cycle
+        syntax: NOP
+        """
+
     def add(self, val):
         """ Adds a value to the accumulator
         This is done using ADD <x>
-        Where x can be a Node or a value
+        Where x is a number, ports are read with read()
         """
-        if (type(val) == Node):
-            literal = self.get_input(val)
-            self.add(literal)
-        else:
-            self.acc += val
+        self.acc += val
 
     def sub(self, val):
         """ Subtracts a value from the accumulator
         syntax: SUB <x>
-        Where x can be a Node or a value
+        Where x is a number, ports are read with read()
         """
-        if (type(val) == Node):
-            literal = self.get_input(val)
-            self.sub(literal)
-        else:
-            self.acc -= val
+        self.acc -= val
+
+    def add_acc(self):
+        """ Adds the accumulator to itself
+        syntax: ADD ACC
+        """
+        self.acc += self.acc
+
+    def sub_acc(self):
+        """ Subtracts the accumulator from itself
+        syntax: SUB ACC
+        """
+        self.acc -= self.acc
 
     def neg(self):
         """ Negates ACC
@@ -448,57 +1082,49 @@ class Node(object):
         """
         self.acc *= -1
 
-    def jmp(self, label):
+    def jmp(self, target):
         """ Changes the pc to point to the line on which the
         label *label* resides.
-        syntax: JMP <l> where l is a label """
-        self.pc = self.labels[label]
-
-        # keep incrementing the pc until we find a line that is not a label
-        # increment the pc again if the new line of code is only a label
-        if self.code.get(self.pc, False) == False:
-            self.increment_pc()
-            self.skip_labels()
+        syntax: JMP <l> where l is a label
+        target is the line the label resolves to in jump_targets
+        """
+        self.pc = target
 
-    def jez(self, label):
+    def jez(self, target):
         """ Jumps to label if acc is equal to Zero
         syntax: JEZ <l>
         """
         if (self.acc == 0):
-            self.jmp(label)
+            self.pc = target
         else:
-            self.increment_pc()
-            self.skip_labels()
+            self.advance_pc()
 
-    def jnz(self, label):
+    def jnz(self, target):
         """ Jumps to label if acc is not equal to zero
         syntax: JNZ <l>
         """
         if (self.acc != 0):
-            self.jmp(label)
+            self.pc = target
         else:
-            self.increment_pc()
-            self.skip_labels()
+            self.advance_pc()
 
-    def jlz(self, label):
+    def jlz(self, target):
         """ Jumps to label is acc is less than zero
         syntax: JLZ <l>
         """
         if (self.acc < 0):
-            self.jmp(label)
+            self.pc = target
         else:
-            self.increment_pc()
-            self.skip_labels()
+            self.advance_pc()
 
-    def jgz(self, label):
+    def jgz(self, target):
         """ Jumps to label is acc is greater than zero
         syntax: JGZ <l>
         """
         if (self.acc > 0):
-            self.jmp(label)
+            self.pc = target
         else:
-            self.increment_pc()
-            self.skip_labels()
+            self.advance_pc()
 
     def jro(self, target):
         """ Jumps to the offset specified by target
@@ -507,16 +1133,11 @@ class Node(object):
             JRO 2 skips the next instruction
             JRO -1 executes the previous instruction next
             JRO ACC uses the value in ACC to specify the offset
+        integer offsets are resolved when compiling and ports are read
+        with read(), so only ACC and NIL get here, NIL stays put like JRO 0
         """
-        if (type(target) == int):
-            self.move_pc_and_skip_labels(target)
-        elif (target == "ACC"):
-            self.move_pc_and_skip_labels(self.acc)
-        #else:
-        #    # TODO: add support for UP/DOWN/etc
-        #    pass
-        #self.skip_labels()
-        #self.correct_pc_bounds()
+        if (target == ACC):
+            self.pc = self.jro_target(self.pc, self.acc)
 
     def __str__(self):
         s = "Node at (" + str(self.xpos) + "," + str(self.ypos) + ")"
@@ -0,0 +1,240 @@
+""" This file contains the input and output ports that connect a grid to
+    the outside world.
+
+    A port sits on a position next to the edge of the grid and is linked
+    to its neighbor with main.update_output_table(). Like stack nodes,
+    ports are passive: the Scheduler serves the node reading from or
+    writing to a port while committing each tick.
+
+    InputPort takes its values from any iterable and only pulls the next
+    one when a node reads it, the read_* generators stream values from
+    text files, binary files and memory-mapped arrays in chunks.
+    OutputPort writes into a preallocated array (array.array, numpy array,
+    numpy memmap) or appends to a binary file through a fixed buffer.
+    Neither keeps the values it has passed on.
+
+    Restoring a port to an earlier state (see Scheduler.restore) and
+    forking it only works when its values can be gone through again: an
+    input reading a list, range or array rather than an iterator, and an
+    output filling an array rather than a file.
+"""
+
+import copy
+import itertools
+from array import array
+
+from node import Passive
+
+# number of values read or written at a time
+CHUNK = 4096
+
+
+class InputPort(Passive):
+
+    """ Offers the values of an iterable, one at a time
+
+    count is the number of values read by the grid so far
+    """
+
+    __slots__ = ("source", "values", "next_value", "count")
+
+    def __init__(self, xpos, ypos, values):
+        Passive.__init__(self, xpos, ypos)
+        self.source = values
+        self.values = iter(values)
+        self.next_value = None
+        self.count = 0
+
+    def is_empty(self):
+        """ Returns True once the values have run out """
+        if (self.next_value is None):
+            self.next_value = next(self.values, None)
+        return self.next_value is None
+
+    def is_full(self):
+        # nothing can be written to an input
+        return True
+
+    def pop(self):
+        """ Takes the next value, is_empty() must have returned False """
+        value = self.next_value
+        self.next_value = None
+        self.count += 1
+        return value
+
+    def fingerprint(self):
+        return self.count
+
+    def restore(self, count):
+        """ Moves the input to having read count values """
+        if (count == self.count):
+            return
+        self.check_restorable()
+        self.values = itertools.islice(self.source, count, None)
+        self.next_value = None
+        self.count = count
+
+    def save_state(self, index):
+        return self.count
+
+    def load_state(self, state, nodes):
+        self.restore(state)
+
+    def clone(self):
+        self.check_restorable()
+        return InputPort(self.xpos, self.ypos, self.source)
+
+    def check_restorable(self):
+        if (iter(self.source) is self.source):
+            raise ValueError(str(self) + " reads an iterator, which cannot "
+                             "be gone through again")
+
+    def __str__(self):
+        return "Input at (" + str(self.xpos) + "," + str(self.ypos) + ")" + \
+            " read: " + str(self.count)
+
+
+class OutputPort(Passive):
+
+    """ Collects the values written by the grid
+
+    values is a preallocated array to fill, writers block once it is full
+    file is a path or binary file to append the values to instead, as
+        native 64 bit integers
+    exactly one of values and file has to be given, or a ValueError is
+    raised
+    count is the number of values written by the grid so far
+    """
+
+    __slots__ = ("values", "file", "buffer", "buffered", "count")
+
+    def __init__(self, xpos, ypos, values=None, file=None, chunk=CHUNK):
+        if ((values is None) == (file is None)):
+            raise ValueError("an output needs either values or a file")
+        Passive.__init__(self, xpos, ypos)
+        self.values = values
+        self.file = None
+        if (file is not None):
+            self.file = open(file, "ab") if isinstance(file, str) else file
+            self.buffer = array("q", [0]) * chunk
+        self.buffered = 0
+        self.count = 0
+
+    def is_empty(self):
+        # nothing can be read from an output
+        return True
+
+    def is_full(self):
+        return self.values is not None and self.count == len(self.values)
+
+    def push(self, value):
+        """ Writes value, is_full() must have returned False """
+        if (self.file is not None):
+            self.buffer[self.buffered] = value
+            self.buffered += 1
+            if (self.buffered == len(self.buffer)):
+                self.flush()
+        else:
+            self.values[self.count] = value
+        self.count += 1
+
+    def flush(self):
+        """ Writes the buffered values out to the file """
+        if (self.file is not None and self.buffered):
+            self.file.write(memoryview(self.buffer)[:self.buffered])
+            self.buffered = 0
+            self.file.flush()
+
+    def close(self):
+        """ Flushes and closes the file """
+        if (self.file is not None):
+            self.flush()
+            self.file.close()
+
+    def fingerprint(self):
+        return self.count
+
+    def restore(self, count):
+        """ Moves the output to having been written count values """
+        if (count == self.count):
+            return
+        self.check_restorable()
+        self.count = count
+
+    def save_state(self, index):
+        return self.count
+
+    def load_state(self, state, nodes):
+        self.restore(state)
+
+    def clone(self):
+        """ Returns a new output at the same position filling a copy of
+            this one's array
+        """
+        self.check_restorable()
+        return OutputPort(self.xpos, self.ypos, copy.copy(self.values))
+
+    def check_restorable(self):
+        if (self.file is not None):
+            raise ValueError(str(self) + " writes to a file, which cannot "
+                             "be taken back")
+
+    def __str__(self):
+        return "Output at (" + str(self.xpos) + "," + str(self.ypos) + ")" + \
+            " written: " + str(self.count)
+
+
+def read_array(values, chunk=CHUNK):
+    """ Yields the values of an array (a numpy memmap works) a chunk at a
+        time, so only one chunk is ever turned into Python integers
+    """
+    for start in range(0, len(values), chunk):
+        part = values[start:start + chunk]
+        if (hasattr(part, "tolist")):
+            part = part.tolist()
+        for value in part:
+            yield value
+
+
+def read_binary(file, typecode="q", chunk=CHUNK):
+    """ Yields the integers stored in a binary file (a path or a binary
+        file object), typecode is their array module type code
+    """
+    if (isinstance(file, str)):
+        with open(file, "rb") as f:
+            for value in read_binary(f, typecode, chunk):
+                yield value
+        return
+    buffer = array(typecode)
+    while (True):
+        del buffer[:]
+        try:
+            buffer.fromfile(file, chunk)
+        except EOFError:
+            # the values that were left have still been read
+            pass
+        if (not buffer):
+            return
+        for value in buffer:
+            yield value
+
+
+def read_text(file):
+    """ Yields one integer per non-empty line of a text file (a path or
+        an open file)
+    """
+    if (isinstance(file, str)):
+        with open(file) as f:
+            for value in read_text(f):
+                yield value
+        return
+    for line in file:
+        line = line.strip()
+        if (line):
+            yield int(line)
+
+
+def read_memmap(filename, dtype="int64", chunk=CHUNK):
+    """ Yields the integers of a raw binary file through a numpy memmap """
+    import numpy as np
+    return read_array(np.memmap(filename, dtype=dtype, mode="r"), chunk)
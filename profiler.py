@@ -0,0 +1,118 @@
+""" This file contains the Profiler, which counts what every node in a
+    grid spends its cycles on.
+
+    Counters live in flat integer arrays indexed by the node's position in
+    the Scheduler's node list:
+        opcodes: instructions executed per node and opcode
+        lines: instructions executed per node and line of code
+        send_stalls / receive_stalls: cycles spent blocked on a MOV
+    Idle % is the share of cycles a node spent blocked.
+
+    A Scheduler given a profiler reports every step and every tick to it,
+    a Scheduler without one pays a single check per step. Cycles skipped
+    by fast forward are not profiled.
+"""
+
+from array import array
+
+# opcode -> column of the opcodes counters, which is the opcode's code in
+# a program's code table
+from node import OPCODE_CODES as OPCODES, WIDTH
+
+
+class Profiler(object):
+
+    """ Execution counters for a list of nodes
+
+    cycles is the number of ticks profiled
+    line_start[i] is where node i's lines start in lines
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.index = dict((node, i) for i, node in enumerate(nodes))
+        self.cycles = 0
+        self.opcodes = array("q", [0]) * (len(nodes) * len(OPCODES))
+        self.line_start = array("q", [0]) * (len(nodes) + 1)
+        for i, node in enumerate(nodes):
+            self.line_start[i + 1] = self.line_start[i] + len(node.lines)
+        self.lines = array("q", [0]) * self.line_start[len(nodes)]
+        self.send_stalls = array("q", [0]) * len(nodes)
+        self.receive_stalls = array("q", [0]) * len(nodes)
+
+    def step(self, node, pc, busy):
+        """ Counts what node ran when it stepped from pc, busy is what
+            node.busy was before the step
+        """
+        if (busy):
+            # the rest of a fused block, counted when the block started
+            return
+        i = self.index[node]
+        length = 1
+        if (node.blocks and node.blocks[pc] is not None):
+            length = node.blocks[pc][1]
+        table = node.program.table
+        for n in range(length):
+            opcode = table[pc * WIDTH]
+            if (opcode < 0):
+                # a label, or an opcode the node does not know, nothing ran
+                return
+            self.opcodes[i * len(OPCODES) + opcode] += 1
+            self.lines[self.line_start[i] + pc] += 1
+            pc = node.next_pc[pc]
+
+    def tick(self, waiting, offers):
+        """ Counts a cycle, waiting and offers are the nodes still blocked
+            reading and sending once the tick's transfers are done
+        """
+        self.cycles += 1
+        for node in waiting:
+            self.receive_stalls[self.index[node]] += 1
+        for node in offers:
+            self.send_stalls[self.index[node]] += 1
+
+    def opcode_counts(self, node):
+        """ Returns {opcode: instructions executed} for node """
+        start = self.index[node] * len(OPCODES)
+        return dict((opcode, self.opcodes[start + i])
+                    for opcode, i in OPCODES.items()
+                    if self.opcodes[start + i])
+
+    def idle_percent(self, node):
+        """ Returns the percentage of cycles node spent blocked """
+        if (not self.cycles):
+            return 0.0
+        i = self.index[node]
+        return 100.0 * (self.send_stalls[i] + self.receive_stalls[i]) / \
+            self.cycles
+
+    def hottest_lines(self, count=10):
+        """ Returns (executed, node, line number) for the count most
+            executed lines across the grid, most executed first
+        """
+        hot = []
+        for i, node in enumerate(self.nodes):
+            start = self.line_start[i]
+            for line_num in range(len(node.lines)):
+                if (self.lines[start + line_num]):
+                    hot.append((self.lines[start + line_num], i, line_num))
+        hot.sort(key=lambda entry: (-entry[0], entry[1], entry[2]))
+        return [(executed, self.nodes[i], line_num)
+                for executed, i, line_num in hot[:count]]
+
+    def report(self, count=10):
+        """ Returns the hottest lines and every node's stalls as text """
+        lines = ["hottest lines over " + str(self.cycles) + " cycles:"]
+        for executed, node, line_num in self.hottest_lines(count):
+            lines.append("%10d  (%d,%d) %3d: %s" % (
+                executed, node.xpos, node.ypos, line_num,
+                node.lines[line_num]))
+        lines.append("nodes:")
+        for i, node in enumerate(self.nodes):
+            if (node.passive):
+                continue
+            lines.append("  (%d,%d) idle %5.1f%%  send stalls %d  "
+                         "receive stalls %d" % (
+                             node.xpos, node.ypos, self.idle_percent(node),
+                             self.send_stalls[i], self.receive_stalls[i]))
+        return "\n".join(lines)
@@ -0,0 +1,499 @@
+""" This file contains the Scheduler, which runs a grid of nodes
+    one synchronous cycle at a time.
+
+    Every tick happens in two phases:
+        compute: each node steps using only its own state and asks to
+            read from another node if its MOV needs a value
+        commit: every read is checked against what the nodes were
+            offering at the very start of the tick, and the values are
+            handed over
+    Because no node looks at another node while computing, the result of
+    a tick does not depend on the order of the nodes in the list.
+
+    Nodes blocked on a MOV are parked instead of being stepped every
+    cycle: a node waiting to read sits in waiting and a node waiting for
+    its value to be picked up sits in offers. A read can only complete
+    when a node starts reading from a node already offering to it, or a
+    node starts offering to a node already reading from it, so those two
+    events are the only ones that queue a transfer, and a tick only
+    touches runnable nodes and queued transfers.
+
+    Fast forward: the state of a closed grid (one with no external
+    inputs) fully decides what it does next, so once the whole grid is
+    back in a state it has been in before it will keep repeating with
+    that period. run(fast_forward=True) looks for the repeat with Brent's
+    algorithm, which only ever keeps one earlier state around, and then
+    skips ahead by whole periods.
+
+    Fusion: Scheduler(fuse=True) has every node run each run of
+    local-only instructions as one fused block (see Node.build_blocks).
+    The node still takes one cycle per instruction, it just spends the
+    last ones of the block idle, so MOV timing is unchanged.
+
+    Passive nodes (stack nodes and I/O ports, see stack_node.py and
+    ports.py) are never stepped. A passive node with neighbors reading
+    from it or offering to it is kept in served and served while
+    committing, see serve().
+
+    ANY: a node blocked on MOV ANY is waiting on, or offering to, its
+    priority tuple of neighbors rather than one node. Those nodes are kept
+    in anys and settled while committing, reads before the passive nodes
+    are served and writes after, so a value pushed this tick can still
+    only be popped from the next tick on (see settle_read() and
+    settle_write()). They are settled in reading order (top to bottom,
+    then left to right), so the tick still does not depend on the order
+    of the node list, and each one tries its neighbors in its precomputed
+    priority order, LEFT, RIGHT, UP, DOWN for reads and UP, LEFT, RIGHT,
+    DOWN for writes.
+
+    Profiling: Scheduler(profiler=profiler.Profiler(nodes)) reports every
+    step and every tick's stalls to the profiler.
+
+    History: a history.History attached to the Scheduler is told which
+    nodes every tick is about to step and what it is about to commit, so
+    the grid can be stepped backwards.
+
+    Snapshots: snapshot() captures the whole state of the grid as an
+    immutable Snapshot, restore() puts the grid back in it and fork()
+    makes an independent copy of the grid in it, sharing the parsed
+    programs, so a long warm up can be run once and then branched from.
+
+    run_until() is the headless way to run a grid: it prints nothing and
+    stops on a cycle budget, a number of output values, a halt or a
+    predicate, returning a RunResult.
+"""
+
+import time
+from collections import namedtuple
+
+from ports import OutputPort
+
+# what run_until() stopped on and the state it left the grid in
+# reason is "halted", "cycles", "outputs" or "predicate"
+# outputs is the number of values written to output ports
+# state maps the (x, y) of every node with code to its (acc, bak, pc)
+RunResult = namedtuple("RunResult", "reason cycles halted outputs seconds "
+                       "cycles_per_sec state")
+
+# the full state of a grid, see Scheduler.snapshot()
+# states holds what every node's save_state() returned, in node order
+Snapshot = namedtuple("Snapshot", "cycle halted states")
+
+
+def reading_order(node):
+    return (node.ypos, node.xpos)
+
+
+class Scheduler(object):
+
+    """ Runs a list of nodes in lockstep
+
+    cycle counts the number of ticks that have been run
+    halted is set once a tick passes where no node changed at all
+    tracer is an optional tracing.Tracer that every node reports to
+    fuse runs basic blocks of local-only instructions as single operations
+    profiler is an optional profiler.Profiler that counts what nodes run
+
+    runnable is the list of nodes that step next tick
+    waiting maps a node blocked reading to the node it reads from
+    offers maps a node offering a value to the node it offers it to
+    candidates is the list of (reader, source) transfers to try next tick
+    served is the set of passive nodes that have neighbors waiting on them
+    anys is the set of nodes blocked on a MOV on ANY
+    index maps every node to its position in nodes
+    history is the history.History recording the grid, if one is attached
+    """
+
+    def __init__(self, nodes, tracer=None, fuse=False, profiler=None):
+        self.nodes = nodes
+        self.index = dict((node, i) for i, node in enumerate(nodes))
+        self.cycle = 0
+        self.halted = False
+        self.tracer = tracer
+        self.profiler = profiler
+        self.history = None
+        if (tracer is not None):
+            tracer.attach(nodes)
+        if (fuse):
+            for node in nodes:
+                if (not node.passive):
+                    node.build_blocks()
+        self.rebuild()
+
+    def rebuild(self):
+        """ Sorts the nodes into runnable, waiting and offering from their
+            current state, call this after changing node state directly
+        """
+        self.runnable = []
+        self.waiting = dict()
+        self.offers = dict()
+        self.served = set()
+        self.anys = set()
+        for node in self.nodes:
+            if (node.passive):
+                continue
+            if (node.receiving is not None):
+                self.waiting[node] = node.receiving
+                if (type(node.receiving) is tuple):
+                    self.anys.add(node)
+                elif (node.receiving.passive):
+                    self.served.add(node.receiving)
+            elif (node.sending is not None):
+                self.offers[node] = node.sending
+                if (type(node.sending) is tuple):
+                    self.anys.add(node)
+                elif (node.sending.passive):
+                    self.served.add(node.sending)
+            elif (node.compiled):
+                self.runnable.append(node)
+        self.candidates = [(reader, source)
+                           for reader, source in self.waiting.items()
+                           if self.offers.get(source) is reader]
+
+    def tick(self):
+        """ Runs every node for one cycle
+            Returns True if any node changed, False if the grid is stuck
+            (every node blocked, halted on JRO 0 or looping in place)
+        """
+        if (self.tracer is not None):
+            self.tracer.cycle = self.cycle
+            self.trace_blocked()
+
+        # offers is left alone until the commit phase, so it is what every
+        # node was offering at the start of the tick
+        offers = self.offers
+        waiting = self.waiting
+        candidates = self.candidates
+        self.candidates = []
+        runnable = []
+        new_offers = []
+        profiler = self.profiler
+        history = self.history
+        if (history is not None):
+            history.begin()
+            # node, acc, bak, pc, busy of every node a step changed
+            steps = []
+
+        # compute phase: nodes only touch their own state
+        changed = False
+        for node in self.runnable:
+            pc = node.pc
+            acc = node.acc
+            bak = node.bak
+            busy = node.busy
+            source = node.step()
+            if (profiler is not None):
+                profiler.step(node, pc, busy)
+            if (not changed or history is not None):
+                differs = (node.pc != pc or node.acc != acc or
+                           node.bak != bak or node.busy != busy or
+                           node.sending is not None or
+                           node.receiving is not None)
+                if (differs and history is not None):
+                    steps += (node, acc, bak, pc, busy)
+                changed = changed or differs
+            if (source is not None):
+                waiting[node] = source
+                if (type(source) is tuple):
+                    self.anys.add(node)
+                elif (source.passive):
+                    self.served.add(source)
+                elif (offers.get(source) is node):
+                    candidates.append((node, source))
+            elif (node.sending is not None):
+                new_offers.append(node)
+            else:
+                runnable.append(node)
+
+        # commit phase: a read succeeds if the value was on offer when the
+        # tick started
+        transfers = [(reader, source) for reader, source in candidates
+                     if (waiting.get(reader) is source and
+                         offers.get(source) is reader)]
+        anys = sorted(self.anys, key=reading_order) if self.anys else ()
+        served = list(self.served)
+        if (history is not None):
+            history.record(steps, transfers, anys, served)
+        values = [source.send_value() for reader, source in transfers]
+        for (reader, source), value in zip(transfers, values):
+            del offers[source]
+            runnable.append(source)
+            del waiting[reader]
+            self.deliver(reader, value, runnable, new_offers)
+
+        moved = 0
+        for node in anys:
+            if (type(waiting.get(node)) is tuple):
+                moved += self.settle_read(node, runnable, new_offers)
+
+        for passive in served:
+            count, pending = self.serve(passive, runnable, new_offers)
+            moved += count
+            if (not pending):
+                self.served.discard(passive)
+
+        for node in anys:
+            if (type(offers.get(node)) is tuple):
+                moved += self.settle_write(node, runnable, new_offers)
+
+        if (profiler is not None):
+            profiler.tick(waiting, offers)
+
+        # new offers are seen from the next tick on
+        for node in new_offers:
+            target = node.sending
+            offers[node] = target
+            if (type(target) is tuple):
+                self.anys.add(node)
+            elif (target.passive):
+                self.served.add(target)
+            elif (waiting.get(target) is node):
+                self.candidates.append((target, node))
+
+        self.runnable = runnable
+        self.cycle += 1
+        return changed or bool(transfers) or moved > 0
+
+    def deliver(self, reader, value, runnable, new_offers):
+        """ Completes the read of reader with value """
+        reader.receive_value(value)
+        if (reader.sending is not None):
+            # the value is passed straight on to another port
+            new_offers.append(reader)
+        else:
+            runnable.append(reader)
+
+    def settle_read(self, node, runnable, new_offers):
+        """ Tries to settle the MOV from ANY node is blocked on: the value
+            comes from the first neighbor that was offering to node when
+            the tick started, or from the first passive neighbor with a
+            value
+            Returns the number of values moved
+        """
+        offers = self.offers
+        for source in node.receiving:
+            if (source.passive):
+                if (source.is_empty()):
+                    continue
+                value = source.pop()
+            else:
+                offer = offers.get(source)
+                if (type(offer) is tuple):
+                    if (node not in offer):
+                        continue
+                    source.settle_any(node)
+                    self.anys.discard(source)
+                elif (offer is not node):
+                    continue
+                value = source.send_value()
+                del offers[source]
+                runnable.append(source)
+            node.settle_any(source)
+            self.anys.discard(node)
+            del self.waiting[node]
+            self.deliver(node, value, runnable, new_offers)
+            return 1
+        return 0
+
+    def settle_write(self, node, runnable, new_offers):
+        """ Tries to settle the MOV to ANY node is blocked on: the value
+            goes to the first neighbor reading from node, or to the first
+            passive neighbor with room for it
+            Returns the number of values moved
+        """
+        waiting = self.waiting
+        for target in node.sending:
+            if (target.passive):
+                if (target.is_full()):
+                    continue
+                node.settle_any(target)
+                target.push(node.send_value())
+            else:
+                wanted = waiting.get(target)
+                if (type(wanted) is tuple):
+                    if (node not in wanted):
+                        continue
+                    target.settle_any(node)
+                    self.anys.discard(target)
+                elif (wanted is not node):
+                    continue
+                node.settle_any(target)
+                del waiting[target]
+                self.deliver(target, node.send_value(), runnable, new_offers)
+            self.anys.discard(node)
+            del self.offers[node]
+            runnable.append(node)
+            return 1
+        return 0
+
+    def serve(self, passive, runnable, new_offers):
+        """ Pops a value for every neighbor reading from the passive node,
+            then pushes the value of every neighbor that was offering to it
+            when the tick started, in its priority order
+            Pops come first, so a value pushed this tick can be popped
+            from the next tick on
+            Returns the number of values moved and whether any neighbor
+            is still waiting on the node
+        """
+        waiting = self.waiting
+        offers = self.offers
+        moved = 0
+        pending = False
+        for reader in passive.priority:
+            if (waiting.get(reader) is not passive):
+                continue
+            if (passive.is_empty()):
+                pending = True
+                continue
+            del waiting[reader]
+            self.deliver(reader, passive.pop(), runnable, new_offers)
+            moved += 1
+        for writer in passive.priority:
+            if (offers.get(writer) is not passive):
+                continue
+            if (passive.is_full()):
+                pending = True
+                continue
+            del offers[writer]
+            passive.push(writer.send_value())
+            runnable.append(writer)
+            moved += 1
+        return moved, pending
+
+    def trace_blocked(self):
+        """ Reports the parked nodes as blocked, they are not stepped so
+            they cannot report it themselves
+        """
+        for node in self.waiting:
+            if (node.trace is not None):
+                node.trace.emit("blocked", node, "receiving")
+        for node in self.offers:
+            if (node.trace is not None):
+                node.trace.emit("blocked", node, "sending")
+
+    def fingerprint(self):
+        """ Returns a value that is equal for two ticks exactly when every
+            node has the same registers, pc and MOV state, every stack holds
+            the same values and every port has moved as many values
+        """
+        return tuple([node.fingerprint() for node in self.nodes])
+
+    def snapshot(self):
+        """ Returns the state of every node and the cycle count as a
+            Snapshot, which holds nothing but tuples of plain values
+        """
+        index = self.index
+        return Snapshot(self.cycle, self.halted,
+                        tuple([node.save_state(index) for node in self.nodes]))
+
+    def restore(self, snapshot):
+        """ Puts the grid back in the state it was in at snapshot
+            Raises ValueError if snapshot is of a different grid, or if a
+            port cannot go back (see ports.py)
+        """
+        if (len(snapshot.states) != len(self.nodes)):
+            raise ValueError("snapshot of " + str(len(snapshot.states)) +
+                             " nodes, the grid has " + str(len(self.nodes)))
+        for node, state in zip(self.nodes, snapshot.states):
+            node.load_state(state, self.nodes)
+        self.cycle = snapshot.cycle
+        self.halted = snapshot.halted
+        self.rebuild()
+        if (self.history is not None):
+            self.history.reset()
+
+    def fork(self, snapshot=None):
+        """ Returns a Scheduler running a copy of the grid, in the state of
+            snapshot or in the current state if snapshot is None
+            The copy shares the parsed programs and every neighbor has to
+            be in the node list. Tracing and profiling are not copied
+        """
+        if (snapshot is None):
+            snapshot = self.snapshot()
+        index = self.index
+        nodes = [node.clone() for node in self.nodes]
+        for node, copy in zip(self.nodes, nodes):
+            copy.neighbors = tuple(None if neighbor is None
+                                   else nodes[index[neighbor]]
+                                   for neighbor in node.neighbors)
+            copy.build_priority()
+        scheduler = Scheduler(nodes)
+        scheduler.restore(snapshot)
+        return scheduler
+
+    def halt(self):
+        """ Marks the grid halted, taking back the tick that found it
+            stuck, as that tick did nothing
+        """
+        self.cycle -= 1
+        self.halted = True
+        if (self.history is not None):
+            self.history.discard()
+
+    def run(self, max_cycles, fast_forward=False):
+        """ Ticks until the grid halts or cycle reaches max_cycles
+            The tick that finds the grid halted is not counted
+            fast_forward skips whole periods once the grid repeats itself
+            Returns True if the grid halted
+        """
+        # Brent's algorithm: saved is compared against every later state,
+        # and is replaced each time period reaches the next power of two
+        saved = self.fingerprint() if fast_forward else None
+        power = period = 1
+        while (not self.halted and self.cycle < max_cycles):
+            if (not self.tick()):
+                self.halt()
+                break
+            if (saved is None):
+                continue
+            state = self.fingerprint()
+            if (state == saved):
+                # the grid repeats every period cycles from here on
+                self.cycle += ((max_cycles - self.cycle) // period) * period
+                saved = None
+                if (self.history is not None):
+                    self.history.reset()
+                continue
+            if (power == period):
+                saved = state
+                power *= 2
+                period = 0
+            period += 1
+        return self.halted
+
+    def run_until(self, max_cycles, outputs=None, predicate=None,
+                  fast_forward=False):
+        """ Ticks until the grid halts, cycle reaches max_cycles, the output
+            ports have been written outputs values in total or
+            predicate(scheduler) returns True after a tick
+            fast_forward is only used when there is no outputs or predicate
+            to check every tick
+            Returns a RunResult
+        """
+        start = time.perf_counter()
+        begin = self.cycle
+        ports = [node for node in self.nodes if isinstance(node, OutputPort)]
+        reason = "cycles"
+        if (outputs is None and predicate is None):
+            self.run(max_cycles, fast_forward)
+        else:
+            while (not self.halted and self.cycle < max_cycles):
+                if (not self.tick()):
+                    self.halt()
+                    break
+                if (outputs is not None and
+                        sum(port.count for port in ports) >= outputs):
+                    reason = "outputs"
+                    break
+                if (predicate is not None and predicate(self)):
+                    reason = "predicate"
+                    break
+        if (self.halted):
+            reason = "halted"
+        seconds = time.perf_counter() - start
+        return RunResult(reason, self.cycle, self.halted,
+                         sum(port.count for port in ports), seconds,
+                         (self.cycle - begin) / seconds if seconds else 0.0,
+                         dict(((node.xpos, node.ypos),
+                               (node.acc, node.bak, node.pc))
+                              for node in self.nodes if node.compiled))
@@ -0,0 +1,207 @@
+""" This file contains a local simulation service, so tools can run jobs
+    without paying for interpreter startup and parsing every time.
+
+    The server listens on a Unix socket or a localhost TCP port and
+    speaks JSON lines: every line a client sends is a job, and every job
+    gets one line back once it is done. Jobs run on a pool of worker
+    processes, so results come back in the order they finish, not the
+    order they were sent; use "id" to match them up. A client can keep
+    sending jobs while earlier ones are still running.
+
+    A job looks like
+        {"id": 1, "layout": "[0,0]\\nMOV UP, DOWN\\n",
+         "inputs": [[0, -1, [1, 2, 3]]], "outputs": [[0, 1, 3]],
+         "max_cycles": 100000}
+    where inputs are [x, y, values] fed in by input ports and outputs are
+    [x, y, count] collected by output ports. The run stops once every
+    output has its count, the grid halts or max_cycles is reached. The
+    result holds "id", the RunResult fields and "values", the outputs in
+    the order they were given, or "id" and "error".
+
+    Every worker keeps its most recently used layouts parsed and linked
+    in an LRU, keyed by a hash of the layout text, and runs every job on
+    a fresh copy of them.
+
+    usage: python server.py [--socket PATH | --port N] [--workers N]
+                            [--layouts N]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import build_layout, layout_entries
+from evaluate import MAX_CYCLES
+from loader import iter_nodes
+from main import build_io_tables, update_output_table
+from ports import InputPort, OutputPort
+from scheduler import Scheduler
+
+# parsed layouts every worker keeps
+LAYOUTS = 64
+
+# the LRU of the worker process, see init_worker()
+layouts = None
+
+
+class LayoutCache(object):
+
+    """ The size most recently used layouts, as layout_entries() """
+
+    def __init__(self, size=LAYOUTS):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def nodes(self, source):
+        """ Returns a fresh copy of the linked nodes of the layout text in
+            source, parsing it only if it is not cached
+        """
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        entries = self.entries.get(key)
+        if (entries is None):
+            self.misses += 1
+            nodes = list(iter_nodes(source.splitlines()))
+            build_io_tables(nodes)
+            entries = layout_entries(nodes)
+            self.entries[key] = entries
+            if (len(self.entries) > self.size):
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return build_layout(entries)
+
+
+def init_worker(size):
+    global layouts
+    layouts = LayoutCache(size)
+
+
+def run_job(job):
+    """ Runs one job, returns its result as a dict for JSON """
+    if (layouts is None):
+        init_worker(LAYOUTS)
+    result = {"id": job.get("id")}
+    try:
+        nodes = layouts.nodes(job["layout"])
+        pipes = [InputPort(x, y, values)
+                 for x, y, values in job.get("inputs", [])]
+        outputs = [OutputPort(x, y, [0] * count)
+                   for x, y, count in job.get("outputs", [])]
+        update_output_table(nodes, pipes + outputs)
+        stop_after = sum(len(port.values) for port in outputs) or None
+        run = Scheduler(nodes + pipes + outputs).run_until(
+            job.get("max_cycles", MAX_CYCLES), stop_after)
+    except (KeyError, TypeError, ValueError) as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+        return result
+    result.update(run._asdict())
+    result["state"] = dict(("%d,%d" % position, list(registers))
+                           for position, registers in run.state.items())
+    result["values"] = [port.values[:port.count] for port in outputs]
+    return result
+
+
+class Server(object):
+
+    """ Hands the jobs of every connected client to a pool of workers """
+
+    def __init__(self, workers=None, layouts=LAYOUTS):
+        # forked workers would keep copies of the client sockets open, so
+        # closing a connection would never reach the client
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn")
+        self.pool = ProcessPoolExecutor(max_workers=workers or
+                                        os.cpu_count() or 1,
+                                        mp_context=context,
+                                        initializer=init_worker,
+                                        initargs=(layouts,))
+
+    async def handle(self, reader, writer):
+        """ Serves one client until it closes its end """
+        loop = asyncio.get_running_loop()
+        running = set()
+
+        async def run(job):
+            try:
+                result = await loop.run_in_executor(self.pool, run_job, job)
+            except Exception as e:
+                # the worker died, the job still gets an answer
+                result = {"id": job.get("id"),
+                          "error": type(e).__name__ + ": " + str(e)}
+            try:
+                writer.write(json.dumps(result).encode("utf-8") + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                # the client has gone away
+                pass
+
+        while (True):
+            line = await reader.readline()
+            if (not line):
+                break
+            if (not line.strip()):
+                continue
+            try:
+                job = json.loads(line)
+                if (not isinstance(job, dict)):
+                    raise ValueError("a job must be an object")
+            except ValueError as e:
+                writer.write(json.dumps({"error": str(e)}).encode("utf-8") +
+                             b"\n")
+                continue
+            task = asyncio.ensure_future(run(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        if (running):
+            await asyncio.wait(running)
+        writer.close()
+
+    async def start(self, path=None, port=None):
+        """ Starts listening on the Unix socket at path, or on localhost
+            at port, and returns the asyncio server
+        """
+        if (path is not None):
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, "127.0.0.1", port)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+async def serve(path=None, port=None, workers=None, layouts=LAYOUTS):
+    server = Server(workers, layouts)
+    listener = await server.start(path, port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run simulation jobs "
+                                     "sent as JSON lines")
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--layouts", type=int, default=LAYOUTS)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.socket, args.port, args.workers,
+                          args.layouts))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
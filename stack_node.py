@@ -0,0 +1,87 @@
+""" This file contains the StackNode, the T30 stack memory node.
+
+    A stack node has no code. Neighbors push onto it by MOVing a value to
+    it and pop from it by MOVing a value from it. It is passive: the
+    Scheduler never steps it, it serves the neighbors waiting on it while
+    committing each tick (see Scheduler.serve).
+
+    Values live in an array allocated when the node is made, so pushing
+    and popping never allocate.
+"""
+
+from array import array
+
+from node import Passive
+
+# how many values a T30 holds
+CAPACITY = 15
+
+
+class StackNode(Passive):
+
+    """ A stack of at most capacity values
+
+    data is the preallocated storage, the top value is data[size - 1]
+    priority lists the neighbors in the order they are served in,
+    see build_priority()
+    """
+
+    __slots__ = ("capacity", "data", "size")
+
+    def __init__(self, xpos, ypos, capacity=CAPACITY):
+        Passive.__init__(self, xpos, ypos)
+        self.capacity = capacity
+        self.data = array("q", [0]) * capacity
+        self.size = 0
+
+    def is_empty(self):
+        return self.size == 0
+
+    def is_full(self):
+        return self.size == self.capacity
+
+    def push(self, value):
+        """ Puts value on top of the stack, which must not be full """
+        self.data[self.size] = value
+        self.size += 1
+
+    def pop(self):
+        """ Takes the top value off the stack, which must not be empty """
+        self.size -= 1
+        return self.data[self.size]
+
+    def values(self):
+        """ Returns the stored values, bottom first """
+        return list(self.data[:self.size])
+
+    def fingerprint(self):
+        return tuple(self.data[:self.size])
+
+    def restore(self, values):
+        """ Puts the stack back to holding values, from fingerprint() """
+        self.size = len(values)
+        self.data[:self.size] = array("q", values)
+
+    def save_state(self, index):
+        return self.fingerprint()
+
+    def load_state(self, state, nodes):
+        self.restore(state)
+
+    def clone(self):
+        return StackNode(self.xpos, self.ypos, self.capacity)
+
+    def get_program(self):
+        """ Returns what is needed to make this node again, see
+            Node.get_program()
+        """
+        return (self.capacity,)
+
+    def set_program(self, program):
+        self.capacity = program[0]
+        self.data = array("q", [0]) * self.capacity
+        self.size = 0
+
+    def __str__(self):
+        return "Stack at (" + str(self.xpos) + "," + str(self.ypos) + ")" + \
+            " " + str(self.values())
@@ -1,6 +1,28 @@
+from array import array
+import asyncio
+import io
+import json
+import os
+import tempfile
 import unittest
-from node import Node
+from unittest import mock
+import zipfile
+from node import Node, BLOCK_MAKERS
 import main
+from scheduler import Scheduler
+from stack_node import StackNode
+import tracing
+import evaluate
+import loader
+from cache import ProgramCache
+import ports
+import benchmark
+from profiler import Profiler
+from history import History
+from visualizer import Visualizer, take_snapshot
+import server
+import fuzz
+from vector_engine import UnsupportedError, VectorEngine, run_batch
 
 
 class TestNodes(unittest.TestCase):
@@ -18,6 +40,12 @@ class TestNodes(unittest.TestCase):
         self.assertTrue(n.is_valid)
         self.assertEqual(n.code, {0: ("ADD", 1, None)})
 
+        # literals go from -999 to 999, anything bigger is invalid
+        n = Node(0, 0)
+        n.lines = ["MOV 99999999999999999999, ACC", "ADD -1000"]
+        n.parse_lines()
+        self.assertFalse(n.is_valid)
+
     def test_build_io_tables(self):
         n1 = Node(0, 0)  # upper left node
         n2 = Node(0, 1)  # lower left node
@@ -46,6 +74,23 @@ class TestNodes(unittest.TestCase):
         self.assertIsNone(n4.adjacency["RIGHT"])
         self.assertEqual(n4.adjacency["UP"], n3)
 
+    def test_load_nodes_large_coordinates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "nodes.txt")
+            with open(filename, "w") as f:
+                f.write("[10, 12]\nADD 1\n[11,12]\nNOP\n[-1,0]\n")
+            nodes = main.load_nodes(filename)
+        self.assertEqual([(n.xpos, n.ypos) for n in nodes],
+                         [(10, 12), (11, 12), (-1, 0)])
+        index = main.build_io_tables(nodes)
+        self.assertIs(index[(10, 12)], nodes[0])
+        self.assertIs(nodes[0].adjacency["RIGHT"], nodes[1])
+        self.assertIs(nodes[1].adjacency["LEFT"], nodes[0])
+        self.assertIsNone(nodes[2].adjacency["RIGHT"])
+
+        with self.assertRaises(ValueError):
+            main.build_io_tables([Node(1, 1), Node(1, 1)])
+
     def test_add_i_and_pc(self):
         n = Node(0, 0)
         n.lines = ["ADD 1", "ADD 50", "ADD -3"]
@@ -289,6 +334,263 @@ class TestNodes(unittest.TestCase):
         n0.execute_next()
         #n0 tries to move beyond the label and cannot
         self.assertEqual(n0.pc, 2)
+
+    def test_compiled_dispatch(self):
+        n = Node(0, 0)
+        n.lines = ["ADD 3", "label:", "ADD ACC", "SUB NIL", "SUB ACC"]
+        n.parse_lines()
+        self.assertTrue(n.is_valid)
+        # one entry per line, label-only lines have no entry
+        self.assertEqual(len(n.compiled), 5)
+        self.assertIsNone(n.compiled[1])
+        self.assertEqual(n.compiled[0][1], (3,))
+
+        n.execute_next()
+        n.execute_next()
+        self.assertEqual(n.acc, 6)
+        n.execute_next()
+        self.assertEqual(n.acc, 6)
+        self.assertEqual(n.pc, 4)
+        n.execute_next()
+        self.assertEqual(n.acc, 0)
+        self.assertEqual(n.pc, 0)
+
+    def test_shared_program(self):
+        nodes = main.make_grid({(0, 0): ["MOV 7, RIGHT", "top:", "JMP top"],
+                                (0, 1): ["MOV 7, RIGHT", "top:", "JMP top"],
+                                (1, 0): ["MOV LEFT, ACC", "SAV"]})
+        # nodes with the same lines share one parsed program
+        self.assertIs(nodes[0].program, nodes[1].program)
+        # which is why lines can't be changed through one of them
+        self.assertIsInstance(nodes[0].lines, tuple)
+        self.assertRaises(AttributeError, setattr, nodes[0], "extra", 1)
+        self.assertIsNot(nodes[0].program, nodes[2].program)
+        # different programs still share their compiled entries
+        other = main.make_grid({(0, 0): ["SAV", "MOV 7, RIGHT"]})[0]
+        self.assertIs(other.compiled[1], nodes[0].compiled[0])
+        for passive in (StackNode(0, 0), ports.InputPort(0, 0, [1]),
+                        ports.OutputPort(0, 0, [0])):
+            self.assertRaises(AttributeError, setattr, passive, "extra", 1)
+        self.assertEqual(nodes[2].code, {0: ("MOV", "LEFT", "ACC"),
+                                         1: ("SAV", None, None)})
+        self.assertEqual(nodes[0].neighbors, (None, nodes[2], None, nodes[1]))
+        self.assertIs(nodes[0].adjacency["DOWN"], nodes[1])
+
+        # the adjacency view writes through to neighbors
+        nodes[0].adjacency["DOWN"] = None
+        self.assertEqual(nodes[0].neighbors, (None, nodes[2], None, None))
+        Scheduler(nodes).run(3)
+        self.assertEqual((nodes[2].acc, nodes[2].bak), (7, 7))
+        self.assertEqual(nodes[0].pc, 2)
+
+    def test_pc_tables(self):
+        n = Node(0, 0)
+        n.lines = ["start:", "ADD 1", "mid:", "JRO ACC", "end:"]
+        n.parse_lines()
+        self.assertTrue(n.is_valid)
+        # every line points at the next line of code, wrapping around
+        self.assertEqual(list(n.next_pc), [1, 3, 3, 1, 1])
+        self.assertEqual(n.jump_targets, {"start": 1, "mid": 3, "end": 1})
+        # offsets past either end clamp to the first/last line
+        self.assertEqual(n.jro_target(3, 1000), 4)
+        self.assertEqual(n.jro_target(3, -1000), 0)
+        self.assertEqual(n.jro_target(3, -1), 1)
+
+    def test_port_operands(self):
+        nodes = main.make_grid({(0, 0): ["MOV 5, RIGHT", "MOV 3, RIGHT",
+                                         "MOV 2, RIGHT", "top:", "JMP top"],
+                                (1, 0): ["ADD LEFT", "SUB LEFT", "JRO LEFT",
+                                         "NEG", "SAV"]})
+        adder = nodes[1]
+        scheduler = Scheduler(nodes)
+        for i in range(3):
+            scheduler.tick()
+        # ADD waits for its operand, then adds it once it arrives
+        self.assertEqual((adder.acc, adder.pc), (5, 1))
+        for i in range(5):
+            scheduler.tick()
+        # 5 - 3, then JRO 2 skips the NEG
+        self.assertEqual((adder.acc, adder.bak), (2, 2))
+        self.assertEqual(adder.pc, 0)
+        self.assertIsNotNone(adder.receiving)
+
+    def make_mov_grid(self):
+        n1 = Node(0, 0)  # upper left node
+        n2 = Node(0, 1)  # lower left node
+        n3 = Node(1, 0)  # upper right node
+        n4 = Node(1, 1)  # lower right node
+        nodes = [n1, n2, n3, n4]
+        main.build_io_tables(nodes)
+
+        n1.lines = ["ADD 4", "MOV ACC, DOWN", "MOV RIGHT, ACC"]
+        n2.lines = ["MOV UP, ACC", "ADD 32",
+                    "JMP label", "label:", "MOV ACC, RIGHT"]
+        n4.lines = ["MOV LEFT, UP", "NOP"]
+        n3.lines = ["MOV DOWN, LEFT", "NOP"]
+        for n in nodes:
+            n.parse_lines()
+            self.assertTrue(n.is_valid)
+        return nodes
+
+    def test_scheduler_mov(self):
+        # same layout and timing as test_mov_tis_accurate
+        n1, n2, n3, n4 = nodes = self.make_mov_grid()
+        scheduler = Scheduler(nodes)
+
+        for i in range(2):
+            scheduler.tick()
+        # n1 is offering 4, n2 has yet to pick it up
+        self.assertEqual(n1.sending, n2)
+        self.assertEqual(n1.value_to_send, 4)
+        self.assertEqual(n1.pc, 1)
+        self.assertEqual(n2.acc, 0)
+
+        scheduler.tick()
+        # both ends of the mov complete in the same cycle
+        self.assertIsNone(n1.sending)
+        self.assertEqual(n1.pc, 2)
+        self.assertEqual(n2.acc, 4)
+        self.assertEqual(n2.pc, 1)
+
+        for i in range(4):
+            scheduler.tick()
+        # n4 picked up 36 from n2 and is offering it to n3
+        self.assertEqual(n2.pc, 0)
+        self.assertIsNone(n4.receiving)
+        self.assertEqual(n4.value_to_send, 36)
+        self.assertEqual(n3.receiving, n4)
+
+        for i in range(2):
+            scheduler.tick()
+        self.assertEqual(scheduler.cycle, 9)
+        self.assertEqual(n1.acc, 36)
+        self.assertEqual(n1.pc, 0)
+        self.assertEqual(n3.pc, 1)
+
+    def test_scheduler_order_independent(self):
+        forward = self.make_mov_grid()
+        backward = self.make_mov_grid()
+        s1 = Scheduler(forward)
+        s2 = Scheduler(list(reversed(backward)))
+        for i in range(25):
+            s1.tick()
+            s2.tick()
+            for a, b in zip(forward, backward):
+                self.assertEqual((a.acc, a.bak, a.pc, a.value_to_send),
+                                 (b.acc, b.bak, b.pc, b.value_to_send))
+
+    def test_scheduler_parks_blocked_nodes(self):
+        nodes = main.make_grid({(0, 0): ["MOV 5, DOWN", "NOP", "NOP", "NOP"],
+                                (0, 1): ["MOV UP, ACC", "ADD 1"]})
+        reader = nodes[1]
+        steps = []
+        step = Node.step
+
+        def counted(node):
+            if (node is reader):
+                steps.append(1)
+            return step(node)
+
+        scheduler = Scheduler(nodes)
+        with mock.patch.object(Node, "step", counted):
+            for i in range(6):
+                scheduler.tick()
+        # tick 1: start reading, tick 2: read 5, tick 3: ADD 1,
+        # tick 4: start reading again and stay parked
+        self.assertEqual(len(steps), 3)
+        self.assertEqual(reader.acc, 6)
+        self.assertIn(reader, scheduler.waiting)
+
+        # state changed by hand needs a rebuild
+        reader.receiving = None
+        scheduler.rebuild()
+        self.assertIn(reader, scheduler.runnable)
+
+    def test_fused_blocks(self):
+        n = Node(0, 0)
+        n.lines = ["MOV UP, ACC", "ADD 5", "top:", "SAV", "ADD ACC",
+                   "NEG", "SWP", "SUB NIL", "JMP top"]
+        n.parse_lines()
+        n.build_blocks()
+        function, length, end = n.blocks[1]
+        self.assertEqual((length, end), (6, 8))
+        self.assertEqual(n.blocks[3][1:], (5, 8))
+        self.assertIsNone(n.blocks[0])  # MOV is not local
+        self.assertIsNone(n.blocks[7])  # SUB NIL alone is not worth fusing
+
+        # blocks that only differ in their numbers share one maker
+        makers = len(BLOCK_MAKERS)
+        for value in range(10):
+            other = Node(0, 0)
+            other.lines = ["MOV UP, ACC", "ADD " + str(value), "top:", "SAV",
+                           "ADD ACC", "NEG", "SWP", "SUB NIL", "JMP top"]
+            other.parse_lines()
+            other.build_blocks()
+            other.acc = 1
+            other.blocks[1][0](other)
+            self.assertEqual((other.acc, other.bak), (1 + value, 1 + value))
+        self.assertEqual(len(BLOCK_MAKERS), makers)
+
+        programs = {(0, 0): ["MOV 3, DOWN", "ADD 1", "MOV ACC, DOWN"],
+                    (0, 1): ["MOV UP, ACC", "ADD 5", "SAV", "ADD ACC", "NEG",
+                             "SWP", "SUB 1", "MOV UP, ACC", "ADD ACC",
+                             "MOV ACC, DOWN"],
+                    (0, 2): ["MOV UP, ACC", "SUB 1"]}
+        plain = main.make_grid(programs)
+        fused = main.make_grid(programs)
+        s1 = Scheduler(plain)
+        s2 = Scheduler(fused, fuse=True)
+        was_busy = False
+        for i in range(40):
+            s1.tick()
+            s2.tick()
+            # the nodes around the fused one see the same timing
+            self.assertEqual(fuzz.node_states([plain[0], plain[2]]),
+                             fuzz.node_states([fused[0], fused[2]]))
+            if (fused[1].busy == 0):
+                self.assertEqual(fuzz.node_states(plain),
+                                 fuzz.node_states(fused))
+            was_busy = was_busy or fused[1].busy > 0
+        self.assertTrue(was_busy)
+
+    def test_tracing(self):
+        n1, n2, n3, n4 = nodes = self.make_mov_grid()
+        for n in nodes:
+            self.assertIsNone(n.trace)  # tracing is off by default
+
+        ring = tracing.RingBufferSink()
+        seen = []
+        tracer = tracing.Tracer(level=tracing.INFO, nodes=[(0, 1)],
+                                sinks=[ring, tracing.CallbackSink(seen.append)])
+        scheduler = Scheduler(nodes, tracer)
+        self.assertIsNone(n1.trace)
+        self.assertIs(n2.trace, tracer)
+
+        for i in range(3):
+            scheduler.tick()
+        # only n2's receive is traced, DEBUG events are filtered out
+        self.assertEqual(list(ring.records), seen)
+        self.assertEqual(seen, [tracing.TraceRecord(
+            2, "receive", 0, 1, (4, "from", (0, 0)))])
+
+        n = Node(0, 0)
+        n.lines = ["MOV 1, ACC", "ADD 1"]
+        n.parse_lines()
+        tracer = tracing.Tracer(level=tracing.DEBUG, events=["mov"])
+        tracer.attach([n])
+        n.execute_next()
+        n.execute_next()
+        self.assertEqual([r.event for r in tracer.sinks[0].records], ["mov"])
+
+        # parked nodes are not stepped, the Scheduler reports them instead
+        nodes = main.make_grid({(0, 0): ["MOV RIGHT, ACC"], (1, 0): ["NOP"]})
+        tracer = tracing.Tracer(level=tracing.DEBUG, events=["blocked"])
+        scheduler = Scheduler(nodes, tracer)
+        for i in range(4):
+            scheduler.tick()
+        self.assertEqual([(r.cycle, r.xpos, r.args)
+                          for r in tracer.sinks[0].records],
+                         [(cycle, 0, ("receiving",)) for cycle in (1, 2, 3)])
     """
     def test_send_receive(self):
         # note: this test is no longer accurate?
@@ -603,6 +905,777 @@ class TestNodes(unittest.TestCase):
         self.assertIsNone(n3.value_to_send)  # n3 no longer sending
         self.assertFalse(n3.receiving_into_acc)  # n3 not receiving into acc
 
+
+class TestVectorEngine(unittest.TestCase):
+
+    PROGRAMS = {(0, 0): ["ADD 4", "MOV ACC, DOWN", "MOV RIGHT, ACC"],
+                (0, 1): ["MOV UP, ACC", "ADD 32", "JMP label",
+                         "label:", "MOV ACC, RIGHT"],
+                (1, 0): ["MOV DOWN, LEFT", "NOP"],
+                (1, 1): ["MOV LEFT, UP", "NOP"],
+                (2, 0): ["top:", "ADD 3", "SAV", "JRO ACC", "NEG",
+                         "SUB ACC", "SWP", "JGZ top", "ADD ACC",
+                         "JLZ top", "JEZ top", "JNZ top"],
+                (2, 1): ["MOV 7, ACC", "MOV ACC, LEFT", "MOV 2, NIL",
+                         "SUB 1", "JRO -2"],
+                (3, 1): []}
+
+    def test_matches_scheduler(self):
+        reference = main.make_grid(self.PROGRAMS)
+        vectorized = main.make_grid(self.PROGRAMS)
+        scheduler = Scheduler(reference)
+        engine = VectorEngine(vectorized)
+        for i in range(60):
+            scheduler.tick()
+            engine.tick()
+            engine.write_back()
+            self.assertEqual(fuzz.node_states(reference),
+                             fuzz.node_states(vectorized))
+        self.assertEqual(engine.cycle, scheduler.cycle)
+
+    def test_unsupported_operand(self):
+        nodes = main.make_grid({(0, 0): ["ADD LEFT"]})
+        with self.assertRaises(UnsupportedError):
+            VectorEngine(nodes)
+
+    def test_run_batch(self):
+        programs = {(0, 0): ["MOV UP, ACC", "ADD ACC", "MOV ACC, RIGHT"],
+                    (1, 0): ["MOV LEFT, ACC", "SUB 1", "MOV ACC, DOWN"]}
+        values = [[1, 2, 3, 4], [5, 6, 7, 8], [-1, 0, 1, 2]]
+        inputs = {(0, 0, "UP"): values}
+        outputs = {(1, 0, "DOWN"): 4}
+
+        result = run_batch(main.make_grid(programs), inputs, outputs, 200)
+        out = result.outputs[(1, 0, "DOWN")]
+        self.assertEqual(out.tolist(),
+                         [[2 * v - 1 for v in lane] for lane in values])
+        # every lane does the same work, so they all finish together
+        self.assertEqual(len(set(result.cycles.tolist())), 1)
+        self.assertGreater(result.cycles[0], 0)
+
+        # a single lane run gives the same answer
+        single = run_batch(main.make_grid(programs),
+                           {(0, 0, "UP"): values[1:2]}, outputs, 200)
+        self.assertEqual(single.outputs[(1, 0, "DOWN")].tolist(), [out[1].tolist()])
+        self.assertEqual(single.cycles[0], result.cycles[1])
+
+        # too few cycles to finish
+        short = run_batch(main.make_grid(programs), inputs, outputs, 3)
+        self.assertEqual(short.cycles.tolist(), [-1, -1, -1])
+
+        # an output with no room never takes a value
+        nodes = main.make_grid(programs)
+        engine = VectorEngine(nodes, 3, inputs, {(1, 0, "DOWN"): 0})
+        engine.run(20)
+        engine.write_back()
+        self.assertEqual(engine.output_count[(1, 0, "DOWN")].tolist(),
+                         [0, 0, 0])
+        self.assertEqual((nodes[1].pc, nodes[1].value_to_send), (2, 1))
+
+
+class TestEvaluate(unittest.TestCase):
+
+    HALTING = "[0,0]\nMOV 1, DOWN\nMOV 2, DOWN\nJRO 0\n\n" \
+        "[0,1]\nMOV UP, ACC\nlabel:\nADD 1\nMOV UP, ACC\n"
+
+    def test_run_halts(self):
+        nodes = main.make_grid({(0, 0): ["MOV 1, DOWN", "MOV 2, DOWN",
+                                         "JRO 0"],
+                                (0, 1): ["MOV UP, ACC", "ADD 1",
+                                         "MOV UP, ACC"]})
+        scheduler = Scheduler(nodes)
+        self.assertTrue(scheduler.run(100))
+        self.assertEqual(scheduler.cycle, 5)
+        self.assertEqual(nodes[1].acc, 2)
+
+        looping = Scheduler(main.make_grid({(0, 0): ["ADD 1"]}))
+        self.assertFalse(looping.run(100))
+        self.assertEqual(looping.cycle, 100)
+
+    def test_run_fast_forward(self):
+        programs = {(0, 0): ["MOV ACC, DOWN", "MOV DOWN, ACC", "ADD 1",
+                             "SAV", "SUB 3", "JLZ skip", "SUB ACC",
+                             "skip:", "SWP", "SUB 3", "JLZ done",
+                             "SUB ACC", "done:", "ADD 3"],
+                    (0, 1): ["MOV UP, ACC", "NEG", "NOP", "MOV ACC, UP"]}
+        for cycles in (7, 50, 1001, 1234):
+            slow = main.make_grid(programs)
+            fast = main.make_grid(programs)
+            Scheduler(slow).run(cycles)
+            scheduler = Scheduler(fast)
+            scheduler.run(cycles, fast_forward=True)
+            self.assertEqual(scheduler.cycle, cycles)
+            self.assertEqual(fuzz.node_states(slow), fuzz.node_states(fast))
+
+        nodes = main.make_grid(programs)
+        scheduler = Scheduler(nodes)
+        self.assertFalse(scheduler.run(10 ** 9, fast_forward=True))
+        self.assertEqual(scheduler.cycle, 10 ** 9)
+
+    def test_evaluate_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "halting.txt"), "w") as f:
+                f.write(self.HALTING)
+            with open(os.path.join(directory, "looping.txt"), "w") as f:
+                f.write("[0,0]\nADD 1\n")
+            results = evaluate.evaluate_directory(directory, workers=2,
+                                                  max_cycles=50)
+        self.assertEqual(results, [
+            {"file": "halting.txt", "cycles": 5, "halted": True, "nodes": 2,
+             "instructions": 6, "valid": True},
+            {"file": "looping.txt", "cycles": 50, "halted": False,
+             "nodes": 1, "instructions": 1, "valid": True}])
+
+    def test_runtime_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "broken.txt")
+            with open(filename, "w") as f:
+                f.write("[0,0]\nADD 1\n")
+            with mock.patch.object(Node, "step", side_effect=TypeError("bad")):
+                result = evaluate.evaluate_file(filename)
+        # reported like a load error, rather than raised out of the pool
+        self.assertEqual(result, {"file": "broken.txt",
+                                  "error": "TypeError: bad"})
+
+    def test_load_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "invalid.txt")
+            with open(filename, "w") as f:
+                f.write("[0,0]\nADD 1 2\n")
+            with mock.patch.object(evaluate, "load_nodes",
+                                   side_effect=OverflowError("big")):
+                result = evaluate.evaluate_file(filename)
+            self.assertEqual(result, {"file": "invalid.txt",
+                                      "error": "OverflowError: big"})
+            # stdout is left to the JSON summary
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as out:
+                result = evaluate.evaluate_file(filename)
+            self.assertFalse(result["valid"])
+            self.assertEqual(out.getvalue(), "")
+
+
+class TestLoader(unittest.TestCase):
+
+    SAVE = "@0\nMOV UP, ACC  # read\nLOOP: SUB 1\n!JGZ LOOP\n\n" \
+        "@1\n\n@2\nMOV LEFT,ACC\n"
+
+    def test_iter_nodes_streams(self):
+        read = []
+
+        def lines():
+            for line in ["[0,0]", "ADD 1", "[1,0]", "NOP"]:
+                read.append(line)
+                yield line
+
+        nodes = loader.iter_nodes(lines())
+        first = next(nodes)
+        self.assertEqual((first.xpos, first.ypos), (0, 0))
+        self.assertEqual(first.code, {0: ("ADD", 1, None)})
+        # the first node comes out before the rest of the input is read
+        self.assertEqual(read, ["[0,0]", "ADD 1", "[1,0]"])
+        self.assertEqual(len(list(nodes)), 1)
+
+    def test_parse_errors(self):
+        with self.assertRaises(loader.ParseError) as caught:
+            list(loader.iter_nodes(["[0,0]", "ADD 1", "  [1,x]"], "f.txt"))
+        self.assertEqual((caught.exception.line, caught.exception.column),
+                         (3, 3))
+        self.assertTrue(str(caught.exception).startswith("f.txt:3:3:"))
+
+        with self.assertRaises(loader.ParseError) as caught:
+            list(loader.iter_nodes(["[0,0]", "ADD 1", "MUL 2"], strict=True))
+        self.assertEqual(caught.exception.line, 3)
+
+        with self.assertRaises(loader.ParseError):
+            list(loader.iter_nodes(["ADD 1"]))
+
+    def test_save_format(self):
+        nodes = list(loader.iter_save_nodes(self.SAVE.splitlines(True)))
+        # @1 has no code and is left out, @2 is the third node of the row
+        self.assertEqual([(n.xpos, n.ypos) for n in nodes], [(0, 0), (2, 0)])
+        self.assertEqual(nodes[0].lines,
+                         ("MOV UP ACC", "LOOP:", "SUB 1", "JGZ LOOP"))
+        self.assertTrue(all(n.is_valid for n in nodes))
+        self.assertEqual(nodes[1].code, {0: ("MOV", "LEFT", "ACC")})
+
+        self.assertEqual(loader.save_position(4), (0, 1))
+        self.assertEqual(loader.save_position(4, broken=[(1, 0)]), (1, 1))
+
+    def test_iter_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "solutions.zip")
+            with zipfile.ZipFile(path, "w") as archive:
+                archive.writestr("a.txt", self.SAVE)
+                archive.writestr("b.txt", "[0,0]\nADD 1\n")
+            solutions = list(loader.iter_archive(path))
+        self.assertEqual([name for name, nodes in solutions],
+                         ["a.txt", "b.txt"])
+        self.assertEqual([len(nodes) for name, nodes in solutions], [2, 1])
+
+
+class TestProgramCache(unittest.TestCase):
+
+    def test_load_layout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "layout.txt")
+            with open(filename, "w") as f:
+                f.write(TestEvaluate.HALTING)
+            cache = ProgramCache(os.path.join(directory, "cache"))
+
+            parsed = cache.load_layout(filename)
+            cached = cache.load_layout(filename)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertIsNot(parsed[0], cached[0])
+            for a, b in zip(parsed, cached):
+                self.assertEqual(a.get_program(), b.get_program())
+            self.assertIs(cached[0].adjacency["DOWN"], cached[1])
+            self.assertIsNone(cached[0].adjacency["UP"])
+
+            scheduler = Scheduler(cached)
+            self.assertTrue(scheduler.run(100))
+            self.assertEqual(scheduler.cycle, 5)
+
+    def test_invalid_layout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "layout.txt")
+            with open(filename, "w") as f:
+                f.write("[0,0]\nADD 1\nA:\nA:\nJMP A\n")
+            cache = os.path.join(directory, "cache")
+            parsed = evaluate.evaluate_file(filename)
+            self.assertEqual((parsed["valid"], parsed["cycles"]), (False, 0))
+            # a cache hit loads the program exactly as it was parsed
+            for i in range(2):
+                self.assertEqual(evaluate.evaluate_file(filename,
+                                                        cache_dir=cache),
+                                 parsed)
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ProgramCache(directory, max_bytes=0)
+            nodes = main.make_grid({(0, 0): ["ADD 1"]})
+            cache.store("[0,0]\nADD 1\n", nodes)
+            # nothing fits in a zero byte cache
+            self.assertIsNone(cache.load("[0,0]\nADD 1\n"))
+
+            cache.max_bytes = 1024 * 1024
+            cache.store("[0,0]\nADD 1\n", nodes)
+            self.assertEqual(len(cache.load("[0,0]\nADD 1\n")), 1)
+
+
+class TestStackNode(unittest.TestCase):
+
+    LAYOUT = "[0,0]\nMOV 1, RIGHT\nMOV 2, RIGHT\nMOV 3, RIGHT\n" \
+        "MOV RIGHT, DOWN\nMOV RIGHT, DOWN\nMOV RIGHT, DOWN\nJRO 0\n" \
+        "[1,0] STACK\n[0,1]\nMOV UP, ACC\n"
+
+    def run_layout(self, nodes, cycles):
+        """ Runs nodes, returning the values received at (0, 1) """
+        seen = []
+        tracer = tracing.Tracer(events=["receive"], nodes=[(0, 1)],
+                                sinks=[tracing.CallbackSink(seen.append)])
+        Scheduler(nodes, tracer).run(cycles)
+        return [record.args[0] for record in seen]
+
+    def test_push_pop(self):
+        stack = StackNode(0, 0, capacity=2)
+        data = stack.data
+        self.assertTrue(stack.is_empty())
+        stack.push(5)
+        stack.push(-7)
+        self.assertTrue(stack.is_full())
+        self.assertEqual(stack.values(), [5, -7])
+        self.assertEqual((stack.pop(), stack.pop()), (-7, 5))
+        self.assertTrue(stack.is_empty())
+        # the storage is allocated once
+        self.assertIs(stack.data, data)
+        # the empty code every passive node shares cannot be changed
+        self.assertIs(stack.code, ports.InputPort(0, 1, []).code)
+        with self.assertRaises(TypeError):
+            stack.code[0] = ("NOP", None, None)
+
+    def test_scheduler(self):
+        nodes = list(loader.iter_nodes(self.LAYOUT.splitlines()))
+        self.assertIsInstance(nodes[1], StackNode)
+        main.build_io_tables(nodes)
+        self.assertEqual(nodes[1].priority, (nodes[0],))
+        self.assertEqual(self.run_layout(nodes, 50), [3, 2, 1])
+        self.assertTrue(nodes[1].is_empty())
+
+        # a full stack blocks the next push until a value is popped
+        nodes = list(loader.iter_nodes(self.LAYOUT.splitlines()))
+        nodes[1].set_program((2,))
+        main.build_io_tables(nodes)
+        scheduler = Scheduler(nodes)
+        self.assertTrue(scheduler.run(50))
+        self.assertEqual(nodes[1].values(), [1, 2])
+        self.assertEqual(nodes[0].pc, 2)
+
+    def test_load(self):
+        with self.assertRaises(loader.ParseError):
+            list(loader.iter_nodes(["[0,0] STACK", "ADD 1"]))
+        with self.assertRaises(loader.ParseError):
+            list(loader.iter_nodes(["[0,0] T99"]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "layout.txt")
+            with open(filename, "w") as f:
+                f.write(self.LAYOUT)
+            cache = ProgramCache(directory)
+            cache.load_layout(filename)
+            nodes = cache.load_layout(filename)
+        self.assertEqual(cache.hits, 1)
+        self.assertIsInstance(nodes[1], StackNode)
+        self.assertEqual(self.run_layout(nodes, 50), [3, 2, 1])
+
+        with self.assertRaises(UnsupportedError):
+            VectorEngine(nodes)
+
+
+class PortGrid(object):
+
+    """ Mixin for the tests running a node between two ports """
+
+    def make_grid(self, values, output):
+        """ Returns a node adding 1 to what it reads, fed from above
+            and written out below
+        """
+        nodes = main.make_grid({(0, 0): ["MOV UP, ACC", "ADD 1",
+                                         "MOV ACC, DOWN"]})
+        pipes = [ports.InputPort(0, -1, values), output]
+        main.update_output_table(nodes, pipes)
+        return nodes + pipes
+
+
+class TestPorts(PortGrid, unittest.TestCase):
+
+    def test_array_output(self):
+        out = array("q", [0]) * 3
+        nodes = self.make_grid(iter([1, 2, 3, 4]), ports.OutputPort(0, 1, out))
+        self.assertIs(nodes[0].adjacency["UP"], nodes[1])
+        self.assertIs(nodes[2].adjacency["UP"], nodes[0])
+        scheduler = Scheduler(nodes)
+        # the output fills up and the grid blocks on the fourth value
+        self.assertTrue(scheduler.run(100, fast_forward=True))
+        self.assertEqual(list(out), [2, 3, 4])
+        self.assertEqual((nodes[1].count, nodes[2].count), (4, 3))
+
+        with self.assertRaises(ValueError):
+            main.update_output_table(nodes[:1], [ports.InputPort(5, 5, [])])
+        # an output writes to an array or to a file, not both or neither
+        self.assertRaises(ValueError, ports.OutputPort, 0, 1)
+        with tempfile.TemporaryFile() as f:
+            self.assertRaises(ValueError, ports.OutputPort, 0, 1, out, f)
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "in.bin")
+            with open(source, "wb") as f:
+                array("q", range(1000)).tofile(f)
+            result = os.path.join(directory, "out.bin")
+            output = ports.OutputPort(0, 1, file=result, chunk=64)
+            nodes = self.make_grid(ports.read_binary(source, chunk=100),
+                                   output)
+            self.assertTrue(Scheduler(nodes).run(100000))
+            output.close()
+            self.assertEqual(list(ports.read_memmap(result)),
+                             list(range(1, 1001)))
+
+            text = os.path.join(directory, "in.txt")
+            with open(text, "w") as f:
+                f.write("5\n\n-2\n")
+            self.assertEqual(list(ports.read_text(text)), [5, -2])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        workloads = {"pipeline": (lambda: benchmark.pipeline(5), 20),
+                     "io": (lambda: benchmark.io_chain(3, 10), 100)}
+        results = benchmark.run_benchmarks(workloads, repeat=1)
+        self.assertEqual(results["pipeline"]["cycles"], 20)
+        for result in results.values():
+            self.assertGreater(result["instructions_per_sec"], 0)
+            self.assertGreater(result["peak_bytes"], 0)
+
+        baseline = dict((name, {"cycles_per_sec": result["cycles_per_sec"]})
+                        for name, result in results.items())
+        self.assertEqual(benchmark.compare(results, baseline), [])
+        baseline["io"]["cycles_per_sec"] *= 2
+        self.assertEqual(benchmark.compare(results, baseline), ["io"])
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_counters(self):
+        nodes = main.make_grid({(0, 0): ["ADD 1", "SAV", "MOV ACC, RIGHT"],
+                                (1, 0): ["MOV LEFT, ACC", "NOP", "NOP", "NOP",
+                                         "NOP"]})
+        profile = Profiler(nodes)
+        Scheduler(nodes, profiler=profile).run(30)
+        self.assertEqual(profile.cycles, 30)
+        self.assertEqual(profile.opcode_counts(nodes[0]),
+                         {"ADD": 7, "SAV": 6, "MOV": 6})
+        self.assertEqual(list(profile.lines), [7, 6, 6, 6, 6, 5, 5, 5])
+        # (0,0) waits on (1,0)'s NOPs, which waits on (0,0) at the start
+        self.assertEqual((profile.send_stalls[0], profile.receive_stalls[1]),
+                         (5, 3))
+        self.assertAlmostEqual(profile.idle_percent(nodes[1]), 10.0)
+        executed, node, line_num = profile.hottest_lines(1)[0]
+        self.assertEqual((executed, node, line_num), (7, nodes[0], 0))
+        self.assertIn("(0,0)   0: ADD 1", profile.report())
+
+        # a fused block counts every instruction in it when it starts
+        nodes = main.make_grid({(0, 0): ["top:", "ADD 1", "SAV", "NEG",
+                                         "JMP top"]})
+        profile = Profiler(nodes)
+        Scheduler(nodes, fuse=True, profiler=profile).run(40)
+        self.assertEqual(list(profile.lines), [0, 10, 10, 10, 9])
+
+
+class TestRunUntil(PortGrid, unittest.TestCase):
+
+    def test_conditions(self):
+        grid = self.make_grid
+        nodes = grid(range(100), ports.OutputPort(0, 1, [0] * 100))
+        result = Scheduler(nodes).run_until(10000, outputs=5)
+        self.assertEqual((result.reason, result.outputs), ("outputs", 5))
+        self.assertEqual(result.state[(0, 0)], (5, 0, 0))
+
+        scheduler = Scheduler(grid(range(100), ports.OutputPort(0, 1, [0])))
+        result = scheduler.run_until(10000, predicate=lambda s: s.cycle == 3)
+        self.assertEqual((result.reason, result.cycles), ("predicate", 3))
+        # the output fills up after one value
+        result = scheduler.run_until(10000, outputs=2)
+        self.assertEqual((result.reason, result.outputs), ("halted", 1))
+
+        result = Scheduler(grid([], ports.OutputPort(0, 1, []))).run_until(50)
+        self.assertEqual((result.reason, result.halted), ("halted", True))
+        result = Scheduler(main.make_grid({(0, 0): ["ADD 1"]})).run_until(50)
+        self.assertEqual((result.reason, result.cycles), ("cycles", 50))
+
+    def test_run_headless(self):
+        with tempfile.TemporaryDirectory() as directory:
+            layout = os.path.join(directory, "layout.txt")
+            with open(layout, "w") as f:
+                f.write("[0,0]\nMOV UP, ACC\nNEG\nMOV ACC, DOWN\n")
+            source = os.path.join(directory, "in.txt")
+            with open(source, "w") as f:
+                f.write("1\n2\n3\n")
+            output = os.path.join(directory, "out.bin")
+            result = main.run_headless(layout, 1000, [(0, -1, source)],
+                                       [(0, 1, output)])
+            self.assertTrue(result.halted)
+            self.assertEqual(list(ports.read_binary(output)), [-1, -2, -3])
+
+
+class TestVisualizer(unittest.TestCase):
+
+    def test_draws_changes(self):
+        nodes = main.make_grid({(0, 0): ["ADD 1", "MOV ACC, RIGHT"],
+                                (1, 0): ["MOV LEFT, ACC"]})
+        scheduler = Scheduler(nodes)
+        view = Visualizer(nodes, stream=io.StringIO())
+        first = view.diff(take_snapshot(scheduler))
+        self.assertIn("(1,0) RUN", first)
+        # nothing changed, nothing is drawn
+        self.assertEqual(view.diff(take_snapshot(scheduler)), "")
+        scheduler.tick()
+        self.assertIn("ACC 1 BAK 0", view.diff(take_snapshot(scheduler)))
+        scheduler.tick()
+        # (1,0) is still waiting to read, only (0,0) is redrawn
+        second = view.diff(take_snapshot(scheduler))
+        self.assertIn("(0,0) WRTE", second)
+        self.assertNotIn("(1,0)", second)
+
+        view = Visualizer(nodes, fps=1000, stream=io.StringIO())
+        view.start()
+        scheduler.run_until(20000, predicate=view.capture)
+        view.stop(scheduler)
+        self.assertIn("cycle 20000", view.stream.getvalue())
+
+
+class TestServer(unittest.TestCase):
+
+    LAYOUT = "[0,0]\nMOV UP, ACC\nADD 1\nMOV ACC, DOWN\n"
+
+    def test_layout_cache(self):
+        layouts = server.LayoutCache(size=1)
+        first = layouts.nodes(self.LAYOUT)
+        second = layouts.nodes(self.LAYOUT)
+        self.assertIsNot(first[0], second[0])
+        self.assertEqual((layouts.hits, layouts.misses), (1, 1))
+        layouts.nodes("[0,0]\nNOP\n")
+        layouts.nodes(self.LAYOUT)
+        self.assertEqual(layouts.misses, 3)
+
+    def test_jobs(self):
+        job = {"layout": self.LAYOUT, "inputs": [[0, -1, [1, 2, 3]]],
+               "outputs": [[0, 1, 2]]}
+
+        async def talk(path):
+            service = server.Server(workers=1)
+            listener = await service.start(path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            for i in range(3):
+                writer.write(json.dumps(dict(job, id=i)).encode() + b"\n")
+            writer.write(b"not json\n")
+            writer.write(json.dumps({"id": 3, "layout": "[0"}).encode() +
+                         b"\n")
+            writer.write_eof()
+            lines = [json.loads(line) async for line in reader]
+            listener.close()
+            await listener.wait_closed()
+            service.close()
+            return lines
+
+        with tempfile.TemporaryDirectory() as directory:
+            results = asyncio.run(talk(os.path.join(directory, "socket")))
+        self.assertEqual(len(results), 5)
+        errors = [result for result in results if "error" in result]
+        self.assertEqual(sorted(str(error.get("id")) for error in errors),
+                         ["3", "None"])
+        done = sorted((result for result in results if "error" not in result),
+                      key=lambda result: result["id"])
+        self.assertEqual([result["id"] for result in done], [0, 1, 2])
+        for result in done:
+            self.assertEqual(result["values"], [[2, 3]])
+            self.assertEqual(result["reason"], "outputs")
+
+
+class TestAnyPort(unittest.TestCase):
+
+    def test_any_fan_in(self):
+        nodes = main.make_grid({(0, 0): ["MOV 1, RIGHT", "JRO 0"],
+                                (1, 0): ["MOV ANY, DOWN"],
+                                (2, 0): ["MOV 2, LEFT", "JRO 0"]})
+        output = ports.OutputPort(1, 1, [0] * 2)
+        main.update_output_table(nodes, [output])
+        self.assertEqual(nodes[1].priority, (nodes[0], nodes[2], output))
+        Scheduler(nodes + [output]).run(20)
+        # LEFT comes before RIGHT when both offer
+        self.assertEqual(list(output.values), [1, 2])
+        # LAST is where the last ANY went, DOWN is not ANY
+        self.assertIs(nodes[1].last, nodes[2])
+
+    def test_any_fan_out(self):
+        nodes = main.make_grid({(0, 1): ["MOV RIGHT, ACC", "JRO 0"],
+                                (1, 0): ["MOV DOWN, ACC", "JRO 0"],
+                                (1, 1): ["MOV 5, ANY", "JRO 0"]})
+        left, up, writer = nodes
+        self.assertEqual(writer.write_priority, (up, left))
+        Scheduler(nodes).run(10)
+        # writes try UP before LEFT, unlike reads
+        self.assertEqual((up.acc, left.acc, left.pc), (5, 0, 0))
+        self.assertIs(writer.last, up)
+
+    def test_last(self):
+        programs = {(0, 0): ["MOV 1, RIGHT", "MOV RIGHT, ACC", "JRO 0"],
+                    (1, 0): ["MOV ANY, ACC", "ADD 10", "MOV ACC, LAST"],
+                    (2, 0): ["MOV 2, LEFT", "MOV LEFT, ACC", "JRO 0"]}
+        nodes = main.make_grid(programs)
+        Scheduler(nodes).run(100)
+        self.assertEqual([n.acc for n in nodes], [11, 12, 12])
+        self.assertIs(nodes[1].last, nodes[2])
+        # settling does not depend on the order of the node list
+        others = main.make_grid(programs)
+        Scheduler(others[::-1]).run(100)
+        self.assertEqual([(n.acc, n.pc, n.last.xpos) for n in others[1:2]],
+                         [(12, 0, 2)])
+
+        # before any ANY, LAST reads and writes like NIL
+        n = main.make_grid({(0, 0): ["ADD 5", "MOV LAST, ACC", "MOV 3, LAST",
+                                     "ADD 1", "JRO 0"]})[0]
+        Scheduler([n]).run(10)
+        self.assertEqual(n.acc, 1)
+        self.assertIsNone(n.last)
+
+        # MOV ANY, LAST sends back to where the value came from
+        nodes = main.make_grid({(0, 0): ["MOV 1, RIGHT", "MOV RIGHT, ACC",
+                                         "JRO 0"],
+                                (1, 0): ["MOV ANY, LAST"],
+                                (2, 0): ["NOP", "MOV 2, LEFT", "MOV LEFT, ACC",
+                                         "JRO 0"]})
+        Scheduler(nodes).run(100)
+        self.assertEqual([n.acc for n in nodes], [1, 0, 2])
+        self.assertIs(nodes[1].last, nodes[2])
+
+    def test_any_with_stack(self):
+        nodes = main.make_grid({(0, 0): ["MOV 4, ANY", "MOV 5, ANY", "JRO 0"],
+                                (2, 0): ["MOV ANY, ACC", "JRO 0"]})
+        stack = StackNode(1, 0)
+        grid = nodes + [stack]
+        main.build_io_tables(grid)
+        Scheduler(grid).run(20)
+        # a value pushed in a tick is only popped from the next one on
+        self.assertEqual(nodes[1].acc, 4)
+        self.assertEqual(stack.values(), [5])
+        self.assertIs(nodes[0].last, stack)
+        self.assertRaises(UnsupportedError, VectorEngine, nodes)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def make_grid(self, values):
+        nodes = main.make_grid({(0, 0): ["MOV LEFT, ACC", "ADD ACC",
+                                         "MOV ACC, DOWN"],
+                                (0, 1): ["MOV UP, ANY"],
+                                (1, 1): ["MOV ANY, ACC", "SUB 1",
+                                         "MOV ACC, RIGHT"]})
+        # what (1, 1) is too busy to take from (0, 1) goes on the stack
+        grid = nodes + [StackNode(0, 2)]
+        main.build_io_tables(grid)
+        pipes = [ports.InputPort(-1, 0, values),
+                 ports.OutputPort(2, 1, [0] * 20)]
+        main.update_output_table(grid, pipes)
+        return grid + pipes
+
+    def test_restore(self):
+        grid = self.make_grid(range(1, 40))
+        scheduler = Scheduler(grid)
+        scheduler.run(30)
+        snapshot = scheduler.snapshot()
+        self.assertEqual(snapshot.cycle, 30)
+        self.assertEqual(hash(snapshot), hash(scheduler.snapshot()))
+        scheduler.run(90)
+        later = scheduler.snapshot()
+        values = list(grid[-1].values)
+
+        scheduler.restore(snapshot)
+        self.assertEqual(scheduler.snapshot(), snapshot)
+        scheduler.run(90)
+        self.assertEqual(scheduler.snapshot(), later)
+        self.assertEqual(list(grid[-1].values), values)
+        self.assertEqual(values[:4], [1, 3, 5, 7])
+        self.assertEqual(grid[3].values(), [44])
+
+    def test_fork(self):
+        scheduler = Scheduler(self.make_grid(range(1, 40)))
+        scheduler.run(30)
+        snapshot = scheduler.snapshot()
+        first = scheduler.fork()
+        second = scheduler.fork(snapshot)
+        first.run(90)
+        self.assertEqual(second.snapshot(), snapshot)
+        second.run(90)
+        scheduler.run(90)
+        self.assertEqual(first.snapshot(), scheduler.snapshot())
+        self.assertEqual(second.snapshot(), scheduler.snapshot())
+        # the copies share programs but not state
+        self.assertIs(first.nodes[0].program, scheduler.nodes[0].program)
+        self.assertIsNot(first.nodes[-1].values, scheduler.nodes[-1].values)
+
+        # an input reading an iterator cannot be gone through again
+        scheduler = Scheduler(self.make_grid(iter(range(1, 40))))
+        snapshot = scheduler.snapshot()
+        scheduler.run(30)
+        self.assertRaises(ValueError, scheduler.restore, snapshot)
+        self.assertRaises(ValueError, scheduler.fork)
+
+    def test_history(self):
+        scheduler = Scheduler(self.make_grid(range(1, 40)))
+        expected = [scheduler.snapshot()]
+        while (scheduler.cycle < 100):
+            scheduler.tick()
+            expected.append(scheduler.snapshot())
+
+        scheduler = Scheduler(self.make_grid(range(1, 40)))
+        history = History(scheduler, depth=50, interval=8)
+        scheduler.run(100)
+        self.assertEqual(len(history.frames), 50)
+        self.assertEqual(history.oldest(), 50)
+        for cycle in range(99, 89, -1):
+            self.assertTrue(history.step_back())
+            self.assertEqual(scheduler.snapshot(), expected[cycle])
+        history.seek(61)
+        self.assertEqual(scheduler.snapshot(), expected[61])
+        self.assertRaises(ValueError, history.seek, 49)
+        # going forward runs the grid again and records it
+        history.seek(100)
+        self.assertEqual(scheduler.snapshot(), expected[100])
+        history.seek(50)
+        self.assertEqual(scheduler.snapshot(), expected[50])
+        while (history.step_back()):
+            pass
+        self.assertEqual(scheduler.cycle, 50)
+
+        # the tick that finds the grid halted is not kept
+        node = main.make_grid({(0, 0): ["ADD 1", "ADD 1", "JRO 0"]})[0]
+        scheduler = Scheduler([node])
+        history = History(scheduler)
+        self.assertTrue(scheduler.run(10))
+        self.assertEqual((scheduler.cycle, node.acc, node.pc), (2, 2, 2))
+        self.assertTrue(history.step_back())
+        self.assertEqual((scheduler.cycle, node.acc, node.pc), (1, 1, 1))
+        self.assertFalse(scheduler.halted)
+
+
+class TestFuzz(unittest.TestCase):
+
+    def test_random_case(self):
+        operands = set()
+        passives = set()
+        for seed in range(50):
+            case = fuzz.random_case(fuzz.random.Random(seed))
+            self.assertTrue(fuzz.is_valid(case.programs))
+            # every port is next to exactly one node
+            fuzz.build(case)
+            passives.update(name for name in ("stacks", "inputs", "outputs")
+                            if getattr(case, name))
+            for lines in case.programs.values():
+                for line in lines:
+                    if (not line.endswith(":")):
+                        words = line.replace(",", "").split()
+                        self.assertEqual(len(words),
+                                         Node.VALID_INSTRUCTIONS[words[0]])
+                        if (words[0] in fuzz.ARITHMETIC):
+                            operands.add(words[1])
+        # ADD, SUB and JRO read ports too
+        self.assertTrue(operands.issuperset(("LEFT", "ANY", "LAST")))
+        self.assertEqual(passives, set(("stacks", "inputs", "outputs")))
+
+    def test_engines_agree(self):
+        self.assertEqual(fuzz.check_cases(0, 30, cycles=50), [])
+        # the vector engine wraps around past 64 bits, which is not a bug
+        case = fuzz.Case({(0, 0): ("ADD 3", "ADD ACC")}, 200)
+        self.assertTrue(fuzz.overflows(case))
+        self.assertEqual(fuzz.check_case(case), [])
+
+    def test_ports(self):
+        case = fuzz.Case({(0, 0): ("MOV UP, ACC", "ADD 1", "MOV ACC, DOWN"),
+                          (1, 0): ("MOV 7, LEFT",)}, 20, inputs=(
+                              ((0, -1), (1, 2, 3)),), outputs=(((0, 1), 2),))
+        self.assertEqual(fuzz.vector_ports(case),
+                         ({(0, 0, "UP"): [(1, 2, 3)]}, {(0, 0, "DOWN"): 2}))
+        expected = fuzz.run_tick(case)
+        # the output is full, so the last value read has nowhere to go
+        self.assertEqual(expected[2:], [3, (2, 3)])
+        self.assertEqual(fuzz.run_vector(case), expected)
+        self.assertEqual(fuzz.check_case(case), [])
+        # stacks keep the vector engine out
+        stacked = case._replace(stacks=((1, 0),), programs={
+            (0, 0): ("MOV UP, RIGHT", "MOV RIGHT, DOWN")})
+        self.assertEqual(fuzz.run_history(stacked), fuzz.run_tick(stacked))
+        self.assertRaises(UnsupportedError, fuzz.run_vector, stacked)
+        self.assertEqual(fuzz.check_case(stacked), [])
+        self.assertEqual(fuzz.format_case(stacked).split("\n")[-4:],
+                         ["[1,0] STACK", "", "input at 0,-1: 1 2 3",
+                          "output at 0,1: room for 2"])
+
+    def test_shrink(self):
+        def broken(case):
+            # gets ACC wrong once it is past 3
+            return [state and (state[0] + (state[0] > 3),) + state[1:]
+                    for state in fuzz.run_tick(case)]
+        case = fuzz.Case({(0, 0): ("ADD 1", "MOV ACC, RIGHT"),
+                          (1, 0): ("MOV LEFT, ACC", "L0:", "ADD 2",
+                                   "JMP L0")}, 40)
+        self.assertTrue(fuzz.fails(case, "broken", broken))
+        small = fuzz.shrink(case, "broken", broken)
+        self.assertTrue(fuzz.fails(small, "broken", broken))
+        self.assertEqual(small, fuzz.Case({(1, 0): ("ADD 2",)}, 2))
+        self.assertEqual(fuzz.format_case(small), "[1,0]\nADD 2\n")
+
+
 """
     def test_mov_with_delay(self):
         n1 = Node(0, 0)  # upper left node
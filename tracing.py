@@ -0,0 +1,129 @@
+""" This file contains the trace facility used to see what nodes are
+    doing while they run.
+
+    Nodes hold a reference to a Tracer in node.trace, which is None when
+    tracing is off, so a disabled trace costs a single attribute check.
+    A Tracer filters by level, event and node, and hands each record to
+    its sinks:
+        RingBufferSink keeps the last few records in memory
+        FileSink writes one line per record to a file
+        CallbackSink calls a function with every record
+        PrintSink prints every record (this is what full_debug used to do)
+"""
+
+from collections import deque, namedtuple
+
+# levels, an event is traced when its level is <= the tracer's level
+OFF = 0
+INFO = 1
+DEBUG = 2
+
+# events and the level they are traced at
+EVENT_LEVELS = {"send": INFO,       # a node handed a value over
+                "receive": INFO,    # a node picked a value up
+                "mov": DEBUG,       # a node started a MOV
+                "execute": DEBUG,   # a node ran the instruction at pc
+                "blocked": DEBUG}   # a node waited on a MOV for a cycle
+
+TraceRecord = namedtuple("TraceRecord", "cycle event xpos ypos args")
+
+
+def format_record(record):
+    """ Turns a record into a line of text """
+    return "[" + str(record.cycle) + "] (" + str(record.xpos) + "," + \
+        str(record.ypos) + ") " + record.event + " " + \
+        " ".join(str(arg) for arg in record.args)
+
+
+class Tracer(object):
+
+    """ Collects trace records from nodes
+
+    level is the most detailed level to trace (INFO or DEBUG)
+    events is a collection of event names to trace, None for every event
+    nodes is a collection of (x, y) positions to trace, None for every node
+    sinks is a list of sinks that are given every record
+
+    cycle is stamped onto every record, the Scheduler keeps it up to date
+    """
+
+    def __init__(self, level=INFO, events=None, nodes=None, sinks=None):
+        self.level = level
+        self.events = set(event for event, event_level in EVENT_LEVELS.items()
+                          if (event_level <= level and
+                              (events is None or event in events)))
+        self.nodes = None if nodes is None else set(nodes)
+        self.sinks = list(sinks) if sinks else [RingBufferSink()]
+        self.cycle = 0
+
+    def attach(self, nodes):
+        """ Points every node that passes the node filter at this tracer,
+            the rest are not traced at all
+        """
+        for node in nodes:
+            if (self.events and (self.nodes is None or
+                                 (node.xpos, node.ypos) in self.nodes)):
+                node.trace = self
+            else:
+                node.trace = None
+
+    def emit(self, event, node, *args):
+        """ Records event for node, args are the details of the event """
+        if (event not in self.events):
+            return
+        record = TraceRecord(self.cycle, event, node.xpos, node.ypos, args)
+        for sink in self.sinks:
+            sink.write(record)
+
+
+class RingBufferSink(object):
+
+    """ Keeps the most recent size records in memory """
+
+    def __init__(self, size=1024):
+        self.records = deque(maxlen=size)
+
+    def write(self, record):
+        self.records.append(record)
+
+
+class FileSink(object):
+
+    """ Writes a line for every record to file, which is either a path
+    or an open file object
+    """
+
+    def __init__(self, file):
+        if (isinstance(file, str)):
+            file = open(file, "a")
+        self.file = file
+
+    def write(self, record):
+        self.file.write(format_record(record) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink(object):
+
+    """ Calls callback(record) for every record """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, record):
+        self.callback(record)
+
+
+class PrintSink(object):
+
+    """ Prints every record """
+
+    def write(self, record):
+        print(format_record(record))
+
+
+def full_debug(nodes=None):
+    """ Returns a tracer that prints everything, for nodes if given """
+    return Tracer(level=DEBUG, nodes=nodes, sinks=[PrintSink()])
@@ -0,0 +1,493 @@
+""" This file contains the VectorEngine, an alternative to the Scheduler
+    that keeps the state of a whole grid in NumPy arrays.
+
+    Every node's program is compiled into rows of a few 2D tables
+    (opcode, argument, jump target, next pc, ...) indexed by
+    [column, line]. Each tick looks up the opcode every running node is on
+    and advances all nodes running the same opcode with one vectorized
+    operation, then commits the MOV transfers the same way the Scheduler
+    does: a read succeeds if the value was on offer at the start of the
+    tick.
+
+    The engine starts from the state of the Node objects it is given and
+    write_back() copies its state into them again.
+
+    Lanes: the engine can run the same grid on many independent copies of
+    its state at once, for example to try a solution against thousands of
+    input sets. Every state array is laid out lane after lane, so a lane
+    is just a block of the same flat axis and the per-opcode operations
+    cover every lane in one go. run_batch() wraps this up.
+
+    Ports: inputs and outputs are streams attached to the unconnected side
+    of a node, keyed by (x, y, direction). Each port gets a column of its
+    own next to the nodes: an input port offers its next value to its node
+    and an output port is always reading from its node.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# opcodes of the compiled tables
+LABEL = 0
+NOP = 1
+ADD = 2
+SUB = 3
+ADD_ACC = 4
+SUB_ACC = 5
+NEG = 6
+SAV = 7
+SWP = 8
+JMP = 9
+JEZ = 10
+JNZ = 11
+JLZ = 12
+JGZ = 13
+JRO_ACC = 14
+HOLD = 15  # an instruction that never completes, the node stays on it
+MOV = 16
+
+# kinds of MOV operands
+IMM = 0      # src only, the value is in arg (NIL is an immediate 0)
+NIL = 0      # dst only
+ACC = 1
+PORT = 2     # the neighbor index is in src_node/dst_node
+MISSING = 3  # a port with no node on the other side
+
+ARITHMETIC = {"ADD": (ADD, ADD_ACC), "SUB": (SUB, SUB_ACC)}
+JUMPS = {"JMP": JMP, "JEZ": JEZ, "JNZ": JNZ, "JLZ": JLZ, "JGZ": JGZ}
+SIMPLE = {"NOP": NOP, "NEG": NEG, "SAV": SAV, "SWP": SWP}
+
+
+class UnsupportedError(ValueError):
+
+    """ A grid the VectorEngine cannot run, only the Scheduler runs it """
+
+
+class VectorEngine(object):
+
+    """ Runs a list of parsed nodes with build_io_tables() already applied
+
+    lanes is the number of independent copies of the grid state
+    inputs maps (x, y, direction) to a (lanes, length) array of values fed
+        into the node at (x, y) from that side
+    outputs maps (x, y, direction) to the number of values to collect per
+        lane from the node at (x, y) on that side, they end up in
+        output_values[key], a (lanes, count) array, with output_count[key]
+        saying how many each lane has written so far
+
+    The state arrays are indexed by lane * width + column, where columns
+    0 to len(nodes) - 1 are the nodes and the rest are the ports:
+    acc, bak and pc hold the registers of every node
+    recv_src is the index being read from, -1 if not reading
+    send_dst is the index being sent to, -1 if not sending
+    send_val/has_val is the value being offered on send_dst
+    into_acc is set when a read from a port goes into ACC
+    """
+
+    def __init__(self, nodes, lanes=1, inputs=None, outputs=None):
+        self.nodes = nodes
+        self.index = dict((node, i) for i, node in enumerate(nodes))
+        self.positions = dict(((node.xpos, node.ypos), i)
+                              for i, node in enumerate(nodes))
+        self.lanes = lanes
+        self.cycle = 0
+        self.add_ports(inputs or dict(), outputs or dict())
+        self.compile(nodes)
+        self.load_state(nodes)
+
+    def add_ports(self, inputs, outputs):
+        """ Gives every input and output port a column after the nodes """
+        self.ports = dict()
+        self.input_values = dict()
+        self.output_values = dict()
+        column = len(self.nodes)
+        for key, values in inputs.items():
+            values = np.asarray(values, dtype=np.int64)
+            if (values.ndim != 2 or values.shape[0] != self.lanes):
+                raise ValueError("inputs for " + str(key) +
+                                 " need one row per lane")
+            self.ports[key] = column
+            self.input_values[column] = values
+            column += 1
+        for key, count in outputs.items():
+            self.ports[key] = column
+            self.output_values[column] = np.zeros((self.lanes, count),
+                                                  dtype=np.int64)
+            column += 1
+        for x, y, direction in self.ports:
+            node = self.nodes[self.positions[(x, y)]]
+            if (node.adjacency[direction] is not None):
+                raise ValueError("no room for a port on the " + direction +
+                                 " side of " + str(node))
+        self.width = column
+        self.size = self.lanes * self.width
+        self.column = np.tile(np.arange(self.width), self.lanes)
+        self.lane_base = np.repeat(np.arange(self.lanes) * self.width,
+                                   self.width)
+
+    def compile(self, nodes):
+        """ Builds the [column, line] program tables
+            Raises UnsupportedError for passive nodes (stacks and ports),
+            for MOVs on ANY or LAST and for ADD, SUB and JRO reading a
+            port, use inputs and outputs for ports
+        """
+        for node in nodes:
+            if (node.passive):
+                raise UnsupportedError(str(node) + " is not supported")
+        count = self.width
+        width = max([len(node.lines) for node in nodes] + [1])
+        jro_width = max([len(node.jro_table) for node in nodes] + [1])
+
+        shape = (count, width)
+        self.op = np.full(shape, LABEL, dtype=np.int64)
+        self.arg = np.zeros(shape, dtype=np.int64)
+        self.target = np.zeros(shape, dtype=np.int64)
+        self.next_pc = np.zeros(shape, dtype=np.int64)
+        self.jro_index = np.zeros(shape, dtype=np.int64)
+        self.src_kind = np.zeros(shape, dtype=np.int64)
+        self.src_node = np.zeros(shape, dtype=np.int64)
+        self.dst_kind = np.zeros(shape, dtype=np.int64)
+        self.dst_node = np.zeros(shape, dtype=np.int64)
+        self.jro_table = np.zeros((count, jro_width), dtype=np.int64)
+        self.jro_len = np.ones(count, dtype=np.int64)
+        has_code = np.zeros(count, dtype=bool)
+
+        for i, node in enumerate(nodes):
+            has_code[i] = bool(node.compiled)
+            length = len(node.lines)
+            self.next_pc[i, :length] = node.next_pc
+            self.jro_table[i, :len(node.jro_table)] = node.jro_table
+            self.jro_len[i] = max(len(node.jro_table), 1)
+            for line_num, instruction in node.code.items():
+                self.compile_instruction(i, node, line_num, instruction)
+        self.has_code = np.tile(has_code, self.lanes)
+
+    def port_operand(self, node, reg):
+        """ Returns the (kind, column) pair for a MOV port operand """
+        neighbor = node.adjacency[reg]
+        if (neighbor is None):
+            port = self.ports.get((node.xpos, node.ypos, reg))
+            if (port is not None):
+                return (PORT, port)
+            return (MISSING, 0)
+        return (PORT, self.index[neighbor])
+
+    def compile_instruction(self, i, node, line_num, instruction):
+        """ Fills in row i, column line_num of the program tables """
+        opcode, arg1, arg2 = instruction
+        at = (i, line_num)
+        self.jro_index[at] = node.jro_index[line_num]
+
+        if (opcode in ARITHMETIC):
+            if (arg1 == "ACC"):
+                self.op[at] = ARITHMETIC[opcode][1]
+            elif (arg1 == "NIL" or type(arg1) == int):
+                self.op[at] = ARITHMETIC[opcode][0]
+                self.arg[at] = 0 if arg1 == "NIL" else arg1
+            else:
+                raise UnsupportedError("VectorEngine cannot run " + opcode +
+                                       " " + str(arg1))
+        elif (opcode in SIMPLE):
+            self.op[at] = SIMPLE[opcode]
+        elif (opcode in JUMPS):
+            target = node.program.jump_target(arg1)
+            if (target is not None):
+                self.op[at] = JUMPS[opcode]
+                self.target[at] = target
+            else:
+                self.op[at] = NOP
+        elif (opcode == "JRO"):
+            if (type(arg1) == int):
+                self.op[at] = JMP
+                self.target[at] = node.jro_target(line_num, arg1)
+            elif (arg1 == "ACC"):
+                self.op[at] = JRO_ACC
+            elif (arg1 == "NIL"):
+                self.op[at] = HOLD
+            else:
+                raise UnsupportedError("VectorEngine cannot run JRO " +
+                                       str(arg1))
+        elif (opcode == "MOV"):
+            if (arg1 in ("ANY", "LAST") or arg2 in ("ANY", "LAST")):
+                # settling ANY depends on every neighbor, only the Scheduler
+                # does it
+                raise UnsupportedError("VectorEngine cannot run MOV " +
+                                       str(arg1) + ", " + str(arg2))
+            self.op[at] = MOV
+            if (arg1 in node.adjacency):
+                self.src_kind[at], self.src_node[at] = \
+                    self.port_operand(node, arg1)
+            elif (arg1 == "ACC"):
+                self.src_kind[at] = ACC
+            else:
+                self.src_kind[at] = IMM
+                self.arg[at] = arg1 if type(arg1) == int else 0
+            if (arg2 in node.adjacency):
+                self.dst_kind[at], self.dst_node[at] = \
+                    self.port_operand(node, arg2)
+            elif (arg2 == "ACC"):
+                self.dst_kind[at] = ACC
+            else:
+                self.dst_kind[at] = NIL
+        else:
+            self.op[at] = NOP
+
+    def load_state(self, nodes):
+        """ Copies the registers and MOV state of nodes into every lane """
+        self.acc = np.zeros(self.size, dtype=np.int64)
+        self.bak = np.zeros(self.size, dtype=np.int64)
+        self.pc = np.zeros(self.size, dtype=np.int64)
+        self.recv_src = np.full(self.size, -1, dtype=np.int64)
+        self.send_dst = np.full(self.size, -1, dtype=np.int64)
+        self.send_val = np.zeros(self.size, dtype=np.int64)
+        self.has_val = np.zeros(self.size, dtype=bool)
+        self.into_acc = np.zeros(self.size, dtype=bool)
+        lanes = np.arange(self.lanes) * self.width
+        for i, node in enumerate(nodes):
+            at = lanes + i
+            self.acc[at] = node.acc
+            self.bak[at] = node.bak
+            self.pc[at] = node.pc
+            if (node.receiving is not None):
+                self.recv_src[at] = lanes + self.index[node.receiving]
+            if (node.sending is not None):
+                self.send_dst[at] = lanes + self.index[node.sending]
+            if (node.value_to_send is not None):
+                self.send_val[at] = node.value_to_send
+                self.has_val[at] = True
+            self.into_acc[at] = node.receiving_into_acc
+
+        # ports, input ports are offering and output ports are reading
+        self.port_pos = np.zeros(self.size, dtype=np.int64)
+        self.output_count = dict()
+        for (x, y, direction), column in self.ports.items():
+            at = lanes + column
+            node_at = lanes + self.positions[(x, y)]
+            if (column in self.input_values):
+                self.send_dst[at] = node_at
+                self.feed(at)
+            elif (self.output_values[column].shape[1]):
+                self.recv_src[at] = node_at
+                self.output_count[(x, y, direction)] = self.port_pos[at]
+            else:
+                # an output with no room never reads
+                self.output_count[(x, y, direction)] = self.port_pos[at]
+
+    def feed(self, at):
+        """ Offers the next input value on the input port indexes in at """
+        for column, values in self.input_values.items():
+            port = at[self.column[at] == column]
+            pos = self.port_pos[port]
+            left = pos < values.shape[1]
+            lane = port // self.width
+            self.send_val[port[left]] = values[lane[left], pos[left]]
+            self.has_val[port[left]] = True
+            self.has_val[port[~left]] = False
+            self.send_dst[port[~left]] = -1
+
+    def collect(self, at, values):
+        """ Stores values read by the output port indexes in at """
+        for column, buffer in self.output_values.items():
+            mine = self.column[at] == column
+            port = at[mine]
+            pos = self.port_pos[port]
+            buffer[port // self.width, pos] = values[mine]
+            self.port_pos[port] = pos + 1
+            # stop reading once the lane's buffer is full
+            full = port[pos + 1 >= buffer.shape[1]]
+            self.recv_src[full] = -1
+        for key, column in self.ports.items():
+            if (column in self.output_values):
+                self.output_count[key] = \
+                    self.port_pos[self.column == column]
+
+    def write_back(self, lane=0):
+        """ Copies the state of one lane into the Node objects """
+        base = lane * self.width
+        count = len(self.nodes)
+        for i, node in enumerate(self.nodes):
+            at = base + i
+            node.acc = int(self.acc[at])
+            node.bak = int(self.bak[at])
+            node.pc = int(self.pc[at])
+            recv_src = self.recv_src[at] - base
+            send_dst = self.send_dst[at] - base
+            # ports have no Node object, they show up as not sending/receiving
+            node.receiving = None if not 0 <= recv_src < count \
+                else self.nodes[recv_src]
+            node.sending = None if not 0 <= send_dst < count \
+                else self.nodes[send_dst]
+            node.value_to_send = \
+                int(self.send_val[at]) if self.has_val[at] else None
+            node.receiving_into_acc = bool(self.into_acc[at])
+
+    def advance(self, sel):
+        """ Moves the pc of the indexes in sel onto their next line of code """
+        self.pc[sel] = self.next_pc[self.column[sel], self.pc[sel]]
+
+    def tick(self):
+        """ Runs every node for one cycle """
+        # freeze what every node is offering before anyone moves
+        offer_to = np.where(self.has_val, self.send_dst, -1)
+
+        # compute phase, every running node executes the opcode at its pc
+        running = np.nonzero(self.has_code & (self.recv_src < 0) &
+                             (self.send_dst < 0))[0]
+        ops = self.op[self.column[running], self.pc[running]]
+        for opcode in np.unique(ops):
+            self.execute(opcode, running[ops == opcode])
+
+        # commit phase: a read succeeds if the value was on offer when the
+        # tick started
+        readers = np.nonzero(self.recv_src >= 0)[0]
+        givers = self.recv_src[readers]
+        matched = offer_to[givers] == readers
+        readers = readers[matched]
+        givers = givers[matched]
+        values = self.send_val[givers]
+
+        if (self.input_values):
+            from_port = self.column[givers] >= len(self.nodes)
+            self.port_pos[givers[from_port]] += 1
+            self.feed(givers[from_port])
+            givers = givers[~from_port]
+        self.send_dst[givers] = -1
+        self.has_val[givers] = False
+        self.advance(givers)
+
+        if (self.output_values):
+            to_port = self.column[readers] >= len(self.nodes)
+            self.collect(readers[to_port], values[to_port])
+            readers = readers[~to_port]
+            values = values[~to_port]
+        self.recv_src[readers] = -1
+        forwarding = self.send_dst[readers] >= 0
+        self.send_val[readers[forwarding]] = values[forwarding]
+        self.has_val[readers[forwarding]] = True
+        done = readers[~forwarding]
+        into_acc = self.into_acc[done]
+        self.acc[done[into_acc]] = values[~forwarding][into_acc]
+        self.into_acc[done] = False
+        self.advance(done)
+
+        self.cycle += 1
+
+    def execute(self, opcode, sel):
+        """ Executes opcode on every index in sel """
+        pcs = self.pc[sel]
+        cols = self.column[sel]
+        if (opcode == LABEL or opcode == NOP):
+            self.advance(sel)
+        elif (opcode == ADD):
+            self.acc[sel] += self.arg[cols, pcs]
+            self.advance(sel)
+        elif (opcode == SUB):
+            self.acc[sel] -= self.arg[cols, pcs]
+            self.advance(sel)
+        elif (opcode == ADD_ACC):
+            self.acc[sel] *= 2
+            self.advance(sel)
+        elif (opcode == SUB_ACC):
+            self.acc[sel] = 0
+            self.advance(sel)
+        elif (opcode == NEG):
+            self.acc[sel] *= -1
+            self.advance(sel)
+        elif (opcode == SAV):
+            self.bak[sel] = self.acc[sel]
+            self.advance(sel)
+        elif (opcode == SWP):
+            self.acc[sel] = self.bak[sel]
+            self.advance(sel)
+        elif (opcode == JMP):
+            self.pc[sel] = self.target[cols, pcs]
+        elif (opcode in (JEZ, JNZ, JLZ, JGZ)):
+            acc = self.acc[sel]
+            if (opcode == JEZ):
+                taken = acc == 0
+            elif (opcode == JNZ):
+                taken = acc != 0
+            elif (opcode == JLZ):
+                taken = acc < 0
+            else:
+                taken = acc > 0
+            self.pc[sel] = np.where(taken, self.target[cols, pcs],
+                                    self.next_pc[cols, pcs])
+        elif (opcode == JRO_ACC):
+            index = np.clip(self.jro_index[cols, pcs] + self.acc[sel],
+                            0, self.jro_len[cols] - 1)
+            self.pc[sel] = self.jro_table[cols, index]
+        elif (opcode == MOV):
+            self.mov(sel, pcs)
+
+    def mov(self, sel, pcs):
+        """ Starts the MOV instructions of the indexes in sel """
+        cols = self.column[sel]
+        src_kind = self.src_kind[cols, pcs]
+        dst_kind = self.dst_kind[cols, pcs]
+        # a port with no node on the other side never completes
+        ready = (src_kind != MISSING) & (dst_kind != MISSING)
+        sel, pcs, cols = sel[ready], pcs[ready], cols[ready]
+        src_kind, dst_kind = src_kind[ready], dst_kind[ready]
+        base = self.lane_base[sel]
+
+        to_port = dst_kind == PORT
+        self.send_dst[sel[to_port]] = base[to_port] + \
+            self.dst_node[cols[to_port], pcs[to_port]]
+        self.into_acc[sel[dst_kind == ACC]] = True
+
+        from_port = src_kind == PORT
+        self.recv_src[sel[from_port]] = base[from_port] + \
+            self.src_node[cols[from_port], pcs[from_port]]
+
+        # registers and immediates are ready straight away
+        local = ~from_port
+        values = np.where(src_kind == ACC, self.acc[sel], self.arg[cols, pcs])
+        offering = local & to_port
+        self.send_val[sel[offering]] = values[offering]
+        self.has_val[sel[offering]] = True
+
+        stored = local & (dst_kind == ACC)
+        self.acc[sel[stored]] = values[stored]
+        self.into_acc[sel[stored]] = False
+        self.advance(sel[local & ~to_port])
+
+    def output_values_by_key(self):
+        """ Returns the output buffers keyed by (x, y, direction) """
+        return dict((key, self.output_values[column])
+                    for key, column in self.ports.items()
+                    if column in self.output_values)
+
+    def run(self, cycles):
+        """ Runs cycles ticks """
+        for i in range(cycles):
+            self.tick()
+
+
+BatchResult = namedtuple("BatchResult", "outputs cycles")
+
+
+def run_batch(nodes, inputs, outputs, max_cycles):
+    """ Runs the grid in nodes on one lane per row of the input arrays
+
+    inputs and outputs are as for VectorEngine, every output port has to
+    collect its count of values for a lane to finish
+    Stops once every lane has finished or after max_cycles
+
+    Returns a BatchResult where outputs maps each output key to a
+    (lanes, count) array and cycles holds the cycle each lane finished
+    on, -1 for lanes that did not finish
+    """
+    lanes = len(next(iter(inputs.values()))) if inputs else 1
+    engine = VectorEngine(nodes, lanes, inputs, outputs)
+    cycles = np.full(lanes, -1, dtype=np.int64)
+    while (engine.cycle < max_cycles):
+        engine.tick()
+        finished = np.ones(lanes, dtype=bool)
+        for key, count in outputs.items():
+            finished &= engine.output_count[key] >= count
+        cycles[finished & (cycles < 0)] = engine.cycle
+        if (finished.all()):
+            break
+    return BatchResult(engine.output_values_by_key(), cycles)
@@ -0,0 +1,165 @@
+""" This file contains the Visualizer, a live terminal view of a running
+    grid.
+
+    Every node is drawn as a cell at its (x, y) position. The view is
+    drawn on its own thread at a capped frame rate: once per frame the
+    renderer asks for a snapshot and the simulation thread hands one over
+    at the end of its next tick (see capture()), so the simulation only
+    pays for a snapshot per frame, not per cycle. Only cells whose text
+    changed since the last frame are redrawn, using ANSI cursor moves.
+
+    usage:
+        view = Visualizer(nodes)
+        view.start()
+        scheduler.run_until(cycles, predicate=view.capture)
+        view.stop()
+"""
+
+import sys
+import threading
+import time
+
+from colorama import Fore, Style
+
+# size of a cell, in characters and lines, and the gap between cells
+CELL_WIDTH = 22
+CELL_HEIGHT = 3
+GAP = 1
+
+# colors a code node is drawn in while running and while blocked
+COLORS = {"RUN": Fore.LIGHTGREEN_EX, "READ": Fore.LIGHTRED_EX,
+          "WRTE": Fore.LIGHTRED_EX, "IDLE": Fore.WHITE}
+
+
+def take_snapshot(scheduler):
+    """ Returns (cycle, per node state) for the grid run by scheduler """
+    state = []
+    for node in scheduler.nodes:
+        if (node.passive):
+            state.append(node.fingerprint())
+            continue
+        if (node.receiving is not None):
+            mode = "READ"
+        elif (node.sending is not None):
+            mode = "WRTE"
+        elif (node.compiled):
+            mode = "RUN"
+        else:
+            mode = "IDLE"
+        state.append((node.acc, node.bak, node.pc, mode))
+    return (scheduler.cycle, state)
+
+
+def format_cell(node, state):
+    """ Returns the color and the lines of text drawn for node in state """
+    position = "(" + str(node.xpos) + "," + str(node.ypos) + ")"
+    if (node.passive):
+        if (isinstance(state, tuple)):
+            # a stack, state is its values
+            return (Fore.CYAN, position + " STACK " + str(len(state)),
+                    " ".join(str(value) for value in state[-4:]), "")
+        return (Fore.CYAN, position + " PORT", "moved " + str(state), "")
+    acc, bak, pc, mode = state
+    line = node.lines[pc] if pc < len(node.lines) else ""
+    return (COLORS[mode], position + " " + mode,
+            "ACC %d BAK %d" % (acc, bak), "%2d: %s" % (pc, line))
+
+
+class Visualizer(object):
+
+    """ Draws the nodes of a grid on stream at most fps times a second
+
+    cells holds the text last drawn for every node
+    wanted is set by the renderer when it wants a snapshot, ready is set
+    by capture() once snapshot holds one
+    """
+
+    def __init__(self, nodes, fps=20, stream=None):
+        self.nodes = nodes
+        self.fps = fps
+        self.stream = stream or sys.stdout
+        self.left = min((node.xpos for node in nodes), default=0)
+        self.top = min((node.ypos for node in nodes), default=0)
+        self.rows = max((node.ypos for node in nodes), default=0) - \
+            self.top + 1
+        self.cells = [None] * len(nodes)
+        self.cycle = None
+        self.snapshot = None
+        self.wanted = threading.Event()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def capture(self, scheduler):
+        """ Hands the renderer a snapshot if it asked for one
+            Called by the simulation after every tick, this returns False
+            so it can be passed as the predicate of Scheduler.run_until
+        """
+        if (self.wanted.is_set()):
+            self.wanted.clear()
+            self.snapshot = take_snapshot(scheduler)
+            self.ready.set()
+        return False
+
+    def start(self):
+        """ Clears the screen and starts drawing on a daemon thread """
+        self.stream.write("\x1b[2J\x1b[?25l")
+        self.thread = threading.Thread(target=self.render_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, scheduler=None):
+        """ Stops the renderer, drawing the final state of scheduler if
+            given, and leaves the cursor under the grid
+        """
+        self.stopped.set()
+        if (self.thread is not None):
+            self.thread.join()
+        if (scheduler is not None):
+            self.draw(take_snapshot(scheduler))
+        row = self.rows * (CELL_HEIGHT + GAP) + 2
+        self.stream.write("\x1b[" + str(row) + ";1H\x1b[?25h" +
+                          Style.RESET_ALL)
+        self.stream.flush()
+
+    def render_loop(self):
+        interval = 1.0 / self.fps
+        while (not self.stopped.is_set()):
+            start = time.perf_counter()
+            self.wanted.set()
+            if (self.ready.wait(interval)):
+                self.ready.clear()
+                self.draw(self.snapshot)
+            # cap the frame rate
+            left = interval - (time.perf_counter() - start)
+            if (left > 0):
+                self.stopped.wait(left)
+
+    def draw(self, snapshot):
+        """ Redraws the cells that changed since the last frame """
+        self.stream.write(self.diff(snapshot))
+        self.stream.flush()
+
+    def diff(self, snapshot):
+        """ Returns the ANSI text that brings the screen up to date with
+            snapshot, and remembers it as drawn
+        """
+        cycle, state = snapshot
+        out = []
+        if (cycle != self.cycle):
+            out.append("\x1b[1;1H" + Style.RESET_ALL + "cycle " + str(cycle))
+            self.cycle = cycle
+        for i, node in enumerate(self.nodes):
+            cell = format_cell(node, state[i])
+            if (cell == self.cells[i]):
+                continue
+            self.cells[i] = cell
+            row = (node.ypos - self.top) * (CELL_HEIGHT + GAP) + 2
+            column = (node.xpos - self.left) * (CELL_WIDTH + GAP) + 1
+            color = cell[0]
+            for n, text in enumerate(cell[1:]):
+                out.append("\x1b[%d;%dH%s%s" % (
+                    row + n, column, color,
+                    text[:CELL_WIDTH].ljust(CELL_WIDTH)))
+            out.append(Style.RESET_ALL)
+        return "".join(out)